@@ -0,0 +1,369 @@
+#!/usr/bin/python
+
+# Drives a real Master with a farm of simulated clients rendering jobs of
+# increasing size, and reports dispatch latency percentiles, tasks/sec
+# through handle_line and per second of master time, client idle gaps,
+# master CPU time and peak RSS.
+#
+# In-process runs call Master.handle_line directly on a simulated clock,
+# so they measure the master alone. TCP runs start a master in a child
+# process behind the real MasterProtocol and connect the clients over
+# localhost, with render times taken in real seconds.
+#
+# With --batch N clients hold on to up to N finished tasks, or until they
+# run out of work, and report them with one set_task_statuses line.
+#
+#   python bench/farm.py [--tcp] [--clients N] [--frames 1000,10000,...]
+#                        [--dist constant|uniform|lognormal] [--mean S]
+#                        [--prefetch N] [--tasksize N] [--batch N]
+
+import StringIO
+import collections
+import heapq
+import math
+import optparse
+import os
+import random
+import resource
+import simplejson
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'lib'))
+
+from legion.client import Client
+from legion.jobs import Job
+from legion.master import Master
+
+# render time samplers, all with the given mean
+DISTRIBUTIONS = {
+    'constant': lambda rand, mean: mean,
+    'uniform': lambda rand, mean: rand.uniform(0.5 * mean, 1.5 * mean),
+    'lognormal': lambda rand, mean:
+        mean * rand.lognormvariate(0, 0.5) / math.exp(0.125),
+}
+
+def job_hash(frames, tasksize):
+    return {
+        'filename': 'farm.blend',
+        'startframe': 1,
+        'endframe': frames,
+        'tasksize': tasksize,
+        'timeout': 3600,
+        'jobdir': 'jobdir',
+        'jobname': 'farm',
+    }
+
+def parse_task(line):
+    """(job id, frame) of a render line, or None for any other line."""
+    if not line.startswith('POST '): return None
+    path = line.split(None, 2)[1].split('/')
+    if path[-1] != 'render': return None
+    return (int(path[2]), int(path[4]))
+
+def status_line(reports):
+    """One line reporting every (job id, frame, elapsed) in reports."""
+    if len(reports) == 1:
+        return 'set_task_status %d %d complete %.3f' % reports[0]
+    return 'set_task_statuses ' + ' '.join(
+        '%d %d complete %.3f' % report for report in reports)
+
+def percentile(samples, p):
+    if not samples: return 0.0
+    return samples[min(len(samples) - 1, int(len(samples) * p / 100.0))]
+
+def usage():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return (usage.ru_utime + usage.ru_stime, usage.ru_maxrss / 1024.0)
+
+class Result(object):
+    def __init__(self, mode, frames, clients):
+        self.mode = mode
+        self.frames = frames
+        self.clients = clients
+        self.latencies = []
+        self.idle_gaps = []
+        self.tasks = 0
+        self.elapsed = 0.0
+        # time the master spent handling lines, over TCP its CPU time
+        self.master_time = 0.0
+        self.cpu = 0.0
+        self.rss = 0.0
+
+    HEADER = "%-8s %8s %7s %10s %10s %8s %8s %8s %9s %7s %8s" % (
+        'mode', 'frames', 'clients', 'tasks/sec', 'master/s', 'p50 ms',
+        'p99 ms', 'max ms', 'idle ms', 'cpu s', 'rss MB')
+
+    def row(self):
+        latencies = sorted(self.latencies)
+        idle = sum(self.idle_gaps) / len(self.idle_gaps) \
+            if self.idle_gaps else 0.0
+        return "%-8s %8d %7d %10.0f %10.0f %8.3f %8.3f %8.3f %9.3f %7.2f %8.1f" % (
+            self.mode, self.frames, self.clients, self.tasks / self.elapsed,
+            self.tasks / self.master_time, percentile(latencies, 50) * 1000, percentile(latencies, 99) * 1000,
+            (latencies[-1] if latencies else 0.0) * 1000, idle * 1000,
+            self.cpu, self.rss)
+
+class SimProtocol(object):
+    """
+    Stands in for a client's connection. Lines are only collected while
+    the master handles a line, and delivered once it is done, so the
+    simulation doesn't count as master time.
+    """
+    def __init__(self, farm):
+        self.farm = farm
+        self.client_id = None
+
+    def sendLine(self, line):
+        self.farm.outbox.append((self.client_id, line, time.time()))
+
+class InProcessFarm(object):
+    """
+    Clients render one task at a time on a simulated clock, any others
+    they were sent wait in a queue. Latency is the wall time from a line
+    reaching handle_line, or the job being submitted, to each task it
+    causes to be sent. A client's idle gap runs from reporting its last
+    queued task to being sent the next one.
+    """
+    def __init__(self, options, frames):
+        self.options = options
+        self.frames = frames
+        self.rand = random.Random(1)
+        self.sample = DISTRIBUTIONS[options.dist]
+        self.master = Master()
+        self.now = 0.0
+        self.events = []
+        self.seq = 0
+        self.queues = {}
+        self.rendering = set()
+        self.idle_since = {}
+        self.reports = {}
+        self.outbox = []
+        self.result = Result('inproc', frames, options.clients)
+
+    def deliver(self, started):
+        for (client_id, line, sent) in self.outbox:
+            task = parse_task(line)
+            if not task: continue
+            self.result.latencies.append(sent - started)
+            if client_id in self.idle_since:
+                self.result.idle_gaps.append(
+                    sent - self.idle_since.pop(client_id))
+            self.queues[client_id].append(task)
+            self.render_next(client_id)
+        del self.outbox[:]
+
+    def render_next(self, client_id):
+        if client_id in self.rendering or not self.queues[client_id]: return
+        task = self.queues[client_id].popleft()
+        self.rendering.add(client_id)
+        elapsed = self.sample(self.rand, self.options.mean)
+        self.seq += 1
+        heapq.heappush(self.events,
+            (self.now + elapsed, self.seq, client_id, task, elapsed))
+
+    def handle_line(self, client_id, line):
+        started = time.time()
+        self.master.handle_line(client_id, line)
+        self.result.master_time += time.time() - started
+        self.deliver(started)
+
+    def run(self):
+        for i in range(self.options.clients):
+            protocol = SimProtocol(self)
+            client = Client(protocol)
+            protocol.client_id = client.id
+            self.queues[client.id] = collections.deque()
+            self.reports[client.id] = []
+            self.master.add_client(client)
+            self.handle_line(client.id, 'protocol 2')
+            self.handle_line(client.id, 'prefetch %d' % (self.options.prefetch,))
+
+        (cpu, rss) = usage()
+        start = time.time()
+        job = Job(StringIO.StringIO(simplejson.dumps(
+            job_hash(self.frames, self.options.tasksize))))
+        self.master.jobs.add_job(job)
+        started = time.time()
+        self.master.request_dispatch()
+        self.result.master_time += time.time() - started
+        self.deliver(started)
+
+        while self.events:
+            (self.now, seq, client_id, task, elapsed) = \
+                heapq.heappop(self.events)
+            self.rendering.discard(client_id)
+            self.result.tasks += 1
+            reports = self.reports[client_id]
+            reports.append(task + (elapsed,))
+            if len(reports) >= self.options.batch or \
+               not self.queues[client_id]:
+                if not self.queues[client_id]:
+                    self.idle_since[client_id] = time.time()
+                self.handle_line(client_id, status_line(reports))
+                del reports[:]
+            self.render_next(client_id)
+
+        self.result.elapsed = time.time() - start
+        (self.result.cpu, self.result.rss) = usage()
+        self.result.cpu -= cpu
+        return self.result
+
+def serve():
+    """
+    Child process side of a TCP run: serve a fresh master on a free port,
+    print the port, and print its CPU time and peak RSS when interrupted.
+    """
+    from twisted.internet import protocol, reactor
+    from legion.protocol import MasterProtocol
+
+    f = protocol.ServerFactory()
+    f.master = Master(call_later=reactor.callLater)
+    f.protocol = MasterProtocol
+    port = reactor.listenTCP(0, f, interface='127.0.0.1')
+    print port.getHost().port
+    sys.stdout.flush()
+    reactor.run()
+    print simplejson.dumps(usage())
+
+def run_tcp(options, frame_counts):
+    from twisted.internet import defer, protocol, reactor
+    from twisted.protocols import basic
+
+    sample = DISTRIBUTIONS[options.dist]
+    rand = random.Random(1)
+    results = []
+
+    class SimClient(basic.LineReceiver):
+        delimiter = '\n'
+
+        def connectionMade(self):
+            self.transport.setTcpNoDelay(True)
+            self.queue = collections.deque()
+            self.rendering = False
+            self.reported = collections.deque()
+            self.reports = []
+            self.idle_since = None
+            self.sendLine('protocol 2')
+            self.sendLine('prefetch %d' % (options.prefetch,))
+            self.factory.connected(self)
+
+        def lineReceived(self, line):
+            task = parse_task(line)
+            if not task: return
+            now = time.time()
+            if self.reported:
+                self.factory.result.latencies.append(
+                    now - self.reported.popleft())
+            if self.idle_since is not None:
+                self.factory.result.idle_gaps.append(now - self.idle_since)
+                self.idle_since = None
+            self.queue.append(task)
+            self.render_next()
+
+        def render_next(self):
+            if self.rendering: return
+            if not self.queue:
+                self.idle_since = time.time()
+                return
+            task = self.queue.popleft()
+            self.rendering = True
+            elapsed = sample(rand, options.mean)
+            reactor.callLater(elapsed, self.finish, task, elapsed)
+
+        def finish(self, task, elapsed):
+            self.rendering = False
+            self.reports.append(task + (elapsed,))
+            if len(self.reports) >= options.batch or not self.queue:
+                now = time.time()
+                self.reported.extend([now] * len(self.reports))
+                self.sendLine(status_line(self.reports))
+                self.reports = []
+            self.factory.task_done()
+            self.render_next()
+
+    class Farm(protocol.ClientFactory):
+        protocol = SimClient
+
+        def __init__(self, frames):
+            self.frames = frames
+            self.result = Result('tcp', frames, options.clients)
+            self.expected = -(-frames // options.tasksize)
+            self.conns = []
+            self.done = defer.Deferred()
+            self.child = subprocess.Popen(
+                [sys.executable, __file__, '--serve'], stdout=subprocess.PIPE)
+            port = int(self.child.stdout.readline())
+            for i in range(options.clients):
+                reactor.connectTCP('127.0.0.1', port, self)
+
+        def connected(self, conn):
+            self.conns.append(conn)
+            if len(self.conns) < options.clients: return
+
+            (fd, self.job_path) = tempfile.mkstemp(suffix='.job')
+            os.write(fd, simplejson.dumps(
+                job_hash(self.frames, options.tasksize)))
+            os.close(fd)
+            self.start = time.time()
+            conn.sendLine('new_job %s' % (self.job_path,))
+
+        def task_done(self):
+            self.result.tasks += 1
+            if self.result.tasks < self.expected: return
+
+            self.result.elapsed = time.time() - self.start
+            os.unlink(self.job_path)
+            for conn in self.conns:
+                conn.transport.loseConnection()
+            self.child.send_signal(2)
+            (self.result.cpu, self.result.rss) = \
+                simplejson.loads(self.child.communicate()[0])
+            self.result.master_time = self.result.cpu
+            self.done.callback(self.result)
+
+    @defer.inlineCallbacks
+    def trials():
+        try:
+            for frames in frame_counts:
+                results.append((yield Farm(frames).done))
+        finally:
+            reactor.stop()
+
+    reactor.callWhenRunning(trials)
+    reactor.run()
+    return results
+
+def main(args):
+    parser = optparse.OptionParser()
+    parser.add_option('--tcp', action='store_true', default=False)
+    parser.add_option('--serve', action='store_true', default=False)
+    parser.add_option('--clients', type='int', default=1000)
+    parser.add_option('--frames', default='1000,10000,100000')
+    parser.add_option('--dist', default='lognormal',
+        choices=sorted(DISTRIBUTIONS.keys()))
+    parser.add_option('--mean', type='float', default=None,
+        help='mean seconds per task, default 60 in-process, 0.05 over TCP')
+    parser.add_option('--prefetch', type='int', default=1)
+    parser.add_option('--tasksize', type='int', default=1)
+    parser.add_option('--batch', type='int', default=1)
+    (options, args) = parser.parse_args(args)
+
+    if options.serve: return serve()
+
+    frame_counts = [ int(frames) for frames in options.frames.split(',') ]
+    if options.mean is None:
+        options.mean = 0.05 if options.tcp else 60.0
+
+    print Result.HEADER
+    if options.tcp:
+        for result in run_tcp(options, frame_counts):
+            print result.row()
+    else:
+        for frames in frame_counts:
+            print InProcessFarm(options, frames).run().row()
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,109 @@
+#!/usr/bin/python
+
+# Submits jobs with a task for every frame to a real Master on a running
+# reactor, loading them inline on the reactor or in a thread, and reports
+# how long loading took and how late a timer checking the reactor every
+# --interval seconds ran meanwhile, which is how long clients would have
+# waited for the master to answer.
+#
+#   python bench/ingest.py [--frames 100000,1000000] [--jobs N]
+#                          [--interval S] [--storage objects|compact]
+
+import optparse
+import os
+import shutil
+import simplejson
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'lib'))
+
+from twisted.internet import defer, reactor, threads
+
+from legion.client import Client
+from legion.master import Master
+from legion.metrics import Histogram, StallMonitor
+
+class NullProtocol(object):
+    def sendLine(self, line):
+        pass
+
+def write_jobs(path, frames, count, storage):
+    paths = []
+    for i in range(count):
+        paths.append(os.path.join(path, '%d.job' % (i,)))
+        fh = open(paths[-1], 'w')
+        fh.write(simplejson.dumps({
+            'filename': 'ingest.blend',
+            'startframe': 1,
+            'endframe': frames,
+            'tasksize': 1,
+            'timeout': 3600,
+            'jobdir': 'jobdir',
+            'jobname': 'ingest%d' % (i,),
+            'lazy': False,
+            'storage': storage,
+        }))
+        fh.close()
+    return paths
+
+def ingest(options, frames, threaded):
+    """(seconds until every job was added, worst stall, mean stall)"""
+    path = tempfile.mkdtemp()
+    paths = write_jobs(path, frames, options.jobs, options.storage)
+    master = Master(call_later=reactor.callLater,
+        defer_to_thread=threads.deferToThread if threaded else None)
+    client = Client(NullProtocol())
+    master.add_client(client)
+    stalls = Histogram('stall_seconds', 'Stalls.')
+    monitor = StallMonitor(stalls, reactor.callLater, options.interval)
+
+    done = defer.Deferred()
+    started = time.time()
+    def check():
+        if len(master.jobs.jobs) < options.jobs:
+            reactor.callLater(options.interval / 10, check)
+            return
+        monitor.stop()
+        shutil.rmtree(path)
+        (counts, total) = stalls.series[()]
+        done.callback((time.time() - started, monitor.worst,
+            total / sum(counts)))
+
+    monitor.start()
+    master.handle_line(client.id, 'new_jobs %s' % (' '.join(paths),))
+    # after the monitor's first check, which loading inline makes late
+    reactor.callLater(options.interval * 2, check)
+    return done
+
+def main(args):
+    parser = optparse.OptionParser()
+    parser.add_option('--frames', default='100000,1000000')
+    parser.add_option('--jobs', type='int', default=1)
+    parser.add_option('--interval', type='float', default=0.01)
+    parser.add_option('--storage', default='objects',
+        choices=['objects', 'compact'])
+    (options, args) = parser.parse_args(args)
+
+    print "%-8s %8s %5s %9s %14s %14s" % (
+        'mode', 'frames', 'jobs', 'load s', 'worst stall ms', 'mean stall ms')
+
+    @defer.inlineCallbacks
+    def trials():
+        try:
+            for frames in [ int(f) for f in options.frames.split(',') ]:
+                for threaded in (False, True):
+                    (elapsed, worst, mean) = yield ingest(options, frames,
+                        threaded)
+                    print "%-8s %8d %5d %9.2f %14.1f %14.1f" % (
+                        'thread' if threaded else 'inline', frames,
+                        options.jobs, elapsed, worst * 1000, mean * 1000)
+        finally:
+            reactor.stop()
+
+    reactor.callWhenRunning(trials)
+    reactor.run()
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
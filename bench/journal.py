@@ -0,0 +1,87 @@
+#!/usr/bin/python
+
+# Measures how fast the master journals task completions, and how long a
+# restarted master takes to recover a job with a million tasks from a
+# snapshot plus a log tail, with completions in order (one range) and
+# scattered at random (hundreds of thousands of ranges).
+#
+#   python bench/journal.py [tasks]
+
+import StringIO
+import os
+import random
+import shutil
+import simplejson
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'lib'))
+
+from legion.jobs import Job, Jobs
+from legion.journal import Journal
+
+def make_job(tasks):
+    return Job(StringIO.StringIO(simplejson.dumps({
+        'filename': 'bench.blend',
+        'startframe': 1,
+        'endframe': tasks,
+        'tasksize': 1,
+        'timeout': 180,
+        'jobdir': 'jobdir',
+        'jobname': 'bench',
+        'lazy': True,
+    })))
+
+def fill(path, tasks, frames, tail):
+    """
+    Journals a job and completions for frames, snapshotting all but the
+    last tail of them. Returns the records written per second.
+    """
+    journal = Journal(path, snapshot_every=len(frames) + 2)
+    jobs = Jobs()
+    job = make_job(tasks)
+    jobs.add_job(job)
+    journal.append('job', job=job.to_hash())
+
+    start = time.time()
+    for (i, frame) in enumerate(frames):
+        if i == len(frames) - tail:
+            journal.flush(journal.take_snapshot(jobs.snapshot()))
+        job.completed.add(frame, frame)
+        journal.append('complete', job=job.id, start=frame, end=frame)
+        if i % 1000 == 0:
+            journal.flush()
+    journal.flush()
+    return len(frames) / (time.time() - start)
+
+def recover(path):
+    start = time.time()
+    (state, records) = Journal(path).recover()
+    jobs = Jobs()
+    jobs.restore(state, records)
+    job = jobs.pending().next()
+    return (time.time() - start, len(job.completed), job.count('pending'))
+
+def main(args):
+    tasks = int(args[0]) if args else 1000000
+    tail = tasks // 10
+    rand = random.Random(0)
+    done = tasks * 9 // 10
+    scattered = rand.sample(xrange(1, tasks + 1), done)
+
+    print "%-10s %10s %14s %10s %12s %12s" % (
+        'order', 'completed', 'appends/sec', 'ranges', 'pending', 'recover (s)')
+    for (name, frames) in [('in order', range(1, done + 1)),
+                           ('scattered', scattered)]:
+        path = tempfile.mkdtemp()
+        try:
+            rate = fill(path, tasks, frames, tail)
+            (elapsed, ranges, pending) = recover(path)
+        finally:
+            shutil.rmtree(path)
+        print "%-10s %10d %14.0f %10d %12d %12.2f" % (
+            name, len(frames), rate, ranges, pending, elapsed)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
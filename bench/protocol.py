@@ -0,0 +1,65 @@
+#!/usr/bin/python
+
+# Measures how fast the master encodes task messages, and how many bytes
+# go over the wire, with protocol 1 (full job JSON with every task) and
+# protocol 2 (job definition sent once, small per-task lines).
+#
+#   python bench/protocol.py [tasks]
+
+import StringIO
+import os
+import simplejson
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'lib'))
+
+from legion.client import Client
+from legion.jobs import Job
+
+class NullProtocol(object):
+    def sendLine(self, line):
+        pass
+
+def make_job(tasks):
+    return Job(StringIO.StringIO(simplejson.dumps({
+        'filename': 'bench.blend',
+        'startframe': 1,
+        'endframe': tasks,
+        'tasksize': 1,
+        'timeout': 180,
+        'jobdir': 'jobdir',
+        'jobname': 'bench',
+        'storage': 'compact',
+    })))
+
+def measure(version, job, clients=10):
+    """
+    Encodes every task of job for clients round robin, as the master does
+    when it hands them out. Returns (tasks/sec, bytes/task).
+    """
+    conns = [ Client(NullProtocol()) for i in range(clients) ]
+    for c in conns:
+        c.protocol_version = version
+
+    total = 0
+    start = time.time()
+    for (i, task) in enumerate(job.tasks):
+        task.client = conns[i % clients]
+        for line in conns[i % clients].task_lines(job, task):
+            total += len(line) + 1
+    elapsed = time.time() - start
+
+    return (len(job.tasks) / elapsed, float(total) / len(job.tasks))
+
+def main(args):
+    tasks = int(args[0]) if args else 100000
+    job = make_job(tasks)
+
+    print "%-9s %10s %14s %12s" % ('protocol', 'tasks', 'tasks/sec', 'bytes/task')
+    for version in (1, 2):
+        (rate, size) = measure(version, job)
+        print "%-9d %10d %14.0f %12.1f" % (version, tasks, rate, size)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
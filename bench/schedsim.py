@@ -0,0 +1,130 @@
+#!/usr/bin/python
+
+# Discrete event simulation of a render farm, used to compare schedulers.
+# Jobs are real legion Jobs driven through a real Jobs/Scheduler pair on a
+# simulated clock, and for every workload the makespan and mean job
+# turnaround are reported per scheduler.
+#
+#   python bench/schedsim.py [clients]
+
+import StringIO
+import heapq
+import os
+import random
+import simplejson
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'lib'))
+
+from legion.jobs import Job, Jobs
+from legion.scheduler import SCHEDULERS
+
+class SimClient(object):
+    def __init__(self, id):
+        self.id = id
+        self.status = 'idle'
+        self.tasks = set()
+        self.speed = None
+        self.failure_rate = 0.0
+        self.warm = set()
+
+def make_job(frames, tasksize=1, priority=0, weight=1):
+    return Job(StringIO.StringIO(simplejson.dumps({
+        'filename': 'sim.blend',
+        'startframe': 1,
+        'endframe': frames,
+        'tasksize': tasksize,
+        'timeout': 180,
+        'jobdir': 'jobdir',
+        'jobname': 'sim',
+        'priority': priority,
+        'weight': weight,
+    })))
+
+def big_then_small(rand):
+    """One long job followed by a trickle of short ones."""
+    work = [ (0.0, dict(frames=4000), 6.0) ]
+    for i in range(20):
+        work.append((30.0 * i + 10, dict(frames=40), 4.0))
+    return work
+
+def mixed(rand):
+    """Jobs of random size and priority arriving over an hour."""
+    work = []
+    for i in range(40):
+        work.append((
+            rand.uniform(0, 3600),
+            dict(frames=rand.choice([20, 100, 500, 2000]),
+                 priority=rand.choice([0, 0, 0, 1]),
+                 weight=rand.choice([1, 1, 2])),
+            rand.uniform(2, 10)))
+    return work
+
+WORKLOADS = [ big_then_small, mixed ]
+
+def simulate(scheduler, workload, clients, seed=1):
+    """
+    Runs workload, a list of (submit time, job arguments, seconds per
+    frame) tuples, on clients simulated clients. Returns the makespan and
+    the mean job turnaround in simulated seconds.
+    """
+    rand = random.Random(seed)
+    jobs = Jobs(scheduler=SCHEDULERS[scheduler]())
+    idle = [ SimClient(i) for i in range(clients) ]
+    events = []
+    seq = 0
+
+    for (submit, args, spf) in workload:
+        heapq.heappush(events, (submit, seq, 'submit', (args, spf)))
+        seq += 1
+
+    submitted = {}
+    spf_of = {}
+    turnaround = []
+    now = last = 0.0
+
+    while events:
+        (now, _, kind, data) = heapq.heappop(events)
+
+        if kind == 'submit':
+            (args, spf) = data
+            job = make_job(**args)
+            jobs.add_job(job)
+            submitted[job.id] = now
+            spf_of[job.id] = spf
+        else:
+            (client, job, task) = data
+            job.set_task_status(task.startframe, 'complete')
+            idle.append(client)
+            if job.status == 'complete':
+                turnaround.append(now - submitted[job.id])
+                last = now
+
+        while idle:
+            client = idle[-1]
+            (job, task) = jobs.assign_next_task(client)
+            if not task: break
+            idle.pop()
+            frames = task.endframe - task.startframe + 1
+            duration = frames * spf_of[job.id] * rand.uniform(0.8, 1.2)
+            heapq.heappush(events,
+                (now + duration, seq, 'finish', (client, job, task)))
+            seq += 1
+
+    first = min(submitted.values())
+    return (last - first, sum(turnaround) / len(turnaround))
+
+def main(args):
+    clients = int(args[0]) if args else 50
+
+    print "%-16s %-10s %14s %16s" % (
+        'workload', 'scheduler', 'makespan (s)', 'turnaround (s)')
+    for workload in WORKLOADS:
+        work = workload(random.Random(0))
+        for scheduler in sorted(SCHEDULERS):
+            (makespan, turnaround) = simulate(scheduler, work, clients)
+            print "%-16s %-10s %14.0f %16.0f" % (
+                workload.__name__, scheduler, makespan, turnaround)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
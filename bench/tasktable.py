@@ -0,0 +1,75 @@
+#!/usr/bin/python
+
+# Compares the memory and build time of the "objects" and "compact" task
+# storage modes. Every measurement runs in a fresh interpreter so the
+# resident set size isn't skewed by memory freed from a previous run.
+#
+#   python bench/tasktable.py [tasks ...]
+
+import StringIO
+import os
+import simplejson
+import subprocess
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'lib'))
+
+SIZES = [10000, 100000, 1000000]
+STORAGES = ['objects', 'compact']
+
+def rss():
+    fh = open('/proc/self/statm')
+    pages = int(fh.read().split()[1])
+    fh.close()
+    return pages * os.sysconf('SC_PAGE_SIZE')
+
+def measure(storage, tasks):
+    from legion.jobs import Job
+
+    job_file = StringIO.StringIO(simplejson.dumps({
+        'filename': 'bench.blend',
+        'startframe': 1,
+        'endframe': tasks,
+        'tasksize': 1,
+        'timeout': 180,
+        'jobdir': 'jobdir',
+        'jobname': 'bench',
+        'storage': storage,
+        # the bench is about the size of the task table, large jobs would
+        # otherwise be lazy and not build one
+        'lazy': False,
+    }))
+
+    before = rss()
+    start = time.time()
+    job = Job(job_file)
+    elapsed = time.time() - start
+    used = rss() - before
+
+    assert len(job.tasks) == tasks
+    print simplejson.dumps({ 'rss': used, 'build': elapsed })
+
+def main(args):
+    sizes = [ int(arg) for arg in args ] or SIZES
+
+    print "%-8s %10s %12s %14s %10s" % (
+        'storage', 'tasks', 'rss (MB)', 'bytes/task', 'build (s)')
+
+    for tasks in sizes:
+        for storage in STORAGES:
+            out = subprocess.Popen(
+                [sys.executable, __file__, '--measure', storage, str(tasks)],
+                stdout=subprocess.PIPE).communicate()[0]
+            result = simplejson.loads(out)
+            print "%-8s %10d %12.1f %14.1f %10.3f" % (
+                storage, tasks,
+                result['rss'] / 1048576.0,
+                float(result['rss']) / tasks,
+                result['build'])
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--measure']:
+        measure(sys.argv[2], int(sys.argv[3]))
+    else:
+        main(sys.argv[1:])
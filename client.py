@@ -2,22 +2,39 @@
 
 from twisted.internet.protocol import Protocol, ReconnectingClientFactory
 from twisted.protocols import basic
-from twisted.internet import reactor
+from twisted.internet import reactor, task
 
-import re
+import ConfigParser
+import os
+import platform
 import sys
 
 sys.path.append('lib')
 
-from legion.log import log
+from legion.assets import AssetCache
+from legion.worker import Worker, blender_command
 
 class LegionClient(basic.LineReceiver):
     delimiter = '\n'
-    render_re = re.compile(r'/jobs/([^/]+)/tasks/([^/]+)/render')
+    # asset chunks and job definitions with large manifests
+    MAX_LENGTH = 1 << 20
 
     def connectionMade(self):
+        self.heartbeat = task.LoopingCall(self.sendLine, 'ping')
+        self.heartbeat.start(self.factory.heartbeat_interval, now=False)
+        self.worker = Worker(self.sendLine, self.factory.command,
+            self.factory.slots, cache=self.factory.cache,
+            results=self.factory.results)
+        self.sendLine('protocol 2')
+        self.sendLine('slots %d' % (self.factory.slots,))
+        self.sendLine('prefetch %d' % (self.factory.prefetch,))
         self.sendLine('status')
-        self.sendLine('new_job jobs/dummy/dummy.job')
+        self.worker.report_cached_assets()
+
+    def connectionLost(self, reason):
+        if self.heartbeat.running: self.heartbeat.stop()
+        # the master requeues everything we were given
+        self.worker.stop()
 
     def sendLine(self, line):
         print "<<< %s" % (line,)
@@ -25,23 +42,18 @@ class LegionClient(basic.LineReceiver):
 
     def lineReceived(self, line):
         print ">>> %s" % (line,)
-
-        if line.startswith('#'): return
-        (method, path, content) = line.split(None, 2)
-        #print method, path, content
-        m = self.render_re.match(path)
-
-        if m:
-            print m.groups()
-            jobid, taskid = m.groups()
-            self.render_task(content, jobid=jobid, taskid=taskid)
-
-    def render_task(self, content, **kwargs):
-        jobid, frame = int(kwargs['jobid']), int(kwargs['taskid'])
-        self.sendLine('set_task_status %d %d complete' %
-            (jobid, frame))
+        self.worker.handle_line(line)
 
 class LegionClientFactory(ReconnectingClientFactory):
+    def __init__(self, heartbeat_interval, prefetch, slots, command,
+                 cache=None, results=None):
+        self.heartbeat_interval = heartbeat_interval
+        self.prefetch = prefetch
+        self.slots = slots
+        self.command = command
+        self.cache = cache
+        self.results = results
+
     def startedConnecting(self, connector):
         print 'Started to connect.'
 
@@ -49,7 +61,9 @@ class LegionClientFactory(ReconnectingClientFactory):
         print 'Connected.'
         print 'Resetting reconnection delay'
         self.resetDelay()
-        return LegionClient()
+        client = LegionClient()
+        client.factory = self
+        return client
 
     def clientConnectionLost(self, connector, reason):
         print 'Lost connection.  Reason:', reason
@@ -59,6 +73,30 @@ class LegionClientFactory(ReconnectingClientFactory):
         print 'Connection failed. Reason:', reason
         ReconnectingClientFactory.clientConnectionFailed(self, connector,
                                                          reason)
-reactor.connectTCP('localhost', 4200, LegionClientFactory())
+config = ConfigParser.RawConfigParser()
+config.read('legion.conf')
+
+# legion.conf has a section of paths for each platform
+section = {'Darwin': 'OSX'}.get(platform.system(), platform.system())
+
+cache = None
+if config.get('Global', 'asset_cache_dir'):
+    cache = AssetCache(config.get('Global', 'asset_cache_dir'),
+        config.getint('Global', 'asset_cache_size') * 1024 * 1024)
+
+results = None
+if config.get('Global', 'result_dir'):
+    results = os.path.abspath(config.get('Global', 'result_dir'))
+
+(master_host, master_port) = config.get('Global', 'master').rsplit(':', 1)
+
+reactor.connectTCP(master_host, int(master_port),
+    LegionClientFactory(config.getint('Global', 'heartbeat_interval'),
+                        config.getint('Global', 'prefetch'),
+                        config.getint('Global', 'slots'),
+                        blender_command(config.get(section, 'blender'),
+                                        config.get(section, 'root'),
+                                        results),
+                        cache, results))
 reactor.run()
 
@@ -0,0 +1,221 @@
+#!python
+
+import collections
+import hashlib
+import os
+import shutil
+
+from legion.error import LegionError
+from legion.log import log
+
+# raw bytes per chunk, sent base64 encoded so a chunk line stays under 64k
+CHUNK_SIZE = 48 * 1024
+
+def hash_file(path):
+    """(sha1 hex digest, size) of the file at path, read a chunk at a time."""
+    sha1 = hashlib.sha1()
+    size = 0
+    fh = open(path, 'rb')
+    try:
+        while True:
+            data = fh.read(CHUNK_SIZE)
+            if not data: break
+            sha1.update(data)
+            size += len(data)
+    finally:
+        fh.close()
+    return (sha1.hexdigest(), size)
+
+class AssetStore(object):
+    """
+    Master side of asset transfer: the files of every job, the scene and
+    any listed assets under the job's directory, by content hash, read
+    in chunks for workers that don't have them cached.
+    """
+    def __init__(self, root):
+        self.root = root
+        # hash -> path
+        self.paths = {}
+        # path -> (size, mtime, hash), files are only hashed again once
+        # they change
+        self.hashed = {}
+
+    def add(self, path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            raise LegionError('Missing asset "%s"' % (path,))
+
+        known = self.hashed.get(path)
+        if known and known[:2] == (st.st_size, st.st_mtime):
+            hash = known[2]
+        else:
+            (hash, size) = hash_file(path)
+            self.hashed[path] = (st.st_size, st.st_mtime, hash)
+        self.paths[hash] = path
+        return (hash, st.st_size)
+
+    def add_job(self, job):
+        """
+        Hash job's files and return its manifest, a dict of each file's
+        name relative to the job directory -> [hash, size].
+        """
+        manifest = {}
+        for name in [ job.filename ] + list(job.assets):
+            manifest[name] = list(
+                self.add(os.path.join(self.root, job.jobdir, name)))
+        return manifest
+
+    def register(self, job):
+        """Serve the files in the manifest of a job recovered from the journal."""
+        for (name, (hash, size)) in job.manifest.iteritems():
+            self.paths[hash] = os.path.join(self.root, job.jobdir, name)
+
+    def read_chunk(self, hash, index):
+        path = self.paths.get(hash)
+        if path is None:
+            raise LegionError('Unknown asset %s' % (hash,))
+        # workers give up on assets they're told are unknown, a file gone
+        # from under us is as good as unknown
+        try:
+            fh = open(path, 'rb')
+            try:
+                fh.seek(index * CHUNK_SIZE)
+                return fh.read(CHUNK_SIZE)
+            finally:
+                fh.close()
+        except (IOError, OSError), e:
+            raise LegionError('Unknown asset %s: %s' % (hash, e))
+
+class AssetDownload(object):
+    """An asset being received, verified against its hash once complete."""
+    def __init__(self, cache, hash, size):
+        self.cache = cache
+        self.hash = hash
+        self.size = size
+        self.received = 0
+        # chunks asked for and received so far, chunks arrive in order
+        self.requested = 0
+        self.chunks_received = 0
+        self.chunks = -(-size // CHUNK_SIZE)
+        self.sha1 = hashlib.sha1()
+        # the worker's call giving up on the download if nothing arrives
+        self.timeout_call = None
+        self.part = cache.blob_path(hash) + '.part'
+        self.fh = open(self.part, 'wb')
+
+    def write(self, data):
+        self.fh.write(data)
+        self.sha1.update(data)
+        self.received += len(data)
+        self.chunks_received += 1
+
+    def done(self):
+        return self.received >= self.size
+
+    def finish(self):
+        self.fh.close()
+        if self.sha1.hexdigest() != self.hash or self.received != self.size:
+            os.unlink(self.part)
+            raise LegionError('Asset %s failed verification' % (self.hash,))
+        os.rename(self.part, self.cache.blob_path(self.hash))
+        self.cache.add(self.hash, self.size)
+
+    def abort(self):
+        self.fh.close()
+        os.unlink(self.part)
+
+class AssetCache(object):
+    """
+    Worker side: assets kept on local disk by content hash, evicting the
+    least recently used ones beyond max_bytes. Assets of running renders
+    are pinned and never evicted. Each job gets a directory of links to
+    its assets under their original names, so scenes find their textures
+    by relative path.
+    """
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.objects = os.path.join(path, 'objects')
+        self.jobs = os.path.join(path, 'jobs')
+        # hash -> size, least recently used first
+        self.entries = collections.OrderedDict()
+        self.pinned = {}
+        self.size = 0
+        # assets added and evicted since take_changes was last called
+        self.added = set()
+        self.removed = set()
+        self.load()
+
+    def load(self):
+        if os.path.isdir(self.jobs): shutil.rmtree(self.jobs)
+        if not os.path.isdir(self.objects): os.makedirs(self.objects)
+
+        blobs = []
+        for name in os.listdir(self.objects):
+            path = os.path.join(self.objects, name)
+            if name.endswith('.part'):
+                os.unlink(path) # interrupted download
+                continue
+            st = os.stat(path)
+            blobs.append((st.st_atime, name, st.st_size))
+        for (atime, hash, size) in sorted(blobs):
+            self.entries[hash] = size
+            self.size += size
+        self.evict()
+
+    def blob_path(self, hash):
+        return os.path.join(self.objects, hash)
+
+    def has(self, hash):
+        return hash in self.entries
+
+    def touch(self, hash):
+        self.entries[hash] = self.entries.pop(hash)
+        os.utime(self.blob_path(hash), None)
+
+    def add(self, hash, size):
+        self.entries[hash] = size
+        self.size += size
+        self.added.add(hash)
+        self.removed.discard(hash)
+        self.evict()
+
+    def take_changes(self):
+        changes = (self.added, self.removed)
+        self.added = set()
+        self.removed = set()
+        return changes
+
+    def download(self, hash, size):
+        return AssetDownload(self, hash, size)
+
+    def pin(self, hash):
+        self.pinned[hash] = self.pinned.get(hash, 0) + 1
+
+    def unpin(self, hash):
+        self.pinned[hash] -= 1
+        if not self.pinned[hash]: del self.pinned[hash]
+        self.evict()
+
+    def evict(self):
+        if self.size <= self.max_bytes: return
+        for hash in list(self.entries):
+            if self.size <= self.max_bytes: break
+            if hash in self.pinned: continue
+            log.debug("Evicting asset %s from the cache", hash)
+            self.size -= self.entries.pop(hash)
+            os.unlink(self.blob_path(hash))
+            self.removed.add(hash)
+            self.added.discard(hash)
+
+    def job_dir(self, job_id, manifest):
+        """Directory holding links to every cached asset of a job."""
+        jobdir = os.path.join(self.jobs, str(job_id))
+        for (name, (hash, size)) in manifest.iteritems():
+            link = os.path.join(jobdir, name)
+            if os.path.lexists(link): os.unlink(link)
+            elif not os.path.isdir(os.path.dirname(link)):
+                os.makedirs(os.path.dirname(link))
+            os.symlink(self.blob_path(hash), link)
+        return jobdir
@@ -1,17 +1,62 @@
 #!python
 
 import simplejson
+import time
 
 from legion.log import log
 
 class Client(object):
     __next_id = 0
 
+    # weight of the newest sample in the rolling render rates
+    RATE_DECAY = 0.2
+    # seconds for the failure rate to halve without a task finishing, so
+    # clients kept off work for failing get to try again
+    FAILURE_HALF_LIFE = 300.0
+
     def __init__(self, protocol, status='idle'):
         self._status = status
         self._type = 'slave'
         self._protocol = protocol
         self._id = self.new_id()
+        self.last_seen = time.time()
+        # (job id, startframe) of every task this client is rendering or
+        # has queued. A client renders up to slots tasks at once and asks
+        # for prefetch - 1 more to be queued, it stays idle until it holds
+        # slots + prefetch - 1 tasks
+        self.tasks = set()
+        self.slots = 1
+        self.prefetch = 1
+        # frames saved so far of each task being rendered
+        self.progress = {}
+        # locality keys the client has warm, the hashes of the assets it
+        # has cached and the jobs it has rendered
+        self.warm = set()
+
+        # protocol 1 sends the full job with every task, protocol 2 sends
+        # each job definition once per connection and refers to it by id
+        self.protocol_version = 1
+        self.known_jobs = set()
+
+        # time spent without any task between finishing one and being
+        # handed the next, which is what dispatch latency costs the farm
+        self.idle_since = time.time()
+        self.idle_gap_last = None
+        self.idle_gap_max = 0.0
+        self.idle_gap_total = 0.0
+        self.idle_gap_count = 0
+
+        # rolling frames per second, speed relative to the average render
+        # time of the jobs it worked on (1.0 is an average node) and
+        # fraction of tasks that failed
+        self.fps = None
+        self.speed = None
+        self._failure_rate = 0.0
+        self.failure_time = time.time()
+        self.frames_rendered = 0
+        self.tasks_failed = 0
+        # rolling bytes per second rendered files are uploaded at
+        self.upload_rate = None
 
     @property
     def id(self):
@@ -38,24 +83,139 @@ class Client(object):
     def is_busy(self):
         return self.status == 'busy'
 
+    def update_status(self):
+        capacity = self.slots + self.prefetch - 1
+        self.status = 'busy' if len(self.tasks) >= capacity else 'idle'
+
+    def add_task(self, job_id, frame):
+        """
+        Returns how long the client was without a task, or None if it
+        already had one.
+        """
+        gap = None
+        if not self.tasks:
+            gap = time.time() - self.idle_since
+            self.record_idle_gap(gap)
+        self.tasks.add((job_id, frame))
+        self.update_status()
+        return gap
+
+    def remove_task(self, job_id, frame):
+        if (job_id, frame) not in self.tasks: return
+        self.tasks.remove((job_id, frame))
+        self.progress.pop((job_id, frame), None)
+        if not self.tasks:
+            self.idle_since = time.time()
+        self.update_status()
+
     def send_line(self, s):
-        log.msg(">>> %d | %s" % (self.id, s))
+        log.debug(">>> %d | %s", self.id, s)
         self._protocol.sendLine(s)
 
-    def to_hash(self):
-        return { 'id': self._id, 'status': self.status }
+    def record_idle_gap(self, gap):
+        self.idle_gap_last = gap
+        self.idle_gap_max = max(self.idle_gap_max, gap)
+        self.idle_gap_total += gap
+        self.idle_gap_count += 1
 
-    def render_task(self, job, task):
-        taskinfo = {
-            'job': job,
-            'task': task,
-        }
+    def get_failure_rate(self):
+        age = time.time() - self.failure_time
+        return self._failure_rate * 0.5 ** (age / Client.FAILURE_HALF_LIFE)
+
+    def set_failure_rate(self, rate):
+        self._failure_rate = rate
+        self.failure_time = time.time()
+
+    failure_rate = property(get_failure_rate, set_failure_rate)
+
+    def rolling(self, average, sample):
+        if average is None: return sample
+        return average + Client.RATE_DECAY * (sample - average)
+
+    def record_task(self, frames, elapsed, status, seconds_per_frame=None):
+        """
+        Fold a finished task into the client's rolling stats. status is
+        the status it was reported with, seconds_per_frame the average
+        render time of its job.
+        """
+        failed = status != 'complete'
+        self.failure_rate = self.rolling(self.failure_rate, float(failed))
+        if failed:
+            self.tasks_failed += 1
+            return
 
-        def encode_obj(obj):
-            return obj.to_hash()
+        self.frames_rendered += frames
+        if elapsed <= 0: return
+        self.fps = self.rolling(self.fps, frames / elapsed)
+        if seconds_per_frame:
+            self.speed = self.rolling(self.speed,
+                seconds_per_frame * frames / elapsed)
 
+    def record_upload(self, size, elapsed):
+        if elapsed <= 0: return
+        self.upload_rate = self.rolling(self.upload_rate, size / elapsed)
+
+    def idle_gap_mean(self):
+        if not self.idle_gap_count: return None
+        return self.idle_gap_total / self.idle_gap_count
+
+    def disconnect(self):
+        self._protocol.transport.loseConnection()
+
+    def to_hash(self):
+        return {
+            'id': self._id,
+            'status': self.status,
+            'slots': self.slots,
+            'prefetch': self.prefetch,
+            'tasks': len(self.tasks),
+            'warm': len(self.warm),
+            'progress': [
+                [job_id, frame, done]
+                for ((job_id, frame), done) in sorted(self.progress.items())
+            ],
+            'fps': self.fps,
+            'speed': self.speed,
+            'failure_rate': self.failure_rate,
+            'frames_rendered': self.frames_rendered,
+            'tasks_failed': self.tasks_failed,
+            'upload_rate': self.upload_rate,
+            'idle_gap': {
+                'last': self.idle_gap_last,
+                'mean': self.idle_gap_mean(),
+                'max': self.idle_gap_max,
+                'count': self.idle_gap_count,
+            },
+        }
+
+    def task_lines(self, job, task):
         # POST /jobs/:jobid/tasks/:taskid/render
         path = "/jobs/%d/tasks/%d/render" % (job.id, task.startframe)
-        taskstr = simplejson.dumps(taskinfo, default=encode_obj)
-        self.send_line("POST %s %s" % (path, taskstr))
-        self.status = 'busy'
+
+        if self.protocol_version < 2:
+            taskinfo = {
+                'job': job,
+                'task': task,
+            }
+
+            def encode_obj(obj):
+                return obj.to_hash()
+
+            taskstr = simplejson.dumps(taskinfo, default=encode_obj)
+            return ["POST %s %s" % (path, taskstr)]
+
+        lines = []
+        if job.id not in self.known_jobs:
+            # PUT /jobs/:jobid
+            lines.append("PUT /jobs/%d %s" % (job.id, job.to_json()))
+            self.known_jobs.add(job.id)
+        lines.append("POST %s %d %d" % (path, task.startframe, task.endframe))
+        return lines
+
+    def cancel_task(self, job, task):
+        # POST /jobs/:jobid/tasks/:taskid/cancel
+        self.send_line("POST /jobs/%d/tasks/%d/cancel" % (job.id, task.startframe))
+
+    def render_task(self, job, task):
+        for line in self.task_lines(job, task):
+            self.send_line(line)
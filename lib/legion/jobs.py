@@ -1,34 +1,95 @@
 #!python
 
+import StringIO
+import bisect
+import hashlib
+import heapq
+import sys
 import types
 import simplejson
+import threading
 import time
 
-from legion.log import log 
+from legion.log import log, INFO
 from legion.error import LegionError
-
-class Task(object):
-    KEYS = "startframe endframe status client".split()
-    def __init__(self, **kwargs):
-        self.client = None
-        for k in kwargs:
-            if k not in Task.KEYS: raise LegionError("Invalid key %s" % (k,))
-            setattr(self, k, kwargs[k])
-
-    def __eq__(self, other):
-        return self.__dict__ == other.__dict__
-
-    def to_hash(self):
-        hash = {}
-        for k in Task.KEYS:
-            hash[k] = getattr(self, k)
-        return hash
+from legion.ranges import RangeSet
+from legion.tasks import Task, TaskTable, CompactTaskTable
+from legion.scheduler import FairShareScheduler
+from legion import tiles
 
 class Job(object):
 
-    KEYS="id filename startframe endframe tasksize timeout jobdir jobname".split()
-
-    def __init__(self, job_file):
+    KEYS="id filename startframe endframe tasksize timeout jobdir jobname storage lazy priority weight chunking speculative assets manifest reuse type tiles resolution depends".split()
+
+    # how the job's tasks are held in memory, "compact" trades a little
+    # access speed for a much smaller footprint on very large jobs
+    TASK_TABLES = {
+        'objects': TaskTable,
+        'compact': CompactTaskTable,
+    }
+    storage = 'objects'
+
+    # lazy jobs keep frames nobody has touched yet as ranges and only
+    # create tasks as they are handed out, by default jobs with more tasks
+    # than LAZY_THRESHOLD are lazy
+    LAZY_THRESHOLD = 100000
+    lazy = None
+
+    # higher priority jobs are always served first, jobs of the same
+    # priority share the farm in proportion to their weight
+    priority = 0
+    weight = 1
+
+    # "fixed" cuts the frame range into tasksize chunks. "guided" cuts
+    # each chunk as it is handed out: once per-frame render times are
+    # known, chunks are 1/GUIDED_FACTOR of the remaining frames per client,
+    # so they start large and shrink towards tasksize as the job nears its
+    # end. Chunks are kept above MIN_TASK_SECONDS of work to amortise
+    # startup, and below half the job timeout.
+    CHUNKING = ['fixed', 'guided']
+    chunking = 'fixed'
+    GUIDED_FACTOR = 2
+    MIN_TASK_SECONDS = 30
+
+    # speculative jobs hand idle clients a second copy of their longest
+    # running tasks once nothing is left to hand out, the first copy to
+    # complete wins and the other one is cancelled
+    speculative = False
+
+    # files under jobdir the scene needs besides filename, like textures.
+    # With an asset store the master hashes them all into the manifest,
+    # {name: [hash, size]}, and workers fetch them by hash
+    assets = []
+    manifest = None
+
+    # frames already rendered from the same scene and assets into the
+    # same place by an earlier job are marked complete on submission,
+    # unless reuse is turned off
+    reuse = True
+
+    # "frame" jobs render whole frames. "tile" jobs split every frame of
+    # a resolution [width, height] into a grid of tiles [columns, rows],
+    # render each tile as a task and assemble them on the master, for
+    # stills and frames too slow to leave to a single client
+    TYPES = ['frame', 'tile']
+    type = 'frame'
+    tiles = None
+    resolution = None
+
+    # jobs this one needs frames of, each the id or name of an earlier
+    # job, or a dict of that job and a "window": [before, after] of its
+    # frames around each of our frames, or "all": true for all of them.
+    # Frames of a plain id or name need the same frame. Tasks are handed
+    # out as soon as the frames they need are rendered, so chained jobs
+    # overlap instead of running one after another
+    depends = []
+
+    scheduler = None
+    __last_id = 0
+    # jobs are loaded in a thread while the reactor restores others
+    __id_lock = threading.Lock()
+
+    def __init__(self, job_file, id=None):
         if type(job_file) == types.StringType:
             fh = file(job_file, 'r')
         else:
@@ -41,78 +102,605 @@ class Job(object):
                 raise LegionError('Invalid key in job file, "%s"' % key)
             setattr(self, "%s" % (key), job_data[key])
 
-        self.id = int(time.time())
+        if self.storage not in Job.TASK_TABLES:
+            raise LegionError('Invalid task storage "%s"' % (self.storage,))
+
+        if self.chunking not in Job.CHUNKING:
+            raise LegionError('Invalid chunking "%s"' % (self.chunking,))
+
+        if self.weight <= 0:
+            raise LegionError('Invalid job weight "%s"' % (self.weight,))
+
+        if self.type not in Job.TYPES:
+            raise LegionError('Invalid job type "%s"' % (self.type,))
+
+        if self.type == 'tile':
+            for key in ('tiles', 'resolution'):
+                value = getattr(self, key)
+                if not value or len(value) != 2 or min(value) < 1:
+                    raise LegionError('Invalid %s "%s"' % (key, value))
+            if self.chunking != 'fixed':
+                raise LegionError('Tile jobs can only use fixed chunking')
+            # every task renders a single tile
+            self.tasksize = 1
+
+        for dep in self.depends:
+            window = dep.get('window', [0, 0]) if isinstance(dep, dict) \
+                else [0, 0]
+            if len(window) != 2 or min(window) < 0:
+                raise LegionError('Invalid window "%s"' % (window,))
+
+        self.id = self.new_id(id)
+        self._json = None
         self.job_file = job_file
-        self.tasks = []
+        self.tasks = Job.TASK_TABLES[self.storage](self)
+        self.status_counts = {}
+        # tasks are handed out in row order by advancing a cursor, rows
+        # behind the cursor that get requeued are kept in a heap
+        self._cursor = 0
+        self._queue = []
+        self._queued = set()
+        self._segments = [] # sorted [start, end] ranges of untouched frames
+        # untouched frames held back until frames they depend on are
+        # rendered, always whole tasks
+        self._blocked = RangeSet()
+        # upstream jobs by id and the jobs depending on this one
+        self.upstreams = {}
+        self.dependents = []
+        self.completed = RangeSet()
+        self.render_time = 0.0
+        self.frames_timed = 0
+        self.timeouts = 0
+        self.requeues = 0
+        # (start time, row) of tasks handed out, oldest first, and the
+        # (client, start time) of the backup copy of speculated rows
+        self._running = []
+        self._copies = {}
+        self.speculated = 0
+        self.speculation_wins = 0
+        self.wasted_time = 0.0
+        self.saved_time = 0.0
         self.status = 'pending'
+        self.reused = 0
+        self._result_key = None
+        # when the job first passed over a client that didn't have it
+        # warm, since it was last handed to one that did
+        self.cold_since = None
         self.frames()
 
+    def new_id(self, id=None):
+        # ids are based on the submission time but must stay unique when
+        # several jobs are submitted within the same second
+        with Job.__id_lock:
+            if id is None:
+                id = max(int(time.time()), Job.__last_id + 1)
+            Job.__last_id = max(id, Job.__last_id)
+        return id
+
+    @classmethod
+    def restore(cls, hash, completed=()):
+        """
+        Rebuild a job from its to_hash() with the frames in completed, a
+        sorted list of [start, end] ranges, already done. Restored jobs are
+        always lazy so completed frames never need tasks of their own.
+        """
+        hash = dict(hash)
+        id = hash.pop('id')
+        hash['lazy'] = True
+        job = cls(StringIO.StringIO(simplejson.dumps(hash)), id)
+
+        job.completed = RangeSet(completed)
+        job._segments = []
+        frame = job.first
+        for (start, end) in job.completed:
+            if start > frame: job.add_segment(frame, start - 1)
+            frame = max(frame, end + 1)
+        if frame <= job.last:
+            job.add_segment(frame, job.last)
+        return job
+
+    def add_segment(self, start, end):
+        """
+        Mark frames start to end untouched, widened to the fixed tasks they
+        fall in. Frames completed by a job split up differently leave tasks
+        partly done, those are rendered again in full.
+        """
+        if self.chunking == 'fixed':
+            size = self.tasksize
+            start = self.first + (start - self.first) // size * size
+            end = min(self.last,
+                self.first + ((end - self.first) // size + 1) * size - 1)
+        if self._segments and start <= self._segments[-1][1] + 1:
+            self._segments[-1][1] = max(end, self._segments[-1][1])
+        else:
+            self._segments.append([start, end])
+
     def to_hash(self):
         hash = {}
         for key in Job.KEYS:
             hash[key] = getattr(self, key)
         return hash
 
+    def to_json(self):
+        # job definitions don't change once loaded, so encode them once
+        if self._json is None:
+            self._json = simplejson.dumps(self.to_hash())
+        return self._json
+
+    def locality_key(self):
+        """
+        What a client needs to have warm to start on the job quickly: the
+        hash of its scene, or for scenes read from the shared root, having
+        rendered the job before.
+        """
+        if self.manifest: return self.manifest[self.filename][0]
+        return 'job:%d' % (self.id,)
+
+    def result_key(self):
+        """
+        Identifies what the job's frames render to, from the content of
+        its scene and assets and where the output is written. None for
+        jobs without a manifest, whose content isn't known, and for jobs
+        depending on others, whose input is the other jobs' output. Tile
+        ids count from the job's first frame, so tile jobs only share
+        results with jobs starting at the same frame.
+        """
+        if not self.manifest or self.depends: return None
+        if self._result_key is None:
+            self._result_key = hashlib.sha1(simplejson.dumps([
+                sorted(self.manifest.items()), self.jobdir, self.jobname,
+                self.type, self.tiles, self.resolution,
+                self.startframe if self.type == 'tile' else None,
+            ])).hexdigest()
+        return self._result_key
+
+    def is_lazy(self):
+        if self.chunking == 'guided' or self.depends: return True
+        if self.lazy is not None: return self.lazy
+        frames = self.last - self.first + 1
+        return frames > Job.LAZY_THRESHOLD * self.tasksize
+
     def frames(self):
-        frame = self.startframe
-        self.type = 'frame'
-
-        self.tasks.extend([
-            Task(
-                startframe=frame,
-                endframe=
-                   (frame+self.tasksize-1)
-                   if frame+self.tasksize-1 < self.endframe
-                   else frame+((self.endframe-self.startframe) % (self.tasksize)),
-                status='pending'
-            )
-            for frame in range(self.startframe, self.endframe + 1, self.tasksize)
-        ])
+        # tasks are identified by the first of the frames they render, or
+        # for tile jobs by the tile's number, so the job's tasks cover the
+        # ids from first to last
+        if self.type == 'tile':
+            self.first = 0
+            self.last = (self.endframe - self.startframe + 1) * \
+                tiles.per_frame(self.tiles) - 1
+        else:
+            (self.first, self.last) = (self.startframe, self.endframe)
+
+        if self.is_lazy():
+            if self.first <= self.last:
+                self._segments = [[self.first, self.last]]
+            return
+
+        count = len(self.tasks)
+        self.tasks.extend_range(self.first, self.last, self.tasksize)
+        self.status_counts['pending'] = \
+            self.status_counts.get('pending', 0) + len(self.tasks) - count
+
+    def split_task(self, frame, status='pending', size=None):
+        """
+        Carve the task starting at frame out of the untouched frame space.
+        Without a size, tasks keep the same boundaries they would have had
+        if the job had been split up front. Returns None if no such task is
+        untouched.
+        """
+        i = bisect.bisect_right(self._segments, [frame, sys.maxint]) - 1
+        if i < 0: return None
+        (start, end) = self._segments[i]
+        if frame > end: return None
+        if size is None:
+            if (frame - self.first) % self.tasksize: return None
+            size = self.tasksize
+
+        taskend = min(frame + size - 1, end)
+        pieces = []
+        if start < frame: pieces.append([start, frame - 1])
+        if taskend < end: pieces.append([taskend + 1, end])
+        self._segments[i:i+1] = pieces
+
+        task = self.tasks.append(frame, taskend, status)
+        self.status_counts[status] = self.status_counts.get(status, 0) + 1
+        return task
+
+    def untouched_tasks(self):
+        return sum(
+            (end - start) // self.tasksize + 1
+            for (start, end) in self._segments) + self.blocked_tasks()
+
+    def blocked_tasks(self):
+        return sum(
+            (end - start) // self.tasksize + 1
+            for (start, end) in self._blocked)
+
+    def frame_ids(self, lo, hi):
+        """
+        (first, last) task id covering frames lo to hi, clipped to the job,
+        or None if none of them are in the job.
+        """
+        (lo, hi) = (max(lo, self.startframe), min(hi, self.endframe))
+        if lo > hi: return None
+        if self.type != 'tile': return (lo, hi)
+        n = tiles.per_frame(self.tiles)
+        return ((lo - self.startframe) * n, (hi - self.startframe + 1) * n - 1)
+
+    def id_frames(self, start, end):
+        """(first, last) frame the task ids start to end belong to."""
+        if self.type != 'tile': return (start, end)
+        n = tiles.per_frame(self.tiles)
+        return (self.startframe + start // n, self.startframe + end // n)
+
+    def completed_frames(self, lo, hi):
+        """Ranges of the frames from lo to hi that are fully rendered."""
+        ids = self.frame_ids(lo, hi)
+        if ids is None: return []
+        if self.type != 'tile': return self.completed.intersection(*ids)
+
+        n = tiles.per_frame(self.tiles)
+        frames = []
+        for (start, end) in self.completed.intersection(*ids):
+            # only frames with every tile rendered
+            (first, last) = (-(-start // n), (end + 1) // n - 1)
+            if first <= last:
+                frames.append((self.startframe + first, self.startframe + last))
+        return frames
+
+    def block(self):
+        """Hold back every untouched task until the frames it needs are in."""
+        for (start, end) in self._segments:
+            self._blocked.add(start, end)
+        self._segments = []
+        self.release_ready(self.startframe, self.endframe)
+
+    def upstream_completed(self, upstream, start, end):
+        """Release tasks waiting on the task ids start to end of upstream."""
+        if not self._blocked: return
+        (first, last) = upstream.id_frames(start, end)
+        for dep in self.depends:
+            if dep['job'] != upstream.id: continue
+            if dep.get('all'):
+                self.release_ready(self.startframe, self.endframe)
+            else:
+                (before, after) = dep['window']
+                self.release_ready(first - after, last + before)
+
+    def ready_frames(self, lo, hi):
+        """Ranges of our frames from lo to hi with everything they need."""
+        ready = RangeSet([(lo, hi)])
+        for dep in self.depends:
+            upstream = self.upstreams[dep['job']]
+            if dep.get('all'):
+                if not upstream.completed.contains(upstream.first,
+                                                   upstream.last):
+                    return []
+                continue
+
+            # a missing upstream frame m holds back our frames from
+            # m - after to m + before
+            (before, after) = dep['window']
+            (ulo, uhi) = (max(lo - before, upstream.startframe),
+                          min(hi + after, upstream.endframe))
+            if ulo > uhi: continue
+            frame = ulo
+            for (start, end) in upstream.completed_frames(ulo, uhi) + \
+                                [(uhi + 1, uhi + 1)]:
+                if start > frame:
+                    ready.remove(frame - after, start - 1 + before)
+                frame = end + 1
+        return list(ready)
+
+    def release_ready(self, lo, hi):
+        """Hand out the blocked tasks of frames lo to hi that are ready."""
+        ids = self.frame_ids(lo, hi)
+        if ids is None: return
+        # widened to the whole tasks the frames belong to
+        size = self.tasksize
+        (start, end) = ids
+        start = self.first + (start - self.first) // size * size
+        end = min(self.last,
+            self.first + ((end - self.first) // size + 1) * size - 1)
+        (lo, hi) = self.id_frames(start, end)
+
+        released = False
+        for (first, last) in self.ready_frames(lo, hi):
+            for (start, end) in self._blocked.intersection(
+                    *self.frame_ids(first, last)):
+                # only whole tasks, so segments start on task boundaries
+                start = self.first + -(-(start - self.first) // size) * size
+                if end != self.last and (end - self.first + 1) % size:
+                    end = self.first + (end - self.first + 1) // size * size - 1
+                if start > end: continue
+                self._blocked.remove(start, end)
+                bisect.insort(self._segments, [start, end])
+                released = True
+        if released and self.scheduler:
+            self.scheduler.job_changed(self)
+
+    def untouched_frames(self):
+        return sum(end - start + 1 for (start, end) in self._segments)
+
+    def task_count(self):
+        return len(self.tasks) + self.untouched_tasks()
+
+    def chunk_size(self, farm_size, speed=None):
+        """
+        Number of frames in the next task cut by guided chunking, for a
+        client speed times as fast as an average one.
+        """
+        remaining = self.untouched_frames()
+        spf = self.seconds_per_frame()
+        # probe with tasksize chunks until we know how long a frame takes
+        if not spf: return min(self.tasksize, remaining)
+
+        size = -(-remaining // (Job.GUIDED_FACTOR * max(farm_size, 1)))
+        if speed:
+            size = int(size * speed)
+            spf = spf / speed
+        size = max(size, int(Job.MIN_TASK_SECONDS / spf))
+        size = max(min(size, int(self.timeout / 2.0 / spf)), self.tasksize)
+        return min(size, remaining)
+
+    def get_task(self, frame):
+        task = self.tasks.find(frame)
+        if task is None and self.chunking == 'fixed':
+            task = self.split_task(frame)
+        if task is None:
+            raise LegionError('Job %d has no task starting at frame %d'
+                % (self.id, frame))
+        return task
+
+    def task_status_changed(self, task, old, new):
+        if old is not None:
+            self.status_counts[old] -= 1
+        self.status_counts[new] = self.status_counts.get(new, 0) + 1
+
+        if new == 'complete':
+            self.completed.add(task.startframe, task.endframe)
+            for job in self.dependents:
+                job.upstream_completed(self, task.startframe, task.endframe)
+        elif old == 'complete':
+            self.completed.remove(task.startframe, task.endframe)
+
+        row = task._row
+        if new in Task.QUEUED and row < self._cursor \
+           and row not in self._queued:
+            self._queued.add(row)
+            heapq.heappush(self._queue, row)
+
+        if self.scheduler:
+            self.scheduler.task_status_changed(self, task, old, new)
+
+    def seconds_per_frame(self):
+        if not self.frames_timed: return None
+        return self.render_time / self.frames_timed
+
+    def count(self, status):
+        count = self.status_counts.get(status, 0)
+        if status == 'pending': count += self.untouched_tasks()
+        return count
+
+    def has_queued_tasks(self):
+        if self._segments: return True
+        counts = self.status_counts
+        return bool(counts.get('pending') or counts.get('error'))
+
+    def can_speculate(self):
+        return self.speculative and not self.has_queued_tasks() and \
+            self.count('rendering') > len(self._copies)
 
     def all_tasks_complete(self):
-        complete = [] == [ 1 for task in self.tasks if task.status != 'complete' ]
-        log.msg("%s" % (complete,))
-        if complete:
+        complete = not self._segments and not self._blocked and \
+            self.count('complete') == len(self.tasks)
+        if complete and self.status != 'complete':
             self.status = 'complete'
-            log.msg("All tasks complete for job %d" % (self.id))
+            log.info("All tasks complete for job %d", self.id)
         return complete
 
     def cleanup(self):
         os.system('rm -R "%s"' % (self.job_dir))
 
-    def assign_next_task(self, client):
-        log.msg("get next step for job %d" % (self.id))
-        start = end = None
-
-        incomplete = (
-            task
-            for task in self.tasks
-            if task.status in ['pending', 'error']
-        )
-       
-        try:
-            next_task = incomplete.next()
-            next_task.status = 'rendering'
-            next_task.client = client
-            next_task.start_time = time.time()
-            return next_task
-        except StopIteration:
-            return None
-
-    def set_task_status(self, frame, status):
-        log.msg("Job %d: Setting task status for frame %d to '%s'"
-            % (self.id, frame, status))
-
-        for task in self.tasks:
-            if task.startframe != frame: continue
-            task.status = status
+    def assign_next_task(self, client, farm_size=1):
+        log.debug("get next step for job %d", self.id)
+
+        while self._queue:
+            row = heapq.heappop(self._queue)
+            self._queued.discard(row)
+            next_task = self.tasks[row]
+
+            # entries are dropped lazily when a task left the queued
+            # states without being assigned (eg. reported complete)
+            if next_task.status in Task.QUEUED:
+                return self.start_task(next_task, client)
+
+        while self._cursor < len(self.tasks):
+            next_task = self.tasks[self._cursor]
+            self._cursor += 1
+            if next_task.status in Task.QUEUED:
+                return self.start_task(next_task, client)
+
+        if self._segments:
+            size = None
+            if self.chunking == 'guided':
+                size = self.chunk_size(farm_size, client.speed)
+            next_task = self.split_task(self._segments[0][0], size=size)
+            self._cursor = len(self.tasks)
+            return self.start_task(next_task, client)
+
+        return None
+
+    def speculate(self, client):
+        """
+        Hand client a backup copy of the longest running task that has
+        none yet and isn't its own. Returns None if there is no such task.
+        """
+        if not self.can_speculate(): return None
+
+        skipped = []
+        task = None
+        while self._running:
+            (start_time, row) = heapq.heappop(self._running)
+            candidate = self.tasks[row]
+            if candidate.status != 'rendering' \
+               or candidate.start_time != start_time or row in self._copies:
+                continue
+            if candidate.client is client:
+                skipped.append((start_time, row))
+                continue
+            task = candidate
+            break
+
+        for entry in skipped:
+            heapq.heappush(self._running, entry)
+        if not task: return None
+
+        log.info("Job %d: speculating on frame %d", self.id, task.startframe)
+        self._copies[task._row] = (client, time.time())
+        self.speculated += 1
+        return task
+
+    def has_copy(self, task):
+        return task._row in self._copies
+
+    def is_backup(self, task, client):
+        return self.has_copy(task) and self._copies[task._row][0] is client
+
+    def release_task(self, task, client):
+        """
+        client stopped working on task without finishing it. If another
+        copy is still running that one carries on, otherwise the task is
+        requeued. Returns True if the task was requeued.
+        """
+        if task.status != 'rendering': return False
+
+        if task._row in self._copies:
+            (backup, backup_start) = self._copies.pop(task._row)
+            now = time.time()
+            if client is backup:
+                self.wasted_time += now - backup_start
+            elif client is task.client:
+                self.wasted_time += now - task.start_time
+                task.client = backup
+                task.start_time = backup_start
+                heapq.heappush(self._running, (backup_start, task._row))
+            return False
+
+        if task.client is not client: return False
+        self.requeue_task(task)
+        return True
+
+    def requeue_task(self, task):
+        if task._row in self._copies:
+            del self._copies[task._row]
+        task.status = 'pending'
+        task.client = None
+        self.requeues += 1
+
+    def stats(self):
+        return {
+            'id': self.id,
+            'status': self.status,
+            'tasks': self.task_count(),
+            'pending': self.count('pending'),
+            'rendering': self.count('rendering'),
+            'complete': self.count('complete'),
+            'error': self.count('error'),
+            'frames_complete': self.completed.size(),
+            'frames_reused': self.reused,
+            'blocked': self.blocked_tasks(),
+            'timeouts': self.timeouts,
+            'requeues': self.requeues,
+            'speculated': self.speculated,
+            'speculation_wins': self.speculation_wins,
+            'wasted_time': self.wasted_time,
+            'saved_time': self.saved_time,
+        }
+
+    def start_task(self, task, client):
+        task.status = 'rendering'
+        task.client = client
+        task.start_time = time.time()
+        if self.speculative:
+            heapq.heappush(self._running, (task.start_time, task._row))
+        return task
+
+    def set_task_status(self, frame, status, elapsed=None, client=None):
+        """
+        Set the status of the task starting at frame, as reported by
+        client. Returns the clients still running another copy of the task
+        that should be told to cancel it.
+        """
+        return self.update_task(self.get_task(frame), status, elapsed, client)
+
+    def update_task(self, task, status, elapsed=None, client=None):
+        """set_task_status for a task that has already been looked up."""
+        log.debug("Job %d: Setting task status for frame %d to '%s'",
+            self.id, task.startframe, status)
+        cancelled = []
+
+        # late reports from a copy that lost, or a client whose task timed
+        # out and was rendered elsewhere, don't undo a completed task
+        if client is not None and task.status == 'complete':
+            return cancelled
+        # nor do failures from a client no longer holding the task requeue
+        # it under the one rendering it now
+        if client is not None and status != 'complete' and \
+           client is not task.client and not self.is_backup(task, client):
+            return cancelled
+
+        if client is not None and self._copies and self.has_copy(task):
+            if status != 'complete':
+                # the other copy is still running, let that one finish
+                self.release_task(task, client)
+                return cancelled
+            cancelled = self.resolve_copies(task, client)
+
+        task.status = status
+        if status != 'complete': return cancelled
+
+        if elapsed is not None:
+            self.render_time += elapsed
+            self.frames_timed += task.endframe - task.startframe + 1
+        if not self._segments: self.all_tasks_complete()
+        return cancelled
+
+    def resolve_copies(self, task, winner):
+        """
+        winner finished a speculated task first. Account for the time the
+        losing copy wasted and, when the backup won, the time it saved
+        compared to waiting for an average render on the original client.
+        """
+        (backup, backup_start) = self._copies.pop(task._row)
+        now = time.time()
+
+        if winner is backup:
+            loser, loser_start = task.client, task.start_time
+            self.speculation_wins += 1
+            spf = self.seconds_per_frame()
+            if spf:
+                expected = task.start_time + \
+                    spf * (task.endframe - task.startframe + 1)
+                self.saved_time += max(0.0, expected - now)
+            task.client = backup
+        else:
+            loser, loser_start = backup, backup_start
+
+        self.wasted_time += now - loser_start
+        return [ loser ]
 
 # XXX this could/should be turned into an iterator
 class Jobs(object):
-    def __init__(self):
+    def __init__(self, scheduler=None):
         self.jobs = {}
         self.job_ids = []
         self.active_job_id = None
+        self.scheduler = scheduler or FairShareScheduler()
+        # (deadline, job id, startframe, start time) for every task handed
+        # out, entries for tasks that finished or were reassigned since are
+        # recognised by their start time and skipped
+        self.deadlines = []
 
     def all(self):
         return self.jobs
@@ -126,19 +714,158 @@ class Jobs(object):
         return self.by_status('pending')
 
     def add_job(self, job):
+        if job.depends: self.link(job)
         self.job_ids.append(job.id)
         self.jobs[job.id] = job
+        self.scheduler.add_job(job)
+
+    def find_job(self, ref):
+        """The job with id ref, or the latest one named ref."""
+        if isinstance(ref, basestring):
+            for job_id in reversed(self.job_ids):
+                if self.jobs[job_id].jobname == ref: return self.jobs[job_id]
+            raise LegionError('No job named "%s"' % (ref,))
+        return self.get_job(ref)
+
+    def link(self, job):
+        """
+        Resolve job's dependencies to the ids of the jobs it depends on and
+        hold back its tasks until the frames they need are rendered.
+        """
+        depends = []
+        for dep in job.depends:
+            if not isinstance(dep, dict): dep = { 'job': dep }
+            upstream = self.find_job(dep['job'])
+            if dep.get('all'):
+                depends.append({ 'job': upstream.id, 'all': True })
+            else:
+                depends.append({ 'job': upstream.id,
+                    'window': list(dep.get('window', [0, 0])) })
+            job.upstreams[upstream.id] = upstream
+
+        job.depends = depends
+        job._json = None
+        for upstream in job.upstreams.itervalues():
+            upstream.dependents.append(job)
+        job.block()
+
+    def check_depends(self, jobs):
+        """
+        Raise a LegionError unless every dependency of jobs resolves, were
+        they added in order, so a batch of jobs is added whole or not at all.
+        """
+        ids = set(self.jobs)
+        names = set(job.jobname for job in self.jobs.itervalues())
+        for job in jobs:
+            for dep in job.depends:
+                ref = dep['job'] if isinstance(dep, dict) else dep
+                if isinstance(ref, basestring) and ref not in names:
+                    raise LegionError('No job named "%s"' % (ref,))
+                if not isinstance(ref, basestring) and ref not in ids:
+                    raise LegionError('No job with id %d' % (ref,))
+            ids.add(job.id)
+            names.add(job.jobname)
 
     def get_job(self, id):
-        return self.jobs[id]
+        try:
+            return self.jobs[id]
+        except KeyError:
+            raise LegionError('No job with id %d' % (id,))
+
+    def snapshot(self):
+        """State of every job, for Journal.take_snapshot."""
+        return { 'jobs': [
+            {
+                'job': self.jobs[job_id].to_hash(),
+                'status': self.jobs[job_id].status,
+                'complete': list(self.jobs[job_id].completed),
+            }
+            for job_id in self.job_ids
+        ] }
+
+    def restore(self, state, records):
+        """
+        Rebuild the jobs from a snapshot state, or None, and the journal
+        records written after it. Completions are collected per job and
+        applied in one pass, which keeps recovering jobs with millions of
+        frames fast.
+        """
+        entries = state['jobs'] if state else []
+        jobs = [ (entry['job'], entry['status']) for entry in entries ]
+        completed = dict(
+            (entry['job']['id'], list(entry['complete'])) for entry in entries)
+        statuses = {}
+
+        for record in records:
+            op = record['op']
+            if op == 'job':
+                jobs.append((record['job'], 'pending'))
+                completed.setdefault(record['job']['id'], [])
+            elif op == 'complete':
+                if record['job'] in completed:
+                    completed[record['job']].append(
+                        (record['start'], record['end']))
+            elif op == 'job_status':
+                statuses[record['job']] = record['status']
+
+        for (hash, status) in jobs:
+            if hash['id'] in self.jobs: continue
+            job = Job.restore(hash, sorted(completed[hash['id']]))
+            job.status = statuses.get(job.id, status)
+            job.all_tasks_complete()
+            self.add_job(job)
 
     def delete_job(self, job_id):
+        if self.jobs[job_id].dependents:
+            raise LegionError('Job %d has jobs depending on it' % (job_id,))
         self.jobs[job_id].cleanup()
+        self.scheduler.remove_job(self.jobs[job_id])
         del self.job_ids[self.job_ids.index(job_id)]
         del self.jobs[job_id]
 
+    def set_job_status(self, job_id, status):
+        job = self.get_job(job_id)
+        job.status = status
+        self.scheduler.job_changed(job)
+
+    def set_farm_size(self, clients):
+        self.scheduler.farm_size = clients
+
+    def warm_changed(self, added=(), removed=()):
+        """Note locality keys that became warm or cold on a client."""
+        self.scheduler.warm_changed(added, removed)
+
+    def locality_retry(self):
+        """
+        When the last assign_next_task came up empty because jobs were
+        waiting for warm clients, the time the first of them stops waiting.
+        """
+        return self.scheduler.retry_at
+
+    def avoided(self):
+        """
+        Whether the last assign_next_task passed over its client in favour
+        of a faster idle one.
+        """
+        return self.scheduler.avoided
+
+    def assign_next_task(self, client):
+        self.scheduler.retry_at = None
+        self.scheduler.avoided = False
+        (job, task) = self.scheduler.assign_next_task(client)
+        if task and job.locality_key() in client.warm:
+            job.cold_since = None
+        # backup copies of speculated tasks don't get a deadline of their
+        # own, the original's covers them
+        if task and task.client is client:
+            # prefetched tasks wait behind the ones the client already has
+            timeout = job.timeout * (len(client.tasks) + 1)
+            heapq.heappush(self.deadlines, (task.start_time + timeout,
+                job.id, task.startframe, task.start_time))
+        return (job, task)
+
     def active_job(self):
-        log.msg("getting active job")
+        log.debug("getting active job")
 
 
         if not self.active_job_id or \
@@ -152,16 +879,55 @@ class Jobs(object):
         return self.jobs[self.active_job_id]
 
 
-    def check_timed_out_tasks(self):
-        log.msg("checking for timed out tasks")
-        for job in self.active:
-            for task in job.tasks:
-                if not (task.status == 'rendering'
-                    and task.start_time < time - job.timeout): break
-
-                job.status = 'pending'
-                log.warn("job %d frame %d has timed out and been re-queued")
-
+    def check_timed_out_tasks(self, now=None):
+        """
+        Requeue every task that has been rendering for longer than its
+        job's timeout. Returns a (client, job id, frame) tuple for each
+        task requeued.
+        """
+        if now is None: now = time.time()
+        requeued = []
+
+        while self.deadlines and self.deadlines[0][0] <= now:
+            (deadline, job_id, frame, start_time) = \
+                heapq.heappop(self.deadlines)
+
+            job = self.jobs.get(job_id)
+            if not job: continue
+            task = job.tasks.find(frame)
+            if task.status != 'rendering' or task.start_time != start_time:
+                continue
+
+            log.every('timeout', 1, INFO,
+                "job %d frame %d has timed out and been re-queued",
+                job.id, frame)
+            requeued.append((task.client, job.id, frame))
+            job.timeouts += 1
+            if not job.release_task(task, task.client):
+                # a backup copy took over, give it a full timeout too
+                heapq.heappush(self.deadlines, (task.start_time + job.timeout,
+                    job.id, frame, task.start_time))
+
+        return requeued
+
+    def requeue_client_tasks(self, client, tasks):
+        """
+        Requeue the tasks, given as (job id, frame) pairs, that client is
+        still rendering. Returns the number of tasks requeued.
+        """
+        requeued = 0
+        for (job_id, frame) in tasks:
+            job = self.jobs.get(job_id)
+            if not job: continue
+            task = job.tasks.find(frame)
+            if task is None: continue
+
+            if job.release_task(task, client):
+                log.debug("requeueing job %d frame %d from client %d",
+                    job.id, frame, client.id)
+                requeued += 1
+
+        return requeued
 
     def reset_tasks(self, job_id=None, slave=None):
         all_complete = True
@@ -181,7 +947,7 @@ class Jobs(object):
                     all_complete = False
             
             if not all_complete:
-                log.msg("setting job %d status to pending" % (job.id,))
+                log.info("setting job %d status to pending", job.id)
                 job.status = 'pending'
 
             if job_id: break
@@ -0,0 +1,137 @@
+#!python
+
+import os
+import simplejson
+
+from legion.log import log
+
+class Journal(object):
+    """
+    Append-only log of job submissions and task completions, plus periodic
+    snapshots of the whole job state, kept in a directory so a restarted
+    master can pick up where it left off.
+
+    Records are only buffered by append. take() hands the buffered lines
+    over, and write() appends them to the log and fsyncs it, so a caller
+    on the reactor thread can batch updates and do the writing in a thread.
+    Every record carries a sequence number. A snapshot remembers the last
+    one it includes, which lets recovery skip log records it already
+    covers if a crash happened between writing a snapshot and truncating
+    the log.
+    """
+    LOG = 'journal.log'
+    SNAPSHOT = 'journal.snapshot'
+
+    def __init__(self, path, snapshot_every=100000):
+        self.path = path
+        self.snapshot_every = snapshot_every
+        self.buffer = []
+        self.seq = 0
+        self.snapshot_seq = 0
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def log_path(self):
+        return os.path.join(self.path, Journal.LOG)
+
+    def snapshot_path(self):
+        return os.path.join(self.path, Journal.SNAPSHOT)
+
+    def append(self, op, **fields):
+        self.seq += 1
+        fields['op'] = op
+        fields['seq'] = self.seq
+        self.buffer.append(simplejson.dumps(fields))
+
+    def snapshot_due(self):
+        return self.seq - self.snapshot_seq >= self.snapshot_every
+
+    def take(self):
+        """Returns the buffered records as a block of lines, and clears them."""
+        if not self.buffer: return ''
+        data = '\n'.join(self.buffer) + '\n'
+        self.buffer = []
+        return data
+
+    def write(self, data, snapshot=None):
+        """
+        Append data, as returned by take, to the log and fsync it. If a
+        snapshot is given it replaces the previous one, and the log is
+        truncated since the snapshot covers everything in it.
+        """
+        if data:
+            fh = open(self.log_path(), 'a')
+            try:
+                fh.write(data)
+                fh.flush()
+                os.fsync(fh.fileno())
+            finally:
+                fh.close()
+
+        if snapshot is None: return
+
+        tmp = self.snapshot_path() + '.tmp'
+        fh = open(tmp, 'w')
+        try:
+            simplejson.dump(snapshot, fh)
+            fh.flush()
+            os.fsync(fh.fileno())
+        finally:
+            fh.close()
+        os.rename(tmp, self.snapshot_path())
+        open(self.log_path(), 'w').close()
+
+    def flush(self, snapshot=None):
+        self.write(self.take(), snapshot)
+
+    def take_snapshot(self, state):
+        """
+        Wrap state, as returned by Jobs.snapshot, for writing. Records
+        appended before this call are covered by it.
+        """
+        self.snapshot_seq = self.seq
+        return { 'seq': self.seq, 'state': state }
+
+    def write_failed(self):
+        """
+        A write raised, so what it was given may be partly on disk. The
+        next write is made a snapshot, which covers those records and
+        replaces the log.
+        """
+        self.snapshot_seq = min(self.snapshot_seq,
+            self.seq - self.snapshot_every)
+
+    def recover(self):
+        """
+        Returns the last snapshot's state, or None, and the log records
+        written after it.
+        """
+        state = None
+        if os.path.exists(self.snapshot_path()):
+            fh = open(self.snapshot_path())
+            try:
+                snapshot = simplejson.load(fh)
+            finally:
+                fh.close()
+            state = snapshot['state']
+            self.seq = self.snapshot_seq = snapshot['seq']
+
+        records = []
+        if os.path.exists(self.log_path()):
+            fh = open(self.log_path())
+            try:
+                for line in fh:
+                    try:
+                        record = simplejson.loads(line)
+                    except ValueError:
+                        # a write cut short by a crash, nothing follows it
+                        log.warn("Ignoring truncated journal record")
+                        break
+                    if record['seq'] <= self.snapshot_seq: continue
+                    records.append(record)
+                    self.seq = record['seq']
+            finally:
+                fh.close()
+
+        return (state, records)
@@ -1,3 +1,128 @@
 #!python
 
-from twisted.python import log
+import collections
+import threading
+import time
+
+from twisted.python import log as twisted_log
+
+DEBUG = 10
+INFO = 20
+WARN = 30
+ERROR = 40
+
+LEVELS = {
+    'debug': DEBUG,
+    'info': INFO,
+    'warn': WARN,
+    'error': ERROR,
+}
+LEVEL_NAMES = dict((level, name) for (name, level) in LEVELS.items())
+
+class FileSink(object):
+    """
+    Appends log lines to a file from a background thread. Writers only
+    append to an in-memory queue, the thread writes whatever has queued
+    up every interval seconds.
+    """
+    def __init__(self, path, interval=0.5):
+        self.path = path
+        self.interval = interval
+        self.lines = collections.deque()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def write(self, line):
+        self.lines.append(line)
+
+    def flush(self):
+        if not self.lines: return
+        lines = []
+        while self.lines:
+            lines.append(self.lines.popleft())
+        fh = open(self.path, 'a')
+        try:
+            fh.write('\n'.join(lines) + '\n')
+        finally:
+            fh.close()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.flush()
+        self.flush()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+class Logger(object):
+    """
+    Leveled logging that costs next to nothing for disabled levels.
+    Messages are %-formatted with their arguments only once they are
+    known to be written, so callers pass the arguments rather than a
+    formatted string. Messages go to twisted's log unless a sink is set.
+    """
+    def __init__(self, level=INFO, sink=None):
+        self.level = level
+        self.sink = sink
+        # key -> [interval start, messages suppressed in it]
+        self.limits = {}
+
+    def set_level(self, level):
+        if not isinstance(level, int): level = LEVELS[level]
+        self.level = level
+
+    def enabled(self, level):
+        return level >= self.level
+
+    def log(self, level, message, *args):
+        if level < self.level: return
+        if args: message = message % args
+        self.emit(level, message)
+
+    def debug(self, message, *args):
+        if DEBUG >= self.level: self.log(DEBUG, message, *args)
+
+    def info(self, message, *args):
+        if INFO >= self.level: self.log(INFO, message, *args)
+
+    def warn(self, message, *args):
+        if WARN >= self.level: self.log(WARN, message, *args)
+
+    def error(self, message, *args):
+        if ERROR >= self.level: self.log(ERROR, message, *args)
+
+    # twisted.python.log compatible
+    msg = info
+
+    def every(self, key, seconds, level, message, *args):
+        """
+        Log at most one message for key every seconds, for messages that
+        can come in bursts, like every task of a client that went away.
+        The next message written says how many were dropped in between.
+        """
+        if level < self.level: return
+        now = time.time()
+        limit = self.limits.get(key)
+        if limit and now - limit[0] < seconds:
+            limit[1] += 1
+            return
+
+        if args: message = message % args
+        if limit and limit[1]:
+            message = "%s (%d similar messages suppressed)" % (message, limit[1])
+        self.limits[key] = [now, 0]
+        self.emit(level, message)
+
+    def emit(self, level, message):
+        if self.sink is None:
+            if level != INFO:
+                message = "%s: %s" % (LEVEL_NAMES[level].upper(), message)
+            twisted_log.msg(message)
+            return
+        self.sink.write("%s [%s] %s" % (
+            time.strftime('%Y-%m-%dT%H:%M:%S'), LEVEL_NAMES[level], message))
+
+log = Logger()
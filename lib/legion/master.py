@@ -1,29 +1,158 @@
 #!python
 
-import re
+import base64
+import collections
+import os
+import simplejson
+import time
+import urllib
 
 from legion.client import Client
-from legion.log import log
+from legion.log import log, WARN
 from legion.jobs import Job, Jobs
 from legion.error import LegionError
+from legion.metrics import Gauge, Metrics
+from legion.results import ResultCache
+from legion import tiles
 
 class Master(object):
-    def __init__(self):
+    def __init__(self, call_later=None, lease_timeout=None, journal=None,
+                 assets=None, locality_wait=0, assembler=None, uploads=None,
+                 defer_to_thread=None):
         self.clients = {}
+        # ids of clients that may be idle, in the order they became idle,
+        # so dispatch doesn't have to look at every client in the pool
+        self.idle = collections.deque()
+        self.waiting = set()
         self.jobs = Jobs()
-    
+        self.jobs.scheduler.locality_wait = locality_wait
+        self.jobs.scheduler.faster_idle = self.faster_idle
+        self.call_later = call_later
+        self.dispatch_scheduled = False
+        self.locality_retry_at = None
+        # clients that haven't sent anything for lease_timeout seconds are
+        # dropped and their tasks requeued
+        self.lease_timeout = lease_timeout
+        # submissions, completions and job status changes are recorded in
+        # the journal so they survive a restart
+        self.journal = journal
+        # with an asset store, job files are hashed on submission and
+        # served to clients by hash instead of read from the shared root
+        self.assets = assets
+        # frames rendered by every job with a manifest, so resubmitted
+        # jobs only render what changed
+        self.results = ResultCache()
+        # puts the tiles of tile jobs together as they complete
+        self.assembler = assembler
+        # with an upload store, clients stream the files they render to
+        # the master instead of writing them to the shared root
+        self.uploads = uploads
+        # with defer_to_thread, eg. twisted's threads.deferToThread, job
+        # files are loaded in a thread one submission at a time, and each
+        # submission's jobs are added together once loaded
+        self.defer_to_thread = defer_to_thread
+        self.submissions = collections.deque()
+        self.loading = False
+
+        self.metrics = Metrics()
+        self.command_time = self.metrics.histogram('legion_command_seconds',
+            'Time spent handling each command.', ('command',))
+        self.command_errors = self.metrics.counter(
+            'legion_command_errors_total',
+            'Commands that were answered with an error.', ('command',))
+        self.dispatch_latency = self.metrics.histogram(
+            'legion_dispatch_latency_seconds',
+            'Time clients spent without a task before being handed one.')
+        self.asset_chunks = self.metrics.counter('legion_asset_chunks_total',
+            'Asset chunks sent to clients.')
+        self.placements = self.metrics.counter('legion_placements_total',
+            'Tasks handed to clients that had the job warm or not.',
+            ('locality',))
+        self.upload_bytes = self.metrics.counter('legion_upload_bytes_total',
+            'Bytes of rendered files received from clients.')
+        self.load_time = self.metrics.histogram('legion_job_load_seconds',
+            'Time spent loading the job files of each submission.')
+        self.reactor_stall = self.metrics.histogram(
+            'legion_reactor_stall_seconds',
+            'How late timers ran, time the reactor was kept busy.')
+        self.metrics.add_collector(self.collect_metrics)
+
+        # command name -> handler, looked up once per line
+        self.commands = dict(
+            (name[3:], getattr(self, name))
+            for name in dir(self) if name.startswith('do_'))
+
+    def recover(self):
+        """Rebuild the jobs recorded in the journal."""
+        (state, records) = self.journal.recover()
+        self.jobs.restore(state, records)
+        for job in self.jobs.jobs.itervalues():
+            if job.manifest and self.assets: self.assets.register(job)
+            key = job.result_key()
+            if key:
+                for (start, end) in job.completed:
+                    self.results.add(key, start, end)
+            if job.type == 'tile' and self.assembler:
+                self.reassemble(job)
+        log.info("Recovered %d jobs from the journal", len(self.jobs.jobs))
+        self.request_dispatch()
+
+    def journal_batch(self):
+        """
+        Returns the records the journal has buffered, and a snapshot of
+        every job when one is due, to be passed to Journal.write.
+        """
+        snapshot = None
+        if self.journal.snapshot_due():
+            snapshot = self.journal.take_snapshot(self.jobs.snapshot())
+        return (self.journal.take(), snapshot)
 
     def add_client(self, client):
         self.clients[client.id] = client
+        client.last_seen = time.time()
         client.send_line("# Welcome client %d" % (client.id))
-        log.msg("Adding client %d" % (client.id))
-        log.msg("%d clients currently in pool" % len(self.clients))
+        log.info("Adding client %d, %d clients currently in pool",
+            client.id, len(self.clients))
+        self.update_farm_size()
+        self.wake(client)
+        self.request_dispatch()
 
     def remove_client(self, id):
-        try:
-            del self.clients[id]
-        except KeyError:
-            raise LegionError('No client with id %d' % (id,))
+        client = self.get_client(id)
+        del self.clients[id]
+        self.update_farm_size()
+        if self.uploads: self.uploads.drop_client(id)
+        self.jobs.warm_changed(removed=client.warm)
+
+        requeued = self.jobs.requeue_client_tasks(client, client.tasks)
+        if requeued:
+            log.info("Requeued %d tasks from client %d", requeued, client.id)
+            self.request_dispatch()
+        client.tasks.clear()
+
+    def update_farm_size(self):
+        # jobs are split up by the number of tasks the farm renders at once
+        self.jobs.set_farm_size(
+            sum(client.slots for client in self.clients.itervalues()))
+
+    def expire_leases(self, now=None):
+        """
+        Drop every client we haven't heard from within the lease timeout,
+        catching half-open connections that never report being closed.
+        """
+        if not self.lease_timeout: return
+        if now is None: now = time.time()
+
+        expired = [
+            client
+            for client in self.clients.itervalues()
+            if client.last_seen + self.lease_timeout < now
+        ]
+
+        for client in expired:
+            log.warn("Lease for client %d expired", client.id)
+            self.remove_client(client.id)
+            client.disconnect()
 
     def clients(self):
         return self.clients
@@ -35,59 +164,313 @@ class Master(object):
             raise LegionError('No client with id %d' % (id,))
 
     def idle_clients(self):
-        log.msg("Looking for idle clients in pool")
         return (
             self.clients[id]
             for id in self.clients
             if self.clients[id].is_idle()
         )
 
+    def wake(self, client):
+        """Note that client may have become idle."""
+        if client.is_idle() and client.id not in self.waiting:
+            self.waiting.add(client.id)
+            self.idle.append(client.id)
+
+    def wake_idle_clients(self):
+        """Catch any idle client that was missed by wake."""
+        for client in self.idle_clients():
+            self.wake(client)
+
+    def request_dispatch(self):
+        """
+        Ask for idle clients to be handed work as soon as possible. With a
+        call_later function requests are coalesced into a single dispatch
+        on the next reactor iteration, otherwise we dispatch right away.
+        """
+        if not self.call_later:
+            self.dispatch_idle_clients()
+            return
+
+        if self.dispatch_scheduled: return
+        self.dispatch_scheduled = True
+
+        def dispatch():
+            self.dispatch_scheduled = False
+            self.dispatch_idle_clients()
+
+        self.call_later(0, dispatch)
+
+    def faster_idle(self, client):
+        """Whether a client that isn't slow is idle besides client."""
+        is_slow = self.jobs.scheduler.is_slow
+        for id in self.idle:
+            other = self.clients.get(id)
+            if other is not None and other is not client and \
+               other.is_idle() and not is_slow(other):
+                return True
+        return False
+
     def dispatch_idle_clients(self):
-        log.msg("Check for clients that need work")
-        idle = self.idle_clients()
-        active_job = self.jobs.active_job()
-        if not active_job: return
-        log.msg("Active job %s" % (active_job.to_hash()))
-        log.msg("Active tasks %s" % ( [ t.to_hash() for t in active_job.tasks ], ))
+        # clients passed over by jobs waiting for a client that has them
+        # warm, or for a faster client, they go back to the front of the
+        # queue
+        passed = []
+        try:
+            while self.idle:
+                # clients stay idle until they hold as many tasks as they
+                # asked to prefetch, removed clients are skipped
+                client = self.clients.get(self.idle[0])
+                while client and client.is_idle():
+                    (job, task) = self.jobs.assign_next_task(client)
+                    if not task: break
+                    gap = client.add_task(job.id, task.startframe)
+                    if gap is not None:
+                        self.dispatch_latency.observe(gap)
+                    self.placements.inc('warm'
+                        if job.locality_key() in client.warm else 'cold')
+                    client.render_task(job, task)
+                else:
+                    self.waiting.discard(self.idle.popleft())
+                    continue
+
+                # nothing left to hand out, unless the jobs waiting for a
+                # warm client, or a faster one, are waiting for the next
+                # one in line
+                if self.jobs.locality_retry() is None and \
+                   not self.jobs.avoided():
+                    return
+                passed.append(self.idle.popleft())
+        finally:
+            if passed:
+                self.idle.extendleft(reversed(passed))
+                self.schedule_locality_retry()
+
+    def schedule_locality_retry(self):
+        """Dispatch again once jobs stop waiting for warm clients."""
+        retry_at = self.jobs.locality_retry()
+        if not self.call_later or retry_at is None: return
+        if self.locality_retry_at is not None and \
+           self.locality_retry_at <= retry_at: return
+        self.locality_retry_at = retry_at
+
+        def retry():
+            self.locality_retry_at = None
+            self.request_dispatch()
 
-        for client in idle:
-            task = active_job.assign_next_task(client)
-            client.render_task(active_job, task)
+        self.call_later(max(0.0, retry_at - time.time()), retry)
+
+    def check_timed_out_tasks(self):
+        requeued = self.jobs.check_timed_out_tasks()
+        for (client, job_id, frame) in requeued:
+            client.remove_task(job_id, frame)
+            if client.id not in self.clients: continue
+            # the client's own timeout is later, stop it rendering a task
+            # that is handed to someone else
+            job = self.jobs.get_job(job_id)
+            client.cancel_task(job, job.tasks.find(frame))
+            self.wake(client)
+        if requeued:
+            self.request_dispatch()
 
     def handle_line(self, client_id, line):
         client = self.get_client(client_id)
-        line = line.strip()
-        tokens = line.split(' ')
-        log.msg(tokens)
+        started = client.last_seen = time.time()
+        command = 'unknown'
+        log.debug("<<< %d | %s", client_id, line)
 
         try:
-            if len(tokens) == 0:
-                raise RuntimeError("Empty line")
-
-            cmd = tokens[0]
-            cmd = re.sub(r'\W', '_', cmd)
-            
-            try:
-                func = getattr(self, 'do_%s' % (cmd,))
-                func(client, tokens[1:])
-            except AttributeError:
-                raise
+            (cmd, space, args) = line.strip().partition(' ')
+            func = self.commands.get(cmd)
+            if func is None:
+                raise LegionError('Unknown command "%s"' % (cmd,))
+            command = cmd
+            func(client, args.split())
         except Exception, e:
+            self.command_errors.inc(command)
+            log.every(('error', command), 10, WARN,
+                "Error handling %r from client %d: %s", line, client_id, e)
             client.send_line("Error: %s" % (e,))
+        self.command_time.observe(time.time() - started, command)
+
+    def collect_metrics(self):
+        tasks = Gauge('legion_job_tasks',
+            'Tasks of each job by status.', ('job', 'status'))
+        requeues = Gauge('legion_job_requeues_total',
+            'Tasks of each job put back in the queue.', ('job',), 'counter')
+        timeouts = Gauge('legion_job_timeouts_total',
+            'Tasks of each job that timed out.', ('job',), 'counter')
+        in_flight = Gauge('legion_tasks_in_flight',
+            'Tasks being rendered across all jobs.')
+
+        rendering = 0
+        for job in self.jobs.jobs.itervalues():
+            for status in ('pending', 'rendering', 'complete', 'error'):
+                tasks.set(job.count(status), job.id, status)
+            requeues.set(job.requeues, job.id)
+            timeouts.set(job.timeouts, job.id)
+            rendering += job.count('rendering')
+        in_flight.set(rendering)
+
+        clients = Gauge('legion_clients', 'Connected clients.')
+        clients.set(len(self.clients))
+        held = Gauge('legion_client_tasks',
+            'Tasks each client is rendering or has queued.', ('client',))
+        fps = Gauge('legion_client_fps',
+            'Rolling frames per second of each client.', ('client',))
+        frames = Gauge('legion_client_frames_rendered_total',
+            'Frames each client has rendered.', ('client',), 'counter')
+        failed = Gauge('legion_client_tasks_failed_total',
+            'Tasks each client reported failed.', ('client',), 'counter')
+        upload_rate = Gauge('legion_client_upload_bytes_per_second',
+            'Rolling rate each client uploads rendered files at.',
+            ('client',))
+        for id in sorted(self.clients):
+            c = self.clients[id]
+            held.set(len(c.tasks), id)
+            fps.set(c.fps, id)
+            frames.set(c.frames_rendered, id)
+            failed.set(c.tasks_failed, id)
+            upload_rate.set(c.upload_rate, id)
+
+        return [ tasks, requeues, timeouts, in_flight,
+                 clients, held, fps, frames, failed, upload_rate ]
 
     def check_arg_count(self, args, count):
         if len(args) != count: raise LegionError("Invalid number of arguments")
 
     def do_set_task_status(self, client, args):
-        self.check_arg_count(args, 3)
-        jobid, taskid, status = args
-        jobid = int(jobid)
-        taskid = int(taskid)
+        # set_task_status <jobid> <taskid> <status> [<seconds rendering>]
+        if len(args) not in (3, 4):
+            raise LegionError("Invalid number of arguments")
+        elapsed = float(args[3]) if len(args) == 4 else None
+        self.set_task_status(client, int(args[0]), int(args[1]), args[2],
+            elapsed)
+        self.request_dispatch()
+
+    def do_set_task_statuses(self, client, args):
+        # set_task_statuses <jobid> <taskid> <status> <seconds rendering>
+        #                   [<jobid> <taskid> <status> <seconds> ...]
+        # reports several tasks with a single dispatch for all of them,
+        # reports are applied in order up to the first one that fails
+        if not args or len(args) % 4:
+            raise LegionError("Invalid number of arguments")
+        try:
+            for i in xrange(0, len(args), 4):
+                self.set_task_status(client, int(args[i]), int(args[i + 1]),
+                    args[i + 2], float(args[i + 3]))
+        finally:
+            self.request_dispatch()
 
+    def set_task_status(self, client, jobid, taskid, status, elapsed=None):
+        # clients only ever finish or fail a task, anything else would be
+        # counted as a status of its own and the task forgotten
+        if status not in ('complete', 'error'):
+            raise LegionError('Invalid task status "%s"' % (status,))
         job = self.jobs.get_job(jobid)
-        job.set_task_status(taskid, status)
-        log.msg("%s"  % ([jobid, taskid, status],))
-        client.status = 'idle'
+        task = job.get_task(taskid)
+        if elapsed is None and task.start_time:
+            elapsed = time.time() - task.start_time
+
+        was_complete = task.status == 'complete'
+        cancelled = job.update_task(task, status, elapsed, client)
+        if not was_complete and task.status == 'complete':
+            if self.journal:
+                self.journal.append('complete', job=jobid,
+                    start=task.startframe, end=task.endframe)
+            key = job.result_key()
+            if key: self.results.add(key, task.startframe, task.endframe)
+            if job.type == 'tile' and self.assembler:
+                for unit in xrange(task.startframe, task.endframe + 1):
+                    self.assembler.add(job, unit)
+        client.remove_task(jobid, taskid)
+        self.wake(client)
+        for other in cancelled:
+            other.remove_task(jobid, taskid)
+            other.cancel_task(job, task)
+            self.wake(other)
+        if status == 'complete':
+            # the client has the job's scene loaded, at least for jobs
+            # that don't go through the asset cache
+            self.add_warm(client, [ job.locality_key() ])
+        if status in ('complete', 'error') and elapsed is not None:
+            client.record_task(task.endframe - task.startframe + 1, elapsed,
+                status, job.seconds_per_frame())
+
+    def do_protocol(self, client, args):
+        self.check_arg_count(args, 1)
+        version = int(args[0])
+        if version not in (1, 2):
+            raise LegionError("Unsupported protocol version %d" % (version,))
+        client.protocol_version = version
+        client.known_jobs.clear()
+
+    def do_prefetch(self, client, args):
+        self.check_arg_count(args, 1)
+        client.prefetch = max(1, int(args[0]))
+        client.update_status()
+        self.wake(client)
+        self.request_dispatch()
+
+    def do_slots(self, client, args):
+        # slots <number of tasks rendered at once>
+        self.check_arg_count(args, 1)
+        client.slots = max(1, int(args[0]))
+        client.update_status()
+        self.update_farm_size()
+        self.wake(client)
+        self.request_dispatch()
+
+    def do_progress(self, client, args):
+        # progress <jobid> <taskid> <frames saved>
+        self.check_arg_count(args, 3)
+        (jobid, taskid, done) = [ int(arg) for arg in args ]
+        if (jobid, taskid) in client.tasks:
+            client.progress[(jobid, taskid)] = done
+
+    def reassemble(self, job):
+        """
+        Place the completed tiles of a recovered job again, for frames that
+        weren't assembled before the restart.
+        """
+        for (start, end) in job.completed:
+            for unit in xrange(start, end + 1):
+                (frame, tile) = tiles.split_unit(unit, job.startframe,
+                    job.tiles)
+                if not os.path.exists(self.assembler.frame_path(job, frame)):
+                    self.assembler.add(job, unit)
+
+    def add_warm(self, client, keys):
+        added = [ key for key in keys if key not in client.warm ]
+        if not added: return
+        client.warm.update(added)
+        self.jobs.warm_changed(added=added)
+
+    def do_cached(self, client, args):
+        # cached <hash> [<hash> ...]
+        # assets the client has in its cache
+        self.add_warm(client, set(args))
+
+    def do_evicted(self, client, args):
+        # evicted <hash> [<hash> ...]
+        removed = set(args) & client.warm
+        client.warm -= removed
+        self.jobs.warm_changed(removed=removed)
+
+    def do_client_stats(self, client, args):
+        # client_stats [<clientid>]
+        if args:
+            self.check_arg_count(args, 1)
+            clients = [ self.get_client(int(args[0])) ]
+        else:
+            clients = self.clients.values()
+
+        for c in clients:
+            client.send_line("# %s" % (simplejson.dumps(c.to_hash()),))
+
+    def do_job_stats(self, client, args):
+        self.check_arg_count(args, 1)
+        job = self.jobs.get_job(int(args[0]))
+        client.send_line("# %s" % (simplejson.dumps(job.stats()),))
 
     def do_reset_tasks(self, client, args):
         self.jobs.reset_tasks(*args)
@@ -100,24 +483,169 @@ class Master(object):
         client = self.get_client(id)
         if clients.status == 'paused':
             clients.status = 'idle'
+            self.request_dispatch()
 
     def do_pause_client(self, client, args):
         id = args[0]
         client = self.get_client(id)
         clients.status = 'paused'
 
+    def set_job_status(self, job_id, status):
+        self.jobs.set_job_status(job_id, status)
+        if self.journal:
+            self.journal.append('job_status', job=job_id, status=status)
+
     def do_start_job(self, client, args):
-        job_id = args[0]
-        self.jobs[job_id].status = 'pending'
+        self.check_arg_count(args, 1)
+        self.set_job_status(int(args[0]), 'pending')
+        self.request_dispatch()
 
     def do_pause_job(self, client, args):
-        job_id = args[0]
-        self.jobs[job_id].status = 'paused'
+        self.check_arg_count(args, 1)
+        self.set_job_status(int(args[0]), 'paused')
 
     def do_new_job(self, client, args):
-        jobinfo = args[0]
-        job = Job(jobinfo)
-        self.jobs.add_job(job)
+        # new_job <path to job file>
+        self.check_arg_count(args, 1)
+        self.submit_jobs(client, args)
+
+    def do_new_jobs(self, client, args):
+        # new_jobs <path to job file> [<path to job file> ...]
+        # the jobs are added together, in order, or none of them are
+        if not args: raise LegionError("Invalid number of arguments")
+        self.submit_jobs(client, args)
+
+    def submit_jobs(self, client, paths):
+        if self.defer_to_thread is None:
+            self.add_jobs(client, self.load_jobs(paths))
+            return
+        self.submissions.append((client, paths))
+        self.load_next()
+
+    def load_next(self):
+        if self.loading or not self.submissions: return
+        (client, paths) = self.submissions.popleft()
+        self.loading = True
+        d = self.defer_to_thread(self.load_jobs, paths)
+        d.addCallback(lambda jobs: self.add_jobs(client, jobs))
+        d.addErrback(lambda failure: self.submit_failed(client, paths, failure))
+        d.addBoth(self.loaded)
+
+    def loaded(self, result):
+        self.loading = False
+        self.load_next()
+
+    def load_jobs(self, paths):
+        """
+        Parse the job files at paths, build their tasks and hash their
+        assets. Nothing the reactor uses is touched apart from the asset
+        store, which only this adds to, so it can run in a thread.
+        """
+        started = time.time()
+        jobs = []
+        for path in paths:
+            job = Job(path)
+            if self.assets:
+                job.manifest = self.assets.add_job(job)
+            jobs.append(job)
+        self.load_time.observe(time.time() - started)
+        return jobs
+
+    def submit_failed(self, client, paths, failure):
+        self.command_errors.inc('new_jobs' if len(paths) > 1 else 'new_job')
+        log.warn("Error loading jobs %s from client %d: %s", ' '.join(paths),
+            client.id, failure.getErrorMessage())
+        if client.id in self.clients:
+            client.send_line("Error: %s" % (failure.getErrorMessage(),))
+
+    def add_jobs(self, client, jobs):
+        self.jobs.check_depends(jobs)
+        for job in jobs:
+            (job, rendered) = self.reuse_results(job)
+            self.jobs.add_job(job)
+            if self.journal:
+                self.journal.append('job', job=job.to_hash())
+                for (start, end) in rendered:
+                    self.journal.append('complete', job=job.id,
+                        start=start, end=end)
+            log.info("Added job %d, %d tasks", job.id, job.task_count())
+            if client.id in self.clients:
+                client.send_line("# Added job %d" % (job.id,))
+        self.request_dispatch()
+
+    def reuse_results(self, job):
+        """
+        Returns job rebuilt with the frames an earlier job already rendered
+        the same way marked complete, and the ranges of those frames.
+        """
+        key = job.result_key()
+        if not key or not job.reuse: return (job, [])
+        rendered = self.results.rendered(key, job.first, job.last)
+        if not rendered: return (job, [])
+
+        reused = Job.restore(job.to_hash(), rendered)
+        reused.reused = reused.completed.size()
+        reused.all_tasks_complete()
+        log.info("Job %d: reusing %d frames rendered before", reused.id,
+            reused.reused)
+        return (reused, rendered)
+
+    def do_get_asset(self, client, args):
+        # get_asset <hash> <chunk>
+        self.check_arg_count(args, 2)
+        if not self.assets: raise LegionError("No asset store")
+        (hash, index) = (args[0], int(args[1]))
+        data = self.assets.read_chunk(hash, index)
+        self.asset_chunks.inc()
+        # PUT /assets/:hash/:chunk
+        client.send_line("PUT /assets/%s/%d %s"
+            % (hash, index, base64.b64encode(data)))
+
+    def upload_store(self):
+        if not self.uploads: raise LegionError("No upload store")
+        return self.uploads
+
+    def do_upload(self, client, args):
+        # upload <uploadid> <jobid> <size> <path>
+        self.check_arg_count(args, 4)
+        id = int(args[0])
+        try:
+            job = self.jobs.get_job(int(args[1]))
+        except LegionError, e:
+            raise LegionError('Upload %d: %s' % (id, e))
+        self.upload_store().begin(client.id, id, job, int(args[2]),
+            urllib.unquote(args[3]))
+
+    def do_upload_chunk(self, client, args):
+        # upload_chunk <uploadid> <chunk> <base64 data>
+        # chunks are written as they arrive and acked once on disk, clients
+        # only send so many ahead of the acks
+        self.check_arg_count(args, 3)
+        (id, index) = (int(args[0]), int(args[1]))
+        try:
+            data = base64.b64decode(args[2])
+        except TypeError:
+            self.upload_store().abort(client.id, id)
+            raise LegionError('Upload %d: chunk %d is not base64' % (id, index))
+        self.upload_store().write(client.id, id, index, data)
+        self.upload_bytes.inc_by(len(data))
+        # ACK /uploads/:id/:chunk
+        client.send_line("ACK /uploads/%d/%d" % (id, index))
+
+    def do_upload_end(self, client, args):
+        # upload_end <uploadid> <sha1>
+        self.check_arg_count(args, 2)
+        id = int(args[0])
+        upload = self.upload_store().finish(client.id, id, args[1])
+        client.record_upload(upload.size, time.time() - upload.started)
+        log.debug("Client %d uploaded %s", client.id, upload.path)
+        # POST /uploads/:id/done
+        client.send_line("POST /uploads/%d/done" % (id,))
+
+    def do_upload_abort(self, client, args):
+        # upload_abort <uploadid>
+        self.check_arg_count(args, 1)
+        self.upload_store().abort(client.id, int(args[0]))
 
     def do_ping(self, client, args):
         client.send_line("pong")
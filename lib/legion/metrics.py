@@ -0,0 +1,194 @@
+#!python
+
+import bisect
+import simplejson
+import time
+
+from twisted.web import resource
+
+def format_labels(names, values):
+    if not names: return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (name, str(value).replace('\\', r'\\')
+            .replace('"', r'\"').replace('\n', r'\n'))
+        for (name, value) in zip(names, values))
+
+def format_value(value):
+    if value is None: return 'NaN'
+    if value == float('inf'): return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Counter(object):
+    type = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}
+
+    def inc(self, *labels):
+        self.inc_by(1, *labels)
+
+    def inc_by(self, amount, *labels):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        for labels in sorted(self.values):
+            yield (self.name, format_labels(self.labels, labels),
+                self.values[labels])
+
+class Histogram(object):
+    """
+    Counts observations into fixed buckets. Bucket counts are kept per
+    bucket and only made cumulative when rendered, so observing is a
+    bisect and two additions.
+    """
+    type = 'histogram'
+
+    BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+        0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+    def __init__(self, name, help, labels=(), buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self.series = {}
+
+    def observe(self, value, *labels):
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def samples(self):
+        names = self.labels + ('le',)
+        for labels in sorted(self.series):
+            (counts, total) = self.series[labels]
+            count = 0
+            for (bound, n) in zip(self.buckets + (float('inf'),), counts):
+                count += n
+                yield ('%s_bucket' % self.name,
+                    format_labels(names, labels + (format_value(bound),)),
+                    count)
+            label_str = format_labels(self.labels, labels)
+            yield ('%s_sum' % self.name, label_str, total)
+            yield ('%s_count' % self.name, label_str, count)
+
+class Gauge(object):
+    """
+    Values read from the master's state when the metrics are rendered.
+    Totals kept elsewhere, like a job's requeues, are exposed as gauges
+    of type counter.
+    """
+    def __init__(self, name, help, labels=(), type='gauge'):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.type = type
+        self.values = []
+
+    def set(self, value, *labels):
+        self.values.append((labels, value))
+
+    def samples(self):
+        for (labels, value) in self.values:
+            yield (self.name, format_labels(self.labels, labels), value)
+
+class StallMonitor(object):
+    """
+    Measures how long the reactor is kept from running timers. A call is
+    scheduled every interval seconds and how late it runs is observed in
+    histogram, so anything blocking the reactor shows up as lateness.
+    """
+    def __init__(self, histogram, call_later, interval=0.1):
+        self.histogram = histogram
+        self.call_later = call_later
+        self.interval = interval
+        self.due = None
+        self.call = None
+        self.worst = 0.0
+
+    def start(self):
+        self.due = time.time() + self.interval
+        self.call = self.call_later(self.interval, self.check)
+
+    def stop(self):
+        if self.call and self.call.active(): self.call.cancel()
+
+    def check(self):
+        stall = max(0.0, time.time() - self.due)
+        self.histogram.observe(stall)
+        self.worst = max(self.worst, stall)
+        self.start()
+
+class Metrics(object):
+    """
+    Registry of the master's metrics, rendered in the Prometheus text
+    format. Counters and histograms are updated as things happen,
+    collectors are called on every render and return gauges built from
+    the master's current state.
+    """
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def counter(self, name, help, labels=()):
+        return self.register(Counter(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=Histogram.BUCKETS):
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def add_collector(self, collector):
+        self.collectors.append(collector)
+
+    def render(self):
+        metrics = list(self.metrics)
+        for collector in self.collectors:
+            metrics.extend(collector())
+
+        lines = []
+        for metric in metrics:
+            lines.append('# HELP %s %s' % (metric.name, metric.help))
+            lines.append('# TYPE %s %s' % (metric.name, metric.type))
+            for (name, labels, value) in metric.samples():
+                lines.append('%s%s %s' % (name, labels, format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+class MetricsResource(resource.Resource):
+    isLeaf = True
+
+    def __init__(self, master):
+        resource.Resource.__init__(self)
+        self.master = master
+
+    def render_GET(self, request):
+        request.setHeader('Content-Type', 'text/plain; version=0.0.4')
+        return self.master.metrics.render()
+
+class StatsResource(resource.Resource):
+    isLeaf = True
+
+    def __init__(self, master):
+        resource.Resource.__init__(self)
+        self.master = master
+
+    def render_GET(self, request):
+        request.setHeader('Content-Type', 'application/json')
+        return simplejson.dumps({
+            'jobs': [ job.stats() for job in self.master.jobs.jobs.values() ],
+            'clients': [ c.to_hash() for c in self.master.clients.values() ],
+        })
+
+def web_console(master):
+    """Root resource serving /metrics and /stats for master."""
+    root = resource.Resource()
+    root.putChild('metrics', MetricsResource(master))
+    root.putChild('stats', StatsResource(master))
+    return root
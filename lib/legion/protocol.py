@@ -0,0 +1,28 @@
+#!python
+
+from twisted.protocols import basic
+
+from legion.client import Client
+from legion.error import LegionError
+from legion.log import log
+
+class MasterProtocol(basic.LineReceiver):
+    delimiter = '\n'
+    # uploaded chunks of rendered files
+    MAX_LENGTH = 1 << 20
+
+    def connectionMade(self):
+        log.debug("New client connected")
+        client = Client(self)
+        self.client_id = client.id
+        self.factory.master.add_client(client)
+
+    def connectionLost(self, reason):
+        log.info("Connection to client %d lost", self.client_id)
+        try:
+            self.factory.master.remove_client(self.client_id)
+        except LegionError:
+            pass # already dropped when its lease expired
+
+    def lineReceived(self, line):
+        self.factory.master.handle_line(self.client_id, line)
@@ -0,0 +1,65 @@
+#!python
+
+import bisect
+
+class RangeSet(object):
+    """
+    A set of frames kept as sorted, non-overlapping inclusive [start, end]
+    ranges. Adjacent ranges are merged, so a job whose frames complete in
+    order only ever holds a single range.
+    """
+    def __init__(self, ranges=()):
+        self.starts = []
+        self.ends = []
+        for (start, end) in ranges:
+            self.add(start, end)
+
+    def __iter__(self):
+        return iter(zip(self.starts, self.ends))
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def add(self, start, end):
+        # every range overlapping or touching [start, end] is merged
+        i = bisect.bisect_left(self.ends, start - 1)
+        j = bisect.bisect_right(self.starts, end + 1)
+        if i < j:
+            start = min(start, self.starts[i])
+            end = max(end, self.ends[j - 1])
+        self.starts[i:j] = [start]
+        self.ends[i:j] = [end]
+
+    def remove(self, start, end):
+        i = bisect.bisect_left(self.ends, start)
+        j = bisect.bisect_right(self.starts, end)
+        if i >= j: return
+
+        pieces = []
+        if self.starts[i] < start: pieces.append((self.starts[i], start - 1))
+        if self.ends[j - 1] > end: pieces.append((end + 1, self.ends[j - 1]))
+        self.starts[i:j] = [ piece[0] for piece in pieces ]
+        self.ends[i:j] = [ piece[1] for piece in pieces ]
+
+    def contains(self, start, end):
+        """Whether every frame from start to end is in the set."""
+        i = bisect.bisect_right(self.starts, start) - 1
+        return i >= 0 and self.ends[i] >= end
+
+    def intersection(self, start, end):
+        """The ranges of frames in the set from start to end."""
+        i = bisect.bisect_left(self.ends, start)
+        j = bisect.bisect_right(self.starts, end)
+        return [
+            (max(self.starts[k], start), min(self.ends[k], end))
+            for k in xrange(i, j)
+        ]
+
+    def size(self):
+        return sum(end - start + 1 for (start, end) in self)
@@ -0,0 +1,24 @@
+#!python
+
+from legion.ranges import RangeSet
+
+class ResultCache(object):
+    """
+    Frames rendered so far for each result key, see Job.result_key. A
+    job submitted with the same key as an earlier one finds those frames
+    already rendered.
+    """
+    def __init__(self):
+        self.keys = {}
+
+    def add(self, key, start, end):
+        frames = self.keys.get(key)
+        if frames is None:
+            frames = self.keys[key] = RangeSet()
+        frames.add(start, end)
+
+    def rendered(self, key, start, end):
+        """Ranges of frames from start to end rendered under key."""
+        frames = self.keys.get(key)
+        if frames is None: return []
+        return frames.intersection(start, end)
@@ -0,0 +1,258 @@
+#!python
+
+import heapq
+import time
+
+from legion.tasks import Task
+
+class Scheduler(object):
+    """
+    Decides which job an idle client works on next. Jobs added to a
+    scheduler report every task status change to it through
+    task_status_changed.
+    """
+    # clients slower than this relative to an average node, or failing
+    # more often than MAX_FAILURE_RATE, are kept off the last tasks of a job
+    SLOW_SPEED = 0.5
+    MAX_FAILURE_RATE = 0.5
+
+    # jobs pass over clients that don't have them warm for up to
+    # locality_wait seconds while another client does, see wait_for_warm
+    locality_wait = 0
+
+    def __init__(self):
+        self.jobs = {}
+        # number of clients connected, for jobs that size tasks by it
+        self.farm_size = 1
+        # locality key -> number of clients it is warm on
+        self.warm = {}
+        # earliest time a job that passed over a client during the last
+        # assignment takes cold clients, None if none did
+        self.retry_at = None
+        # whether a job kept the client of the last assignment off its
+        # last tasks
+        self.avoided = False
+
+    def add_job(self, job):
+        self.jobs[job.id] = job
+        job.scheduler = self
+
+    def remove_job(self, job):
+        del self.jobs[job.id]
+        job.scheduler = None
+
+    def job_changed(self, job):
+        """Called when a job is paused, started or otherwise modified."""
+        pass
+
+    def task_status_changed(self, job, task, old, new):
+        pass
+
+    def runnable(self, job):
+        return job.status == 'pending' and job.has_queued_tasks()
+
+    def speculate(self, jobs, client):
+        """
+        Once no job has anything left to hand out, give client a backup
+        copy of a straggling task from the first of jobs that has one.
+        """
+        if self.is_slow(client): return (None, None)
+        for job in jobs:
+            if job.status != 'pending': continue
+            task = job.speculate(client)
+            if task: return (job, task)
+        return (None, None)
+
+    def is_slow(self, client):
+        if client.failure_rate > Scheduler.MAX_FAILURE_RATE: return True
+        return client.speed is not None and client.speed < Scheduler.SLOW_SPEED
+
+    def faster_idle(self, client):
+        """
+        Whether a client that isn't slow is idle besides client. Without
+        a view of the farm we assume there is, the master knows better.
+        """
+        return True
+
+    def avoid(self, job, client):
+        """
+        Whether client should be kept off job. Once a job has no more tasks
+        left than there are clients, whoever gets them decides when it
+        finishes, so slow or unreliable clients are passed over while a
+        faster client is idle to take them instead.
+        """
+        if not self.is_slow(client) or job.count('pending') > self.farm_size:
+            return False
+        if not self.faster_idle(client): return False
+        self.avoided = True
+        return True
+
+    def warm_changed(self, added=(), removed=()):
+        for key in added:
+            self.warm[key] = self.warm.get(key, 0) + 1
+        for key in removed:
+            self.warm[key] -= 1
+            if not self.warm[key]: del self.warm[key]
+
+    def wait_for_warm(self, job, client):
+        """
+        Whether job should pass over client, which doesn't have the job
+        warm, in the hope that a client that does frees up. Jobs wait at
+        most locality_wait seconds from first passing over a client, and
+        only while some client has them warm, before taking cold clients.
+        """
+        if not self.locality_wait: return False
+        key = job.locality_key()
+        if key in client.warm or key not in self.warm: return False
+
+        now = time.time()
+        if job.cold_since is None: job.cold_since = now
+        retry_at = job.cold_since + self.locality_wait
+        if retry_at <= now: return False
+        if self.retry_at is None or retry_at < self.retry_at:
+            self.retry_at = retry_at
+        return True
+
+    def assign_next_task(self, client):
+        """
+        Assign a task from the chosen job to client. Returns a (job, task)
+        pair, or (None, None) when no job has work to hand out.
+        """
+        raise NotImplementedError
+
+class FifoScheduler(Scheduler):
+    """
+    Works through jobs in the order they were submitted, only moving on
+    to a later job once every earlier one has no tasks left to hand out.
+    """
+    def __init__(self):
+        Scheduler.__init__(self)
+        self.job_ids = []
+
+    def add_job(self, job):
+        Scheduler.add_job(self, job)
+        self.job_ids.append(job.id)
+
+    def remove_job(self, job):
+        Scheduler.remove_job(self, job)
+        self.job_ids.remove(job.id)
+
+    def assign_next_task(self, client):
+        for job_id in self.job_ids:
+            job = self.jobs[job_id]
+            if not self.runnable(job) or self.avoid(job, client): continue
+            if self.wait_for_warm(job, client): continue
+            task = job.assign_next_task(client, self.farm_size)
+            if task: return (job, task)
+
+        jobs = [ self.jobs[job_id] for job_id in self.job_ids ]
+        return self.speculate(jobs, client)
+
+class FairShareScheduler(Scheduler):
+    """
+    Hands each idle client to the runnable job with the highest priority,
+    and among jobs of equal priority to the one running the fewest tasks
+    relative to its weight. A job with weight 2 ends up with twice the
+    clients of a job with weight 1.
+
+    Jobs live in a heap keyed on (-priority, running / weight, submission
+    order). Whenever a job's key changes it is marked dirty, and before
+    the next assignment a new entry is pushed for every dirty job, so a
+    burst of status changes costs a single push. Old entries are left
+    behind as stale, to be skipped when they reach the top. Jobs with
+    nothing to hand out drop out of the heap until one of their tasks is
+    queued again.
+    """
+    def __init__(self):
+        Scheduler.__init__(self)
+        self.heap = []
+        self.running = {}
+        self.versions = {}
+        self.order = {}
+        self.submitted = 0
+        self.dirty = set()
+
+    def key(self, job):
+        share = self.running[job.id] / float(job.weight)
+        return (-job.priority, share, self.order[job.id])
+
+    def push(self, job):
+        version = self.versions.get(job.id, 0) + 1
+        self.versions[job.id] = version
+        heapq.heappush(self.heap, (self.key(job), version, job.id))
+
+        if len(self.heap) > 2 * len(self.jobs) + 64:
+            self.compact()
+
+    def compact(self):
+        self.heap = [
+            entry for entry in self.heap
+            if self.versions.get(entry[2]) == entry[1]
+        ]
+        heapq.heapify(self.heap)
+
+    def add_job(self, job):
+        Scheduler.add_job(self, job)
+        self.running[job.id] = 0
+        self.order[job.id] = self.submitted
+        self.submitted += 1
+        self.push(job)
+
+    def remove_job(self, job):
+        Scheduler.remove_job(self, job)
+        del self.running[job.id]
+        del self.versions[job.id]
+        del self.order[job.id]
+        self.dirty.discard(job.id)
+
+    def push_dirty(self):
+        for job_id in self.dirty:
+            self.push(self.jobs[job_id])
+        self.dirty.clear()
+
+    def job_changed(self, job):
+        self.dirty.add(job.id)
+
+    def task_status_changed(self, job, task, old, new):
+        if new == 'rendering':
+            self.running[job.id] += 1
+        elif old == 'rendering':
+            self.running[job.id] -= 1
+        elif new not in Task.QUEUED:
+            return
+        self.dirty.add(job.id)
+
+    def assign_next_task(self, client):
+        if self.dirty: self.push_dirty()
+        passed = []
+        stragglers = []
+        try:
+            while self.heap:
+                entry = heapq.heappop(self.heap)
+                (key, version, job_id) = entry
+                if self.versions.get(job_id) != version: continue
+
+                job = self.jobs[job_id]
+                if not self.runnable(job):
+                    if job.status == 'pending' and job.can_speculate():
+                        stragglers.append(job)
+                        passed.append(entry)
+                    continue
+                if self.avoid(job, client) or self.wait_for_warm(job, client):
+                    passed.append(entry)
+                    continue
+
+                # assigning marks the job dirty, so it goes back in the
+                # heap with its new share before the next assignment
+                task = job.assign_next_task(client, self.farm_size)
+                if task: return (job, task)
+
+            return self.speculate(stragglers, client)
+        finally:
+            for entry in passed:
+                heapq.heappush(self.heap, entry)
+
+SCHEDULERS = {
+    'fifo': FifoScheduler,
+    'fairshare': FairShareScheduler,
+}
@@ -0,0 +1,233 @@
+#!python
+
+import array
+import bisect
+
+from legion.error import LegionError
+
+class Task(object):
+    KEYS = "startframe endframe status client".split()
+    QUEUED = ['pending', 'error']
+
+    def __init__(self, **kwargs):
+        self._status = None
+        self._job = None
+        self._row = None
+        self.client = None
+        self.start_time = None
+        for k in kwargs:
+            if k not in Task.KEYS: raise LegionError("Invalid key %s" % (k,))
+            setattr(self, k, kwargs[k])
+
+    def __eq__(self, other):
+        return self.to_hash() == other.to_hash()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def get_status(self):
+        return self._status
+
+    def set_status(self, status):
+        old = self._status
+        self._status = status
+        # let the owning job keep its queues and counters in step
+        if self._job: self._job.task_status_changed(self, old, status)
+
+    status = property(get_status, set_status)
+
+    def to_hash(self):
+        hash = {}
+        for k in Task.KEYS:
+            hash[k] = getattr(self, k)
+        return hash
+
+class TaskView(Task):
+    """
+    A Task backed by one row of a CompactTaskTable. Views are created on
+    demand and hold no state of their own.
+    """
+    __slots__ = ('_table', '_row')
+
+    def __init__(self, table, row):
+        self._table = table
+        self._row = row
+
+    @property
+    def _job(self):
+        return self._table.job
+
+    @property
+    def startframe(self):
+        return self._table.startframes[self._row]
+
+    @property
+    def endframe(self):
+        return self._table.endframes[self._row]
+
+    def get_status(self):
+        return self._table.status_names[self._table.statuses[self._row]]
+
+    def set_status(self, status):
+        old = self.status
+        self._table.statuses[self._row] = self._table.status_code(status)
+        self._table.job.task_status_changed(self, old, status)
+
+    status = property(get_status, set_status)
+
+    def get_client(self):
+        return self._table.clients.get(self._table.client_ids[self._row])
+
+    def set_client(self, client):
+        if client is None:
+            self._table.client_ids[self._row] = -1
+            return
+        self._table.clients[client.id] = client
+        self._table.client_ids[self._row] = client.id
+
+    client = property(get_client, set_client)
+
+    def get_start_time(self):
+        return self._table.start_times[self._row] or None
+
+    def set_start_time(self, start_time):
+        self._table.start_times[self._row] = start_time or 0.0
+
+    start_time = property(get_start_time, set_start_time)
+
+class TaskTable(object):
+    """
+    Stores the tasks of a job as a list of Task objects. Rows are numbered
+    in the order tasks were added.
+    """
+    def __init__(self, job):
+        self.job = job
+        self._tasks = []
+        self._rows = {}
+
+    def __len__(self):
+        return len(self._tasks)
+
+    def __iter__(self):
+        return iter(self._tasks)
+
+    def __getitem__(self, row):
+        return self._tasks[row]
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def append(self, startframe, endframe, status='pending'):
+        task = Task(startframe=startframe, endframe=endframe, status=status)
+        task._row = len(self._tasks)
+        task._job = self.job
+        self._tasks.append(task)
+        self._rows[startframe] = task._row
+        return task
+
+    def extend_range(self, startframe, endframe, tasksize):
+        for frame in xrange(startframe, endframe + 1, tasksize):
+            self.append(frame, min(frame + tasksize - 1, endframe))
+
+    def find(self, startframe):
+        row = self._rows.get(startframe)
+        if row is None: return None
+        return self._tasks[row]
+
+class CompactTaskTable(object):
+    """
+    Stores the tasks of a job in parallel arrays, one entry per task, and
+    hands out TaskView objects on access. This costs a few dozen bytes per
+    task instead of a full object with its own __dict__.
+    """
+    STATUSES = ['pending', 'rendering', 'complete', 'error']
+
+    def __init__(self, job):
+        self.job = job
+        self.startframes = array.array('l')
+        self.endframes = array.array('l')
+        self.statuses = array.array('b')
+        self.client_ids = array.array('l')
+        self.start_times = array.array('d')
+        self.status_names = list(CompactTaskTable.STATUSES)
+        self.clients = {}
+        # startframes are looked up by bisection while rows are appended
+        # in frame order, and through a dict once they are not
+        self._rows = None
+
+    def __len__(self):
+        return len(self.startframes)
+
+    def __iter__(self):
+        for row in xrange(len(self)):
+            yield TaskView(self, row)
+
+    def __getitem__(self, row):
+        if row < 0: row += len(self)
+        if not 0 <= row < len(self): raise IndexError(row)
+        return TaskView(self, row)
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def status_code(self, status):
+        try:
+            return self.status_names.index(status)
+        except ValueError:
+            self.status_names.append(status)
+            return len(self.status_names) - 1
+
+    def append(self, startframe, endframe, status='pending'):
+        row = len(self)
+        if self._rows is not None:
+            self._rows[startframe] = row
+        elif row and startframe < self.startframes[-1]:
+            self._rows = dict((s, r) for (r, s) in enumerate(self.startframes))
+            self._rows[startframe] = row
+
+        self.startframes.append(startframe)
+        self.endframes.append(endframe)
+        self.statuses.append(self.status_code(status))
+        self.client_ids.append(-1)
+        self.start_times.append(0.0)
+        return TaskView(self, row)
+
+    def extend_range(self, startframe, endframe, tasksize):
+        if startframe > endframe: return
+        if len(self) and startframe < self.startframes[-1]:
+            for frame in xrange(startframe, endframe + 1, tasksize):
+                self.append(frame, min(frame + tasksize - 1, endframe))
+            return
+
+        starts = array.array('l', xrange(startframe, endframe + 1, tasksize))
+        ends = array.array('l',
+            xrange(startframe + tasksize - 1, endframe + tasksize, tasksize))
+        ends[-1] = endframe
+        count = len(starts)
+
+        if self._rows is not None:
+            for (i, frame) in enumerate(starts):
+                self._rows[frame] = len(self) + i
+        self.startframes.extend(starts)
+        self.endframes.extend(ends)
+        self.statuses.extend(
+            array.array('b', [self.status_code('pending')]) * count)
+        self.client_ids.extend(array.array('l', [-1]) * count)
+        self.start_times.extend(array.array('d', [0.0]) * count)
+
+    def find(self, startframe):
+        if self._rows is not None:
+            row = self._rows.get(startframe)
+        else:
+            row = bisect.bisect_left(self.startframes, startframe)
+            if row == len(self) or self.startframes[row] != startframe:
+                row = None
+
+        if row is None: return None
+        return TaskView(self, row)
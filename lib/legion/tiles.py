@@ -0,0 +1,190 @@
+#!python
+
+import Queue
+import os
+import struct
+import threading
+
+from legion.error import LegionError
+from legion.log import log
+
+# Tile jobs split every frame into a grid of tiles = [columns, rows] and
+# render each tile as a task of its own. Tasks are numbered from 0 across
+# the whole job, tile by tile and frame by frame, so a tile job's task ids
+# run from 0 to frames * columns * rows - 1.
+
+def per_frame(tiles):
+    return tiles[0] * tiles[1]
+
+def split_unit(unit, startframe, tiles):
+    """(frame, tile) rendered by the task with id unit."""
+    (index, tile) = divmod(unit, per_frame(tiles))
+    return (startframe + index, tile)
+
+def tile_rect(tile, tiles, resolution):
+    """
+    Pixels covered by tile as (x0, y0, x1, y1), ends exclusive, counting
+    tiles and rows from the top left corner.
+    """
+    (columns, rows) = tiles
+    (width, height) = resolution
+    (row, column) = divmod(tile, columns)
+    return (column * width // columns, row * height // rows,
+            (column + 1) * width // columns, (row + 1) * height // rows)
+
+def border_expr(rect, resolution):
+    """Python for blender's --python-expr that renders only rect."""
+    (x0, y0, x1, y1) = rect
+    (width, height) = resolution
+    # blender measures the border as fractions from the bottom left
+    return ('import bpy; r = bpy.context.scene.render; '
+        'r.resolution_x = %d; r.resolution_y = %d; '
+        'r.resolution_percentage = 100; '
+        'r.use_border = True; r.use_crop_to_border = True; '
+        'r.border_min_x = %r; r.border_max_x = %r; '
+        'r.border_min_y = %r; r.border_max_y = %r' % (
+            width, height,
+            x0 / float(width), x1 / float(width),
+            1 - y1 / float(height), 1 - y0 / float(height)))
+
+def tile_pattern(jobname, tile):
+    """Blender's -o for a tile, blender fills in the frame."""
+    return '%s_####_%03d' % (jobname, tile)
+
+def tile_name(jobname, frame, tile):
+    return '%s_%04d_%03d.tga' % (jobname, frame, tile)
+
+def frame_name(jobname, frame):
+    return '%s_%04d.tga' % (jobname, frame)
+
+# Tiles are rendered as uncompressed TGA, so rows can be copied straight
+# from a tile into their place in the frame.
+TGA_HEADER = struct.Struct('<BBBHHBHHHHBB')
+TGA_TRUE_COLOR = 2
+TGA_TOP_ORIGIN = 0x20
+
+def read_tga_header(fh):
+    """(width, height, bytes per pixel, top origin, pixel data offset)"""
+    data = fh.read(TGA_HEADER.size)
+    if len(data) < TGA_HEADER.size:
+        raise LegionError('Truncated TGA header')
+    (id_length, colormap_type, image_type, colormap_start, colormap_length,
+     colormap_depth, x, y, width, height, depth, descriptor) = \
+        TGA_HEADER.unpack(data)
+    if image_type != TGA_TRUE_COLOR or colormap_type or depth not in (24, 32):
+        raise LegionError('Not an uncompressed true color TGA')
+    return (width, height, depth // 8, bool(descriptor & TGA_TOP_ORIGIN),
+        TGA_HEADER.size + id_length)
+
+def write_tga_header(fh, width, height, pixel_bytes):
+    alpha = 8 if pixel_bytes == 4 else 0
+    fh.write(TGA_HEADER.pack(0, 0, TGA_TRUE_COLOR, 0, 0, 0, 0, 0,
+        width, height, pixel_bytes * 8, TGA_TOP_ORIGIN | alpha))
+
+class TileAssembler(object):
+    """
+    Assembles the tiles of tile jobs into frames as they are rendered.
+    Each tile is copied a row at a time into its place in the frame's
+    file, so no more than a row is held in memory, and a frame is moved
+    into place once all of its tiles are in. Tiles are placed from a
+    background thread in the order they complete, unless threaded is
+    False.
+    """
+    def __init__(self, root, threaded=True):
+        self.root = root
+        # (job id, frame) -> tiles placed so far
+        self.placed = {}
+        self.queue = None
+        if threaded:
+            self.queue = Queue.Queue()
+            self.thread = threading.Thread(target=self.run)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def add(self, job, unit):
+        """Place the tile rendered by the task with id unit of job."""
+        (frame, tile) = split_unit(unit, job.startframe, job.tiles)
+        if self.queue is None:
+            self.place(job, frame, tile)
+        else:
+            self.queue.put((job, frame, tile))
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None: return
+            self.place(*item)
+
+    def stop(self):
+        if self.queue is None: return
+        self.queue.put(None)
+        self.thread.join()
+
+    def tile_path(self, job, frame, tile):
+        return os.path.join(self.root, job.jobdir, 'tiles',
+            tile_name(job.jobname, frame, tile))
+
+    def frame_path(self, job, frame):
+        return os.path.join(self.root, job.jobdir, 'frames',
+            frame_name(job.jobname, frame))
+
+    def place(self, job, frame, tile):
+        try:
+            self.copy_tile(job, frame, tile)
+        except (IOError, OSError, LegionError), e:
+            log.error("Job %d frame %d: can't place tile %d: %s", job.id,
+                frame, tile, e)
+            return
+
+        placed = self.placed.setdefault((job.id, frame), set())
+        placed.add(tile)
+        if len(placed) < per_frame(job.tiles): return
+
+        del self.placed[(job.id, frame)]
+        path = self.frame_path(job, frame)
+        os.rename(path + '.part', path)
+        for placed_tile in range(per_frame(job.tiles)):
+            tile_path = self.tile_path(job, frame, placed_tile)
+            if os.path.exists(tile_path): os.unlink(tile_path)
+        log.info("Job %d: frame %d assembled", job.id, frame)
+
+    def copy_tile(self, job, frame, tile):
+        (x0, y0, x1, y1) = tile_rect(tile, job.tiles, job.resolution)
+        (width, height) = job.resolution
+
+        src = open(self.tile_path(job, frame, tile), 'rb')
+        try:
+            (w, h, pixel_bytes, top, offset) = read_tga_header(src)
+            dst = self.open_frame(job, frame, pixel_bytes)
+            try:
+                # tiles rendered a pixel larger or smaller than their share
+                # of the frame are cropped to it
+                row_bytes = min(w, x1 - x0) * pixel_bytes
+                for row in range(min(h, y1 - y0)):
+                    src.seek(offset +
+                        (row if top else h - 1 - row) * w * pixel_bytes)
+                    dst.seek(TGA_HEADER.size +
+                        ((y0 + row) * width + x0) * pixel_bytes)
+                    dst.write(src.read(row_bytes))
+            finally:
+                dst.close()
+        finally:
+            src.close()
+
+    def open_frame(self, job, frame, pixel_bytes):
+        """The frame's partly assembled file, created by its first tile."""
+        (width, height) = job.resolution
+        path = self.frame_path(job, frame) + '.part'
+        if os.path.exists(path):
+            fh = open(path, 'r+b')
+            if read_tga_header(fh)[2] != pixel_bytes:
+                fh.close()
+                raise LegionError('Tiles with different pixel formats')
+            return fh
+
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        fh = open(path, 'w+b')
+        write_tga_header(fh, width, height, pixel_bytes)
+        fh.truncate(TGA_HEADER.size + width * height * pixel_bytes)
+        return fh
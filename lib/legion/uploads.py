@@ -0,0 +1,175 @@
+#!python
+
+import base64
+import hashlib
+import os
+import time
+import urllib
+
+from legion.assets import CHUNK_SIZE
+from legion.error import LegionError
+from legion.log import log
+
+# Rendered frames are streamed from workers to the master a chunk per line,
+# base64 encoded like assets:
+#
+#   upload <upload id> <job id> <size> <path>
+#   upload_chunk <upload id> <chunk> <base64 data>
+#   upload_end <upload id> <sha1>
+#
+# path is relative to the job directory and URL quoted, so names with
+# spaces stay a single argument. The master writes each chunk to
+# disk as it arrives and acks it with "ACK /uploads/:id/:chunk", and
+# answers upload_end with "POST /uploads/:id/done" once the file is
+# verified and in place. Errors start with "Upload <upload id>".
+
+class Upload(object):
+    """
+    Worker side: a result file being sent. At most window chunks are sent
+    ahead of the ones the master has acked, so a master that is slow to
+    write them slows the upload down instead of piling up lines.
+    """
+    def __init__(self, id, job_id, frame, path, name):
+        self.id = id
+        self.job_id = job_id
+        self.frame = frame
+        self.path = path
+        self.name = name
+        self.size = os.path.getsize(path)
+        self.chunks = -(-self.size // CHUNK_SIZE)
+        self.sent = 0
+        self.acked = 0
+        self.ended = False
+        self.sha1 = hashlib.sha1()
+        self.fh = None
+
+    def begin_line(self):
+        return 'upload %d %d %d %s' % (self.id, self.job_id, self.size,
+            urllib.quote(self.name))
+
+    def next_lines(self, window):
+        """Lines for the chunks the window allows now, then upload_end."""
+        if self.fh is None: self.fh = open(self.path, 'rb')
+        lines = []
+        while self.sent < self.chunks and self.sent - self.acked < window:
+            data = self.fh.read(CHUNK_SIZE)
+            self.sha1.update(data)
+            lines.append('upload_chunk %d %d %s'
+                % (self.id, self.sent, base64.b64encode(data)))
+            self.sent += 1
+        if self.sent == self.chunks and not self.ended:
+            self.ended = True
+            lines.append('upload_end %d %s' % (self.id, self.sha1.hexdigest()))
+        return lines
+
+    def close(self, remove=True):
+        if self.fh: self.fh.close()
+        if remove and os.path.exists(self.path): os.unlink(self.path)
+
+class IncomingUpload(object):
+    """
+    Master side: a result file being received, written as it arrives.
+    Both copies of a speculated or timed out task may upload the same file
+    at once, so each upload writes its own part file and only the first
+    one to finish is moved into place.
+    """
+    def __init__(self, client_id, id, path, size):
+        self.id = id
+        self.path = path
+        self.part = '%s.%d.%d.part' % (path, client_id, id)
+        self.size = size
+        self.received = 0
+        self.chunks_received = 0
+        self.started = time.time()
+        self.sha1 = hashlib.sha1()
+        # another upload of the same file finished first
+        self.superseded = False
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        self.fh = open(self.part, 'wb')
+
+    def write(self, index, data):
+        if index != self.chunks_received:
+            raise LegionError('Upload %d: expected chunk %d, got %d'
+                % (self.id, self.chunks_received, index))
+        if self.received + len(data) > self.size:
+            raise LegionError('Upload %d: more than %d bytes'
+                % (self.id, self.size))
+        self.fh.write(data)
+        self.sha1.update(data)
+        self.received += len(data)
+        self.chunks_received += 1
+
+    def finish(self, hash):
+        self.fh.close()
+        if self.sha1.hexdigest() != hash or self.received != self.size:
+            os.unlink(self.part)
+            raise LegionError('Upload %d failed verification' % (self.id,))
+        if self.superseded:
+            os.unlink(self.part)
+        else:
+            os.rename(self.part, self.path)
+
+    def abort(self):
+        self.fh.close()
+        os.unlink(self.part)
+
+class UploadStore(object):
+    """
+    Master side of result uploads: files being received from each client,
+    written under the job's directory in root.
+    """
+    def __init__(self, root):
+        self.root = root
+        # (client id, upload id) -> IncomingUpload
+        self.uploads = {}
+
+    def begin(self, client_id, id, job, size, name):
+        name = os.path.normpath(name)
+        if os.path.isabs(name) or name.split(os.sep)[0] == os.pardir:
+            raise LegionError('Upload %d: invalid path "%s"' % (id, name))
+        self.abort(client_id, id)
+        path = os.path.join(self.root, job.jobdir, name)
+        try:
+            upload = IncomingUpload(client_id, id, path, size)
+        except (IOError, OSError), e:
+            raise LegionError('Upload %d: %s' % (id, e))
+        self.uploads[(client_id, id)] = upload
+        return upload
+
+    def get(self, client_id, id):
+        upload = self.uploads.get((client_id, id))
+        if upload is None: raise LegionError('Upload %d: unknown' % (id,))
+        return upload
+
+    def write(self, client_id, id, index, data):
+        upload = self.get(client_id, id)
+        try:
+            upload.write(index, data)
+        except (IOError, OSError, LegionError), e:
+            self.abort(client_id, id)
+            if isinstance(e, LegionError): raise
+            raise LegionError('Upload %d: %s' % (id, e))
+        return upload
+
+    def finish(self, client_id, id, hash):
+        upload = self.get(client_id, id)
+        del self.uploads[(client_id, id)]
+        try:
+            upload.finish(hash)
+        except (IOError, OSError), e:
+            raise LegionError('Upload %d: %s' % (id, e))
+        for other in self.uploads.itervalues():
+            if other.path == upload.path: other.superseded = True
+        return upload
+
+    def abort(self, client_id, id):
+        upload = self.uploads.pop((client_id, id), None)
+        if upload is None: return
+        log.info("Client %d: dropping upload of %s", client_id, upload.path)
+        upload.abort()
+
+    def drop_client(self, client_id):
+        """Abort everything a disconnected client was uploading."""
+        for (owner, id) in self.uploads.keys():
+            if owner == client_id: self.abort(owner, id)
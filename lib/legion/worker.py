@@ -0,0 +1,508 @@
+#!python
+
+import base64
+import collections
+import os
+import re
+import simplejson
+import time
+
+from twisted.internet import error, protocol
+
+from legion.error import LegionError
+from legion.log import log
+from legion import tiles
+from legion.uploads import Upload
+
+def blender_command(blender, root, output=None):
+    """
+    Returns a function building the command line that renders frames
+    startframe to endframe of a job with the blender binary, for job
+    directories kept under root. scene is the local copy of the job's
+    scene when its assets are cached, otherwise it is read from root.
+    Output goes to the job's directory under output, root unless results
+    are uploaded to the master. Tasks of tile jobs render their tile as
+    an uncompressed TGA for the master to assemble.
+    """
+    if output is None: output = root
+
+    def command(job, startframe, endframe, scene=None):
+        if scene is None:
+            scene = os.path.join(root, job['jobdir'], job['filename'])
+        jobdir = os.path.join(output, job['jobdir'])
+        if job.get('type') == 'tile':
+            (frame, tile) = tiles.split_unit(startframe, job['startframe'],
+                job['tiles'])
+            rect = tiles.tile_rect(tile, job['tiles'], job['resolution'])
+            return [
+                blender, '-b', scene,
+                '--python-expr', tiles.border_expr(rect, job['resolution']),
+                '-o', os.path.join(jobdir, 'tiles',
+                    tiles.tile_pattern(job['jobname'], tile)),
+                '-F', 'RAWTGA', '-x', '1', '-f', str(frame),
+            ]
+        return [
+            blender, '-b', scene,
+            '-o', os.path.join(jobdir, 'frames', job['jobname'] + '_####'),
+            '-s', str(startframe), '-e', str(endframe), '-a',
+        ]
+    return command
+
+def saved_path(line):
+    """The file named by one of blender's "Saved:" lines."""
+    path = line[len('Saved:'):].strip()
+    # newer blenders quote the path, older ones follow it with the time
+    if path[:1] in ('"', "'"): return path[1:path.find(path[0], 1)]
+    return path.split(' Time: ')[0]
+
+class RenderProcess(protocol.ProcessProtocol):
+    """A render running as a subprocess, reporting back to its worker."""
+    def __init__(self, worker, job_id, frame):
+        self.worker = worker
+        self.job_id = job_id
+        self.frame = frame
+        self.started = time.time()
+        self.buffer = ''
+        self.frames_done = 0
+        # files the render saved
+        self.saved = []
+        # why the render is being stopped, 'cancel' or 'timeout'
+        self.killed = None
+        self.timeout_call = None
+        self.kill_call = None
+
+    def outReceived(self, data):
+        lines = (self.buffer + data).split('\n')
+        self.buffer = lines.pop()
+        for line in lines:
+            # blender prints "Saved: <path>" as each frame is written
+            if line.startswith('Saved:'):
+                self.frames_done += 1
+                self.saved.append(saved_path(line))
+                self.worker.progress(self)
+
+    def errReceived(self, data):
+        log.debug("Job %d frame %d: %s", self.job_id, self.frame, data.strip())
+
+    def processEnded(self, reason):
+        self.worker.render_ended(self, reason.value.exitCode)
+
+    def kill(self, why):
+        if self.killed: return
+        self.killed = why
+        try:
+            self.transport.signalProcess('TERM')
+        except error.ProcessExitedAlready:
+            return
+        self.kill_call = self.worker.reactor.callLater(
+            self.worker.kill_grace, self.force_kill)
+
+    def force_kill(self):
+        self.kill_call = None
+        try:
+            self.transport.signalProcess('KILL')
+        except error.ProcessExitedAlready:
+            pass
+
+class Worker(object):
+    """
+    Client side of the protocol: renders the tasks the master sends as
+    subprocesses, up to slots at a time, and queues the rest. Progress is
+    reported as frames are saved, results are batched into one report
+    per reactor iteration. Renders are killed when the master cancels
+    them or when they run past their job's timeout.
+
+    With an asset cache, the files in a job's manifest are fetched from
+    the master by hash before its first task starts, and tasks of jobs
+    whose assets are all cached start without any transfer.
+
+    With a results directory, renders write there and the files they save
+    are uploaded to the master one at a time while the next render runs.
+    A task is only reported complete once its files are on the master.
+    """
+    render_re = re.compile(r'/jobs/([^/]+)/tasks/([^/]+)/render')
+    job_re = re.compile(r'/jobs/([^/]+)$')
+    cancel_re = re.compile(r'/jobs/([^/]+)/tasks/([^/]+)/cancel')
+    asset_re = re.compile(r'/assets/([0-9a-f]+)/(\d+)$')
+    asset_error_re = re.compile(r'Error: Unknown asset ([0-9a-f]+)')
+    upload_ack_re = re.compile(r'/uploads/(\d+)/(\d+)$')
+    upload_done_re = re.compile(r'/uploads/(\d+)/done$')
+    upload_error_re = re.compile(r'Error: Upload (\d+)')
+
+    # seconds between asking a render to stop and killing it
+    kill_grace = 10
+    # asset chunks asked for ahead of the ones received
+    fetch_window = 8
+    # seconds a download may go without a chunk arriving before its tasks
+    # are failed, so they don't hold their slots for good
+    download_timeout = 60
+    # hashes per cached line
+    cached_per_line = 200
+    # upload chunks sent ahead of the ones the master has acked
+    upload_window = 8
+
+    def __init__(self, send_line, command, slots=1, reactor=None, cache=None,
+                 results=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        self.send_line = send_line
+        self.command = command
+        self.slots = slots
+        self.jobs = {}
+        self.queue = collections.deque()
+        self.running = {}
+        self.cache = cache
+        # (job id, frame) -> (endframe, hashes of assets still missing)
+        # of tasks waiting for their assets, they hold a slot
+        self.starting = {}
+        self.downloads = {}
+        self.results = results
+        # files waiting to be uploaded, the first one is being sent
+        self.uploads = collections.deque()
+        # (job id, frame) -> [seconds rendering, files left to upload]
+        self.uploading = {}
+        self.upload_id = 0
+        self.reports = []
+        self.flush_call = None
+
+    def handle_line(self, line):
+        if line.startswith('#') or line == 'pong': return
+        m = self.asset_error_re.match(line)
+        if m:
+            self.asset_failed(m.group(1), line)
+            return
+        m = self.upload_error_re.match(line)
+        if m:
+            self.upload_failed(int(m.group(1)), line)
+            return
+        (method, path, content) = (line.split(None, 2) + ['', ''])[:3]
+
+        m = self.upload_ack_re.match(path)
+        if method == 'ACK' and m:
+            self.upload_acked(int(m.group(1)), int(m.group(2)))
+            return
+
+        m = self.upload_done_re.match(path)
+        if method == 'POST' and m:
+            self.upload_finished(int(m.group(1)))
+            return
+
+        m = self.asset_re.match(path)
+        if method == 'PUT' and m:
+            self.chunk_received(m.group(1), content)
+            return
+
+        # job definitions are sent once and only referred to by id after
+        m = self.job_re.match(path)
+        if method == 'PUT' and m:
+            self.jobs[int(m.group(1))] = simplejson.loads(content)
+            return
+
+        m = self.cancel_re.match(path)
+        if m:
+            # another client finished this task first
+            self.cancel(int(m.group(1)), int(m.group(2)))
+            return
+
+        m = self.render_re.match(path)
+        if m:
+            endframe = int(content.split()[1])
+            self.queue.append((int(m.group(1)), int(m.group(2)), endframe))
+            self.render_next()
+
+    def render_next(self):
+        while self.queue and \
+              len(self.running) + len(self.starting) < self.slots:
+            (job_id, frame, endframe) = self.queue.popleft()
+            manifest = self.manifest(job_id)
+            if not manifest:
+                self.start(job_id, frame, endframe)
+                continue
+
+            # assets are pinned in the cache until the render ends
+            missing = set()
+            for (hash, size) in manifest.itervalues():
+                self.cache.pin(hash)
+                if not self.cache.has(hash):
+                    missing.add(hash)
+                    self.fetch(hash, size)
+            self.starting[(job_id, frame)] = (endframe, missing)
+            if not missing: self.assets_ready(job_id, frame)
+
+    def manifest(self, job_id):
+        """The job's manifest if its assets go through the cache."""
+        if self.cache is None: return None
+        return self.jobs[job_id].get('manifest')
+
+    def unpin(self, job_id):
+        for (hash, size) in self.manifest(job_id).itervalues():
+            self.cache.unpin(hash)
+
+    def assets_ready(self, job_id, frame):
+        (endframe, missing) = self.starting.pop((job_id, frame))
+        self.start(job_id, frame, endframe)
+
+    def start(self, job_id, frame, endframe):
+        job = self.jobs[job_id]
+        scene = None
+        manifest = self.manifest(job_id)
+        if manifest:
+            for (hash, size) in manifest.itervalues():
+                self.cache.touch(hash)
+            scene = os.path.join(self.cache.job_dir(job_id, manifest),
+                job['filename'])
+        argv = self.command(job, frame, endframe, scene)
+        log.info("Job %d: rendering frames %d-%d", job_id, frame, endframe)
+
+        process = RenderProcess(self, job_id, frame)
+        self.running[(job_id, frame)] = process
+        self.reactor.spawnProcess(process, argv[0], argv, env=os.environ)
+        process.timeout_call = self.reactor.callLater(
+            job['timeout'], process.kill, 'timeout')
+
+    def cancel(self, job_id, frame):
+        for queued in list(self.queue):
+            if queued[:2] == (job_id, frame): self.queue.remove(queued)
+
+        if (job_id, frame) in self.starting:
+            del self.starting[(job_id, frame)]
+            self.unpin(job_id)
+            self.render_next()
+
+        if (job_id, frame) in self.uploading:
+            self.drop_uploads(job_id, frame, abort=True)
+
+        process = self.running.get((job_id, frame))
+        if process:
+            log.info("Job %d: cancelling frame %d", job_id, frame)
+            process.kill('cancel')
+
+    def stop(self):
+        """Drop queued tasks and stop every render, eg. when disconnected."""
+        self.queue.clear()
+        for (job_id, frame) in self.starting.keys():
+            del self.starting[(job_id, frame)]
+            self.unpin(job_id)
+        # nothing more will arrive for these
+        for download in self.downloads.values():
+            self.unwatch(download)
+            download.abort()
+        self.downloads.clear()
+        for upload in self.uploads:
+            upload.close()
+        self.uploads.clear()
+        self.uploading.clear()
+        for process in self.running.values():
+            process.kill('cancel')
+
+    def progress(self, process):
+        self.send_line('progress %d %d %d'
+            % (process.job_id, process.frame, process.frames_done))
+
+    def render_ended(self, process, exit_code):
+        for call in (process.timeout_call, process.kill_call):
+            if call and call.active(): call.cancel()
+        del self.running[(process.job_id, process.frame)]
+        if self.manifest(process.job_id):
+            self.unpin(process.job_id)
+            self.report_cache()
+
+        # the master has already handed cancelled tasks to someone else
+        if process.killed != 'cancel':
+            if process.killed:
+                log.warn("Job %d frame %d timed out", process.job_id,
+                    process.frame)
+            status = 'complete' \
+                if exit_code == 0 and not process.killed else 'error'
+            elapsed = time.time() - process.started
+            if status == 'complete' and self.results and process.saved:
+                self.upload_results(process, elapsed)
+            else:
+                self.report(process.job_id, process.frame, status, elapsed)
+
+        self.render_next()
+
+    def fetch(self, hash, size):
+        if hash in self.downloads: return
+        log.info("Fetching asset %s, %d bytes", hash, size)
+        download = self.downloads[hash] = self.cache.download(hash, size)
+        if download.done():
+            self.download_finished(download)
+        else:
+            self.request_chunks(download)
+            self.watch(download)
+
+    def watch(self, download):
+        """(Re)start the clock on a download, each chunk winds it back."""
+        call = download.timeout_call
+        if call and call.active():
+            call.reset(self.download_timeout)
+        else:
+            download.timeout_call = self.reactor.callLater(
+                self.download_timeout, self.asset_failed, download.hash,
+                'nothing received for %d seconds' % (self.download_timeout,))
+
+    def unwatch(self, download):
+        call = download.timeout_call
+        if call and call.active(): call.cancel()
+        download.timeout_call = None
+
+    def request_chunks(self, download):
+        while download.requested < download.chunks and \
+              download.requested - download.chunks_received < self.fetch_window:
+            self.send_line('get_asset %s %d' % (download.hash, download.requested))
+            download.requested += 1
+
+    def chunk_received(self, hash, content):
+        download = self.downloads.get(hash)
+        if download is None: return # given up on
+        download.write(base64.b64decode(content))
+        if download.done():
+            self.download_finished(download)
+        else:
+            self.request_chunks(download)
+            self.watch(download)
+
+    def download_finished(self, download):
+        del self.downloads[download.hash]
+        self.unwatch(download)
+        try:
+            download.finish()
+        except LegionError, e:
+            self.asset_failed(download.hash, str(e))
+            return
+
+        self.report_cache()
+        for (key, (endframe, missing)) in self.starting.items():
+            missing.discard(download.hash)
+            if not missing: self.assets_ready(*key)
+
+    def asset_failed(self, hash, message):
+        """Fail every task waiting for an asset we can't get."""
+        log.warn("Asset %s: %s", hash, message)
+        download = self.downloads.pop(hash, None)
+        if download:
+            self.unwatch(download)
+            download.abort()
+
+        for ((job_id, frame), (endframe, missing)) in self.starting.items():
+            if hash not in missing: continue
+            del self.starting[(job_id, frame)]
+            self.unpin(job_id)
+            self.report(job_id, frame, 'error', 0.0)
+        self.report_cache()
+        self.render_next()
+
+    def upload_results(self, process, elapsed):
+        """Queue the files a render saved for upload to the master."""
+        jobdir = os.path.join(self.results, self.jobs[process.job_id]['jobdir'])
+        uploads = []
+        try:
+            for path in process.saved:
+                name = os.path.relpath(path, jobdir)
+                if name.split(os.sep)[0] == os.pardir:
+                    log.warn("Job %d frame %d: not uploading %s, it isn't "
+                        "under %s", process.job_id, process.frame, path, jobdir)
+                    continue
+                self.upload_id += 1
+                uploads.append(Upload(self.upload_id, process.job_id,
+                    process.frame, path, name))
+        except OSError, e:
+            log.warn("Job %d frame %d: %s", process.job_id, process.frame, e)
+            self.report(process.job_id, process.frame, 'error', elapsed)
+            return
+        if not uploads:
+            self.report(process.job_id, process.frame, 'complete', elapsed)
+            return
+
+        self.uploading[(process.job_id, process.frame)] = \
+            [elapsed, len(uploads)]
+        idle = not self.uploads
+        self.uploads.extend(uploads)
+        if idle: self.send_upload()
+
+    def send_upload(self):
+        """Start sending the next queued file."""
+        if not self.uploads: return
+        upload = self.uploads[0]
+        self.send_line(upload.begin_line())
+        self.send_chunks(upload)
+
+    def send_chunks(self, upload):
+        for line in upload.next_lines(self.upload_window):
+            self.send_line(line)
+
+    def current_upload(self, id):
+        if self.uploads and self.uploads[0].id == id: return self.uploads[0]
+        return None # given up on
+
+    def upload_acked(self, id, chunk):
+        upload = self.current_upload(id)
+        if upload is None: return
+        upload.acked = max(upload.acked, chunk + 1)
+        self.send_chunks(upload)
+
+    def upload_finished(self, id):
+        upload = self.current_upload(id)
+        if upload is None: return
+        self.uploads.popleft()
+        upload.close()
+
+        key = (upload.job_id, upload.frame)
+        self.uploading[key][1] -= 1
+        if not self.uploading[key][1]:
+            elapsed = self.uploading.pop(key)[0]
+            self.report(upload.job_id, upload.frame, 'complete', elapsed)
+        self.send_upload()
+
+    def upload_failed(self, id, message):
+        """Fail the task whose file the master couldn't take."""
+        upload = self.current_upload(id)
+        if upload is None: return
+        log.warn("Job %d frame %d: %s", upload.job_id, upload.frame, message)
+        elapsed = self.drop_uploads(upload.job_id, upload.frame)
+        self.report(upload.job_id, upload.frame, 'error', elapsed)
+
+    def drop_uploads(self, job_id, frame, abort=False):
+        """
+        Give up on the uploads of a task and return how long it rendered.
+        With abort the master is told to drop the part it has received.
+        """
+        active = self.uploads[0] if self.uploads else None
+        for upload in list(self.uploads):
+            if (upload.job_id, upload.frame) == (job_id, frame):
+                self.uploads.remove(upload)
+                upload.close()
+        if active and (active.job_id, active.frame) == (job_id, frame):
+            if abort: self.send_line('upload_abort %d' % (active.id,))
+            self.send_upload()
+        return self.uploading.pop((job_id, frame))[0]
+
+    def report_cached_assets(self):
+        """Tell the master every asset we have cached, once connected."""
+        if self.cache is None: return
+        self.cache.take_changes()
+        hashes = list(self.cache.entries)
+        for i in range(0, len(hashes), self.cached_per_line):
+            self.send_line('cached %s'
+                % (' '.join(hashes[i:i + self.cached_per_line]),))
+
+    def report_cache(self):
+        """Tell the master about assets cached or evicted since last time."""
+        (added, removed) = self.cache.take_changes()
+        if added: self.send_line('cached %s' % (' '.join(added),))
+        if removed: self.send_line('evicted %s' % (' '.join(removed),))
+
+    def report(self, job_id, frame, status, elapsed):
+        self.reports.append('%d %d %s %.3f' % (job_id, frame, status, elapsed))
+        if not self.flush_call:
+            self.flush_call = self.reactor.callLater(0, self.flush_reports)
+
+    def flush_reports(self):
+        self.flush_call = None
+        if len(self.reports) == 1:
+            self.send_line('set_task_status %s' % (self.reports[0],))
+        elif self.reports:
+            self.send_line('set_task_statuses %s' % (' '.join(self.reports),))
+        self.reports = []
@@ -0,0 +1,41 @@
+#!/usr/bin/python
+
+# Stands in for blender in the worker tests. Prints blender style output
+# for frames -s to -e, sleeping --sleep seconds per frame, then exits with
+# --exit. With --ignore-term it has to be killed. With --output each frame
+# is written there as a file of --size bytes.
+
+import optparse
+import os
+import signal
+import sys
+import time
+
+parser = optparse.OptionParser()
+parser.add_option('-s', type='int', dest='start')
+parser.add_option('-e', type='int', dest='end')
+parser.add_option('--sleep', type='float', default=0.0)
+parser.add_option('--exit', type='int', default=0)
+parser.add_option('--ignore-term', action='store_true', default=False)
+parser.add_option('--output')
+parser.add_option('--size', type='int', default=1000)
+(options, args) = parser.parse_args()
+
+if options.ignore_term:
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+for frame in range(options.start, options.end + 1):
+    print "Fra:%d Mem:1.00M | Rendering" % (frame,)
+    sys.stdout.flush()
+    time.sleep(options.sleep)
+    if options.output:
+        path = os.path.join(options.output, 'frame_%04d.png' % (frame,))
+        fh = open(path, 'wb')
+        fh.write(('%04d' % (frame,)) * (options.size // 4))
+        fh.close()
+        print "Saved: %s Time: 00:00.01 (Saving: 00:00.00)" % (path,)
+    else:
+        print "Saved: frame_%04d.png" % (frame,)
+    sys.stdout.flush()
+
+sys.exit(options.exit)
@@ -1,16 +1,38 @@
 #!/usr/bin/python
 
 import StringIO
+import base64
 import copy
+import hashlib
+import os
+import shutil
 import simplejson
 import sys
+import tempfile
 import unittest
+import urllib
+
+from twisted.internet import defer, reactor, threads
+from twisted.trial import unittest as trial
 
 sys.path.append('lib')
 
+from legion.assets import AssetCache, AssetStore, hash_file
+from legion.client import Client
 from legion.jobs import Job, Jobs, Task
+from legion.log import Logger, FileSink, DEBUG, INFO, WARN
+from legion.journal import Journal
 from legion.master import Master
+from legion.metrics import Metrics, StallMonitor
+from legion.ranges import RangeSet
 from legion.error import LegionError
+from legion.scheduler import FifoScheduler, FairShareScheduler
+from legion.tasks import CompactTaskTable
+from legion import tiles
+from legion.uploads import Upload, UploadStore
+from legion.worker import Worker, blender_command, saved_path
+
+FAKE_RENDERER = os.path.join(os.path.dirname(__file__), 'fake_renderer.py')
 
 class Mocked(object):
     def __init__(self, *args, **kwargs):
@@ -21,8 +43,15 @@ class Mocked(object):
 class MockClient(Mocked):
     def __init__(self, *args, **kwargs):
         self.received = []
+        self.tasks = set()
+        self.warm = set()
+        self.slots = 1
+        self.prefetch = 1
+        self.speed = None
+        self.failure_rate = 0.0
         self.id = 0
         self.status = 'idle'
+        self.disconnected = False
         Mocked.__init__(self, *args, **kwargs)
 
     def is_idle(self):
@@ -31,6 +60,43 @@ class MockClient(Mocked):
     def send_line(self, line):
         self.received.append(line)
 
+    def render_task(self, job, task):
+        self.received.append((job.id, task.startframe))
+
+    def update_status(self):
+        capacity = self.slots + self.prefetch - 1
+        self.status = 'busy' if len(self.tasks) >= capacity else 'idle'
+
+    def add_task(self, job_id, frame):
+        self.tasks.add((job_id, frame))
+        self.update_status()
+
+    def remove_task(self, job_id, frame):
+        self.tasks.discard((job_id, frame))
+        self.update_status()
+
+    def record_task(self, frames, elapsed, status, seconds_per_frame=None):
+        pass
+
+    def cancel_task(self, job, task):
+        self.received.append(('cancel', job.id, task.startframe))
+
+    def disconnect(self):
+        self.disconnected = True
+
+def job_file(**kwargs):
+    job_dict = {
+        'filename': 'legion.blend',
+        'startframe': 1,
+        'endframe': 6,
+        'tasksize': 2,
+        'timeout': 180,
+        'jobdir': 'jobdir',
+        'jobname': 'legionjob',
+    }
+    job_dict.update(kwargs)
+    return StringIO.StringIO(simplejson.dumps(job_dict))
+
 class TestMaster(unittest.TestCase):
     def setUp(self):
         self.m = Master()
@@ -79,7 +145,341 @@ class TestMaster(unittest.TestCase):
         self.assert_(b not in idle)
 
     def test_dispatch_idle_clients(self):
-        pass
+        c0 = MockClient(id=0)
+        c1 = MockClient(id=1)
+        self.m.add_client(c0)
+        self.m.add_client(c1)
+
+        job = Job(job_file())
+        self.m.jobs.add_job(job)
+        self.m.dispatch_idle_clients()
+
+        self.assertEqual(c0.received[-1], (job.id, 1))
+        self.assertEqual(c1.received[-1], (job.id, 3))
+
+        # finishing a task hands out the next one without waiting for a tick
+        self.m.handle_line(1, 'set_task_status %d 3 complete' % (job.id,))
+        self.assertEqual(c1.received[-1], (job.id, 5))
+        self.assertEqual(c0.status, 'busy')
+
+    def test_slow_head_client(self):
+        slow = MockClient(id=0, speed=0.2)
+        fast = [ MockClient(id=1), MockClient(id=2) ]
+        for c in [ slow ] + fast:
+            self.m.add_client(c)
+        self.m.jobs.set_farm_size(3)
+        job = Job(job_file(endframe=3, tasksize=1))
+        self.m.jobs.add_job(job)
+        self.m.dispatch_idle_clients()
+
+        # the slow client is passed over while faster ones are idle
+        self.assertEqual([ c.received[-1] for c in fast ],
+            [ (job.id, 1), (job.id, 2) ])
+        self.assertEqual(slow.tasks, set())
+        # and gets the last task once nobody faster is left
+        self.m.dispatch_idle_clients()
+        self.assertEqual(slow.received[-1], (job.id, 3))
+
+    def test_flaky_single_client(self):
+        c = MockClient(id=0, failure_rate=0.9)
+        self.m.add_client(c)
+        job = Job(job_file(endframe=1, tasksize=1))
+        self.m.jobs.add_job(job)
+        self.m.dispatch_idle_clients()
+        self.assertEqual(c.received[-1], (job.id, 1))
+
+    def test_remove_client_requeues(self):
+        c0 = MockClient(id=0)
+        c1 = MockClient(id=1)
+        self.m.add_client(c0)
+        job = Job(job_file())
+        self.m.jobs.add_job(job)
+        self.m.dispatch_idle_clients()
+        self.assertEqual(c0.tasks, set([(job.id, 1)]))
+
+        self.m.remove_client(0)
+        self.assertEqual(job.get_task(1).status, 'pending')
+        self.assertEqual(job.requeues, 1)
+
+        self.m.add_client(c1)
+        self.assertEqual(c1.received[-1], (job.id, 1))
+
+    def test_expire_leases(self):
+        m = Master(lease_timeout=15)
+        c0 = MockClient(id=0)
+        c1 = MockClient(id=1)
+        m.add_client(c0)
+        m.add_client(c1)
+        job = Job(job_file())
+        m.jobs.add_job(job)
+        m.dispatch_idle_clients()
+
+        c1.last_seen += 10
+        m.expire_leases(c0.last_seen + 16)
+        self.assertEqual(m.clients, { 1: c1 })
+        self.assert_(c0.disconnected)
+        self.assertEqual(job.get_task(1).status, 'pending')
+        self.assertEqual(job.get_task(3).status, 'rendering')
+
+        m.handle_line(1, 'ping')
+        self.assertEqual(c1.received[-1], 'pong')
+        m.expire_leases(c1.last_seen + 14)
+        self.assertEqual(m.clients, { 1: c1 })
+
+    def test_prefetch(self):
+        c0 = MockClient(id=0)
+        self.m.add_client(c0)
+        job = Job(job_file(endframe=10, tasksize=1))
+        self.m.jobs.add_job(job)
+        self.m.dispatch_idle_clients()
+        self.assertEqual(len(c0.tasks), 1)
+
+        self.m.handle_line(0, 'prefetch 3')
+        self.assertEqual(c0.received[-2:], [(job.id, 2), (job.id, 3)])
+        self.assertEqual(len(c0.tasks), 3)
+        self.assertEqual(c0.status, 'busy')
+
+        self.m.handle_line(0, 'set_task_status %d 1 complete' % (job.id,))
+        self.assertEqual(c0.received[-1], (job.id, 4))
+
+        # every prefetched task is requeued when the client goes away
+        self.m.remove_client(0)
+        self.assertEqual(job.count('rendering'), 0)
+        self.assertEqual(job.requeues, 3)
+
+    def test_set_task_statuses(self):
+        c0 = MockClient(id=0, prefetch=3)
+        c1 = MockClient(id=1)
+        self.m.add_client(c0)
+        self.m.add_client(c1)
+        job = Job(job_file(endframe=10, tasksize=1))
+        self.m.jobs.add_job(job)
+        self.m.dispatch_idle_clients()
+        self.assertEqual(sorted(c0.tasks), [(job.id, 1), (job.id, 2), (job.id, 3)])
+
+        self.m.handle_line(0, 'set_task_statuses %d 1 complete 1.5 %d 2 error 0.5'
+            % (job.id, job.id))
+        self.assertEqual(job.count('complete'), 1)
+        self.assertEqual(job.count('rendering'), 4)
+        # both freed slots are filled by the same dispatch, starting with
+        # the task that just failed
+        self.assertEqual(c0.received[-2:], [(job.id, 2), (job.id, 5)])
+
+        self.m.handle_line(0, 'set_task_statuses %d 3 complete' % (job.id,))
+        self.assertEqual(job.count('complete'), 1)
+
+    def test_unknown_command(self):
+        c = Client(MockProtocol())
+        self.m.add_client(c)
+        self.m.handle_line(c.id, 'do_ping')
+        self.m.handle_line(c.id, '')
+        self.assertEqual(c._protocol.lines[-2:], [
+            'Error: Unknown command "do_ping"', 'Error: Unknown command ""'])
+        self.m.handle_line(c.id, '  ping  ')
+        self.assertEqual(c._protocol.lines[-1], 'pong')
+
+    def test_slots(self):
+        c = Client(MockProtocol())
+        self.m.add_client(c)
+        self.m.handle_line(c.id, 'slots 4')
+        self.m.handle_line(c.id, 'prefetch 2')
+        job = Job(job_file(endframe=10, tasksize=1))
+        self.m.jobs.add_job(job)
+        self.m.dispatch_idle_clients()
+
+        # a task for every slot and one more queued
+        self.assertEqual(len(c.tasks), 5)
+        self.assertEqual(self.m.jobs.scheduler.farm_size, 4)
+
+        self.m.handle_line(c.id, 'progress %d 1 1' % (job.id,))
+        self.m.handle_line(c.id, 'progress %d 9 1' % (job.id,))
+        self.assertEqual(c.to_hash()['progress'], [[job.id, 1, 1]])
+        self.m.handle_line(c.id, 'set_task_status %d 1 complete' % (job.id,))
+        self.assertEqual(c.progress, {})
+
+    def test_locality(self):
+        m = Master(locality_wait=5)
+        (cold, warm) = (MockClient(id=0), MockClient(id=1))
+        m.add_client(cold)
+        m.add_client(warm)
+        m.handle_line(warm.id, 'cached 4a3f 4a3f 77c0')
+        self.assertEqual(m.jobs.scheduler.warm, { '4a3f': 1, '77c0': 1 })
+
+        # the job waits for the client that has its scene cached
+        warm.status = 'busy'
+        job = Job(job_file(manifest={ 'legion.blend': [ '4a3f', 10 ] }))
+        m.jobs.add_job(job)
+        m.dispatch_idle_clients()
+        self.assertEqual(cold.tasks, set())
+        self.assertEqual(list(m.idle), [ cold.id ])
+        self.assert_(m.jobs.locality_retry() > job.cold_since)
+
+        warm.status = 'idle'
+        m.wake(warm)
+        m.dispatch_idle_clients()
+        self.assertEqual(warm.tasks, set([ (job.id, 1) ]))
+        self.assertEqual(job.cold_since, None)
+
+        # and takes cold clients once it has waited long enough
+        m.dispatch_idle_clients()
+        self.assertEqual(cold.tasks, set())
+        job.cold_since -= 5
+        m.dispatch_idle_clients()
+        self.assertEqual(cold.tasks, set([ (job.id, 3) ]))
+        self.assertEqual(m.placements.values,
+            { ('warm',): 1, ('cold',): 1 })
+
+        m.handle_line(warm.id, 'evicted 4a3f')
+        self.assertEqual(warm.warm, set([ '77c0' ]))
+        m.remove_client(warm.id)
+        self.assertEqual(m.jobs.scheduler.warm, {})
+
+    def test_locality_rendered(self):
+        m = Master(locality_wait=5)
+        (c0, c1) = (MockClient(id=0), MockClient(id=1))
+        m.add_client(c0)
+        job = Job(job_file())
+        m.jobs.add_job(job)
+        m.dispatch_idle_clients()
+        m.handle_line(c0.id, 'set_task_status %d 1 complete' % (job.id,))
+        self.assertEqual(c0.warm, set([ 'job:%d' % (job.id,) ]))
+
+        # the job has a client that has rendered it, which is busy
+        m.add_client(c1)
+        self.assertEqual(c1.tasks, set())
+        self.assertEqual(len(c0.tasks), 1)
+
+    def test_protocol(self):
+        c = Client(MockProtocol())
+        c.known_jobs.add(1)
+        self.m.add_client(c)
+        self.m.handle_line(c.id, 'protocol 2')
+        self.assertEqual(c.protocol_version, 2)
+        self.assertEqual(c.known_jobs, set())
+
+        self.m.handle_line(c.id, 'protocol 3')
+        self.assertEqual(c.protocol_version, 2)
+        self.assert_(c._protocol.lines[-1].startswith('Error:'))
+
+    def test_client_stats(self):
+        c0 = MockClient(id=0)
+        c1 = Client(MockProtocol())
+        self.m.add_client(c0)
+        self.m.add_client(c1)
+        job = Job(job_file())
+        self.m.jobs.add_job(job)
+        self.m.dispatch_idle_clients()
+
+        (job_id, frame) = list(c1.tasks)[0]
+        self.m.handle_line(c1.id,
+            'set_task_status %d %d complete 4' % (job_id, frame))
+        self.m.handle_line(c1.id, 'client_stats %d' % (c1.id,))
+        stats = simplejson.loads(c1._protocol.lines[-1][2:])
+        self.assertEqual(stats['fps'], 0.5)
+        self.assertEqual(stats['frames_rendered'], 2)
+
+    def test_speculative(self):
+        c0 = MockClient(id=0)
+        c1 = MockClient(id=1)
+        self.m.add_client(c0)
+        job = Job(job_file(endframe=2, tasksize=1, speculative=True))
+        self.m.jobs.add_job(job)
+        self.m.add_client(c1)
+        self.assertEqual(c0.received[-1], (job.id, 1))
+        self.assertEqual(c1.received[-1], (job.id, 2))
+
+        # c1 is done and nothing is pending, so it backs up frame 1
+        job.render_time, job.frames_timed = 20.0, 1
+        self.m.handle_line(1, 'set_task_status %d 2 complete 1' % (job.id,))
+        self.assertEqual(c1.received[-1], (job.id, 1))
+        self.assertEqual(job.speculated, 1)
+
+        self.m.handle_line(1, 'set_task_status %d 1 complete 1' % (job.id,))
+        self.assertEqual(c0.received[-1], ('cancel', job.id, 1))
+        self.assertEqual(c0.tasks, set())
+        self.assertEqual(job.get_task(1).client, c1)
+        self.assert_(job.all_tasks_complete())
+
+        stats = job.stats()
+        self.assertEqual(stats['speculation_wins'], 1)
+        self.assert_(0 <= stats['wasted_time'] < 1)
+        self.assert_(10 < stats['saved_time'] <= 10.5)
+
+        # the losing copy reporting late changes nothing
+        self.m.handle_line(0, 'set_task_status %d 1 error' % (job.id,))
+        self.assertEqual(job.get_task(1).status, 'complete')
+
+    def test_invalid_status(self):
+        c = MockClient(id=0)
+        self.m.add_client(c)
+        job = Job(job_file(endframe=1, tasksize=1))
+        self.m.jobs.add_job(job)
+        self.m.dispatch_idle_clients()
+        self.m.handle_line(0, 'set_task_status %d 1 completed' % (job.id,))
+        self.assertEqual(c.received[-1], 'Error: Invalid task status "completed"')
+        self.assertEqual(job.get_task(1).status, 'rendering')
+        self.assertEqual(job.status_counts.get('completed'), None)
+
+    def test_late_error(self):
+        (a, b) = (MockClient(id=0), MockClient(id=1))
+        self.m.add_client(a)
+        job = Job(job_file(endframe=1, tasksize=1, timeout=0))
+        self.m.jobs.add_job(job)
+        self.m.dispatch_idle_clients()
+        self.m.add_client(b)
+        self.assertEqual(a.received[-1], (job.id, 1))
+
+        # a is told to stop once its task times out and goes to b
+        self.m.check_timed_out_tasks()
+        self.assert_(('cancel', job.id, 1) in a.received)
+        self.assertEqual(b.received[-1], (job.id, 1))
+        self.assertEqual(job.get_task(1).client, b)
+
+        # a's render failing after all doesn't requeue b's task
+        self.m.handle_line(0, 'set_task_status %d 1 error' % (job.id,))
+        self.assertEqual(job.get_task(1).status, 'rendering')
+        self.assertEqual(job.get_task(1).client, b)
+        self.assertEqual(b.tasks, set([ (job.id, 1) ]))
+
+    def test_speculative_disconnect(self):
+        c0 = MockClient(id=0)
+        c1 = MockClient(id=1)
+        self.m.add_client(c0)
+        job = Job(job_file(endframe=1, tasksize=1, speculative=True))
+        self.m.jobs.add_job(job)
+        self.m.add_client(c1)
+        self.assertEqual(c1.received[-1], (job.id, 1))
+
+        # the backup takes over when the original client goes away
+        self.m.remove_client(0)
+        self.assertEqual(job.get_task(1).status, 'rendering')
+        self.assertEqual(job.get_task(1).client, c1)
+        self.assertEqual(job.requeues, 0)
+
+        self.m.handle_line(1, 'set_task_status %d 1 complete' % (job.id,))
+        self.assert_(job.all_tasks_complete())
+
+    def test_job_stats(self):
+        c = MockClient(id=0)
+        self.m.add_client(c)
+        job = Job(job_file())
+        self.m.jobs.add_job(job)
+
+        self.m.handle_line(0, 'job_stats %d' % (job.id,))
+        stats = simplejson.loads(c.received[-1][2:])
+        self.assertEqual(stats['tasks'], 3)
+        self.assertEqual(stats['pending'], 3)
+
+    def test_request_dispatch(self):
+        calls = []
+        m = Master(call_later=lambda delay, f: calls.append(f))
+        m.add_client(MockClient(id=0))
+        m.add_client(MockClient(id=1))
+        self.assertEqual(len(calls), 1, 'dispatch requests are coalesced')
+
+        calls.pop()()
+        m.request_dispatch()
+        self.assertEqual(len(calls), 1, 'new request after dispatch ran')
 
 
 class TestJob(unittest.TestCase):
@@ -196,7 +596,171 @@ class TestJob(unittest.TestCase):
         self.assertEqual(job.tasks[0].status, 'complete')
         self.assertEqual(job.tasks[1].status, 'rendering')
 
+        self.assertRaises(LegionError, job.set_task_status, 2, 'complete')
+
+    def test_status_counts(self):
+        c = MockClient()
+        job = Job(self.job_file)
+        self.assertEqual(job.count('pending'), 3)
+
+        job.assign_next_task(c)
+        job.set_task_status(5, 'complete')
+        self.assertEqual(job.count('pending'), 1)
+        self.assertEqual(job.count('rendering'), 1)
+        self.assertEqual(job.count('complete'), 1)
+
+        # frame 5 was completed out of order, so only frame 3 is left
+        task = job.assign_next_task(c)
+        self.assertEqual(task.startframe, 3)
+        self.assertEqual(job.assign_next_task(c), None)
+        self.assertFalse(job.all_tasks_complete())
+
+        job.set_task_status(1, 'error')
+        task = job.assign_next_task(c)
+        self.assertEqual(task.startframe, 1, 'errored task is requeued')
+
+        job.set_task_status(1, 'complete')
+        job.set_task_status(3, 'complete')
+        self.assertTrue(job.all_tasks_complete())
+        self.assertEqual(job.status, 'complete')
+
+class TestCompactJob(TestJob):
+    def setUp(self):
+        TestJob.setUp(self)
+        self.job_dict['storage'] = 'compact'
+        self.update_job_file()
+
+    def test_task_views(self):
+        c = MockClient(id=7)
+        job = Job(self.job_file)
+        self.assert_(isinstance(job.tasks, CompactTaskTable))
+
+        task = job.assign_next_task(c)
+        self.assertEqual(job.get_task(1).client, c)
+        self.assert_(job.get_task(1).start_time)
+        self.assertEqual(job.tasks[-1].to_hash(), {
+            'startframe': 5,
+            'endframe': 6,
+            'status': 'pending',
+            'client': None })
+
+        job.set_task_status(1, 'paused')
+        self.assertEqual(job.tasks[0].status, 'paused')
+
+    def test_invalid_storage(self):
+        self.job_dict['storage'] = 'invalid'
+        self.update_job_file()
+        self.assertRaises(LegionError, Job, self.job_file)
+
+class TestLazyJob(TestJob):
+    def setUp(self):
+        TestJob.setUp(self)
+        self.job_dict['lazy'] = True
+        self.update_job_file()
+
+    def test_load_job(self):
+        job = Job(self.job_file)
+
+        self.assertEqual(job.status, 'pending')
+        self.assertEqual(len(job.tasks), 0, 'no tasks created up front')
+        self.assertEqual(job.task_count(), 3)
+        self.assertEqual(job.count('pending'), 3)
+
+    def test_split_task(self):
+        c = MockClient()
+        job = Job(self.job_file)
+
+        job.set_task_status(3, 'complete')
+        self.assertEqual(job.tasks[0].to_hash(), {
+            'startframe': 3,
+            'endframe': 4,
+            'status': 'complete',
+            'client': None })
+        self.assertRaises(LegionError, job.set_task_status, 4, 'complete')
+
+        self.assertEqual(job.assign_next_task(c).startframe, 1)
+        self.assertEqual(job.assign_next_task(c).startframe, 5)
+        self.assertEqual(job.assign_next_task(c), None)
+        self.assertEqual(len(job.tasks), 3)
+
+    def test_huge_job(self):
+        c = MockClient()
+        self.job_dict['lazy'] = None
+        self.job_dict['endframe'] = 10000000
+        self.job_dict['tasksize'] = 1
+        self.update_job_file()
+        job = Job(self.job_file)
+
+        self.assert_(job.is_lazy(), 'large jobs are lazy by default')
+        self.assertEqual(job.task_count(), 10000000)
+        self.assertEqual(job.assign_next_task(c).startframe, 1)
+
+        job.set_task_status(5000000, 'complete')
+        self.assertEqual(job.count('complete'), 1)
+        self.assertEqual(job.count('pending'), 10000000 - 2)
+        self.assertEqual(len(job.tasks), 2)
+
+class TestGuidedJob(unittest.TestCase):
+    def test_guided_chunks(self):
+        c = MockClient()
+        job = Job(job_file(endframe=1000, tasksize=2, timeout=600,
+            chunking='guided'))
+        self.assert_(job.is_lazy())
+
+        # chunks stay at tasksize until a frame has been timed
+        task = job.assign_next_task(c, 5)
+        self.assertEqual((task.startframe, task.endframe), (1, 2))
+        job.set_task_status(1, 'complete', 1.0)
+        self.assertEqual(job.seconds_per_frame(), 0.5)
+
+        sizes = []
+        while True:
+            task = job.assign_next_task(c, 5)
+            if not task: break
+            sizes.append(task.endframe - task.startframe + 1)
+            job.set_task_status(task.startframe, 'complete', sizes[-1] * 0.5)
+
+        self.assertEqual(sum(sizes), 998, 'every frame handed out once')
+        self.assertEqual(sizes[0], 100)
+        self.assertEqual(sizes, sorted(sizes, reverse=True))
+        self.assertEqual(min(sizes[:-1]), 60, 'MIN_TASK_SECONDS of work')
+        self.assert_(job.all_tasks_complete())
+
+    def test_guided_timeout_cap(self):
+        job = Job(job_file(endframe=1000, tasksize=1, timeout=20,
+            chunking='guided'))
+        job.assign_next_task(MockClient())
+        job.set_task_status(1, 'complete', 1.0)
+        self.assertEqual(job.chunk_size(1), 10, 'half the timeout')
+
+        job.tasksize = 15
+        self.assertEqual(job.chunk_size(1), 15, 'never below tasksize')
+
+    def test_client_speed(self):
+        job = Job(job_file(endframe=1000, tasksize=1, timeout=1000,
+            chunking='guided'))
+        job.assign_next_task(MockClient())
+        job.set_task_status(1, 'complete', 1.0)
+
+        self.assertEqual(job.chunk_size(5), 100)
+        self.assertEqual(job.chunk_size(5, 2.0), 200)
+        self.assertEqual(job.chunk_size(5, 0.5), 50)
+
+    def test_invalid_chunking(self):
+        self.assertRaises(LegionError, Job, job_file(chunking='invalid'))
+
+class TestCompactLazyJob(TestLazyJob):
+    def setUp(self):
+        TestLazyJob.setUp(self)
+        self.job_dict['storage'] = 'compact'
+        self.update_job_file()
+
 class MockJob(Mocked):
+    priority = 0
+    weight = 1
+    depends = []
+    dependents = []
+
     def __init__(self, *args, **kwargs):
         self.all_tasks_complete = False
         Mocked.__init__(self, *args, **kwargs)
@@ -251,6 +815,29 @@ class TestJobs(unittest.TestCase):
         active = jobs.active_job()
         self.assertEqual(active, None, 'no jobs available')
 
+    def test_check_timed_out_tasks(self):
+        jobs = Jobs()
+        job = Job(job_file(timeout=60))
+        jobs.add_job(job)
+        first_client = MockClient(id=0)
+        (j, first) = jobs.assign_next_task(first_client)
+        (j, second) = jobs.assign_next_task(MockClient(id=1))
+        job.set_task_status(3, 'complete')
+
+        self.assertEqual(jobs.check_timed_out_tasks(first.start_time + 59), [])
+        self.assertEqual(jobs.check_timed_out_tasks(first.start_time + 61),
+            [(first_client, job.id, 1)])
+        self.assertEqual(first.status, 'pending')
+        self.assertEqual(second.status, 'complete')
+        self.assertEqual(job.stats()['timeouts'], 1)
+        self.assertEqual(job.stats()['requeues'], 1)
+
+        # the requeued task gets a fresh deadline when it is reassigned
+        (j, task) = jobs.assign_next_task(MockClient(id=2))
+        self.assertEqual(task.startframe, 1)
+        self.assertEqual(jobs.check_timed_out_tasks(task.start_time + 59), [])
+        self.assertEqual(task.status, 'rendering')
+
     def test_task_to_hash(self):
         t = Task(
             startframe=1,
@@ -267,10 +854,1238 @@ class TestJobs(unittest.TestCase):
               'client': None }
         )
 
-# class TestClient(unittest.TestCase):
-#     def setUp(self):
-#         pass
-# 
+class TestDepends(unittest.TestCase):
+    def setUp(self):
+        self.jobs = Jobs()
+        self.client = MockClient()
+
+    def add(self, **kwargs):
+        job = Job(job_file(**kwargs))
+        self.jobs.add_job(job)
+        return job
+
+    def next_frame(self, job):
+        task = job.assign_next_task(self.client)
+        return task and task.startframe
+
+    def test_all(self):
+        bake = self.add(jobname='bake', endframe=2, tasksize=1)
+        render = self.add(jobname='render', depends=[
+            { 'job': 'bake', 'all': True }])
+        self.assertEqual(render.depends, [{ 'job': bake.id, 'all': True }])
+        self.assertEqual(render.stats()['blocked'], 3)
+        self.assertEqual(self.next_frame(render), None)
+
+        bake.set_task_status(1, 'complete')
+        self.assertEqual(self.next_frame(render), None)
+        bake.set_task_status(2, 'complete')
+        self.assertEqual(self.next_frame(render), 1)
+        self.assertEqual(render.stats()['blocked'], 0)
+
+    def test_same_frames(self):
+        sim = self.add(jobname='sim', tasksize=1)
+        render = self.add(depends=[sim.id])
+        self.assertEqual(render.depends, [{ 'job': sim.id, 'window': [0, 0] }])
+
+        sim.set_task_status(1, 'complete')
+        self.assertEqual(self.next_frame(render), None, 'whole tasks only')
+        sim.set_task_status(2, 'complete')
+        sim.set_task_status(5, 'complete')
+        self.assertEqual(self.next_frame(render), 1)
+        self.assertEqual(self.next_frame(render), None)
+        sim.set_task_status(6, 'complete')
+        self.assertEqual(self.next_frame(render), 5)
+
+        render.set_task_status(1, 'complete')
+        render.set_task_status(5, 'complete')
+        self.assertNotEqual(render.status, 'complete', 'frames 3-4 still held')
+        self.assertEqual(render.count('pending'), 1)
+
+    def test_window(self):
+        sim = self.add(jobname='sim', tasksize=1)
+        blur = self.add(tasksize=1, depends=[
+            { 'job': 'sim', 'window': [1, 1] }])
+
+        sim.set_task_status(1, 'complete')
+        self.assertEqual(self.next_frame(blur), None)
+        sim.set_task_status(2, 'complete')
+        self.assertEqual(self.next_frame(blur), 1)
+        sim.set_task_status(4, 'complete')
+        self.assertEqual(self.next_frame(blur), None)
+        sim.set_task_status(3, 'complete')
+        self.assertEqual(self.next_frame(blur), 2)
+        self.assertEqual(self.next_frame(blur), 3)
+        self.assertEqual(self.next_frame(blur), None)
+
+    def test_latest_by_name(self):
+        old = self.add(jobname='sim')
+        new = self.add(jobname='sim')
+        render = self.add(depends=['sim'])
+        self.assertEqual(render.upstreams.keys(), [new.id])
+        self.assertEqual(new.dependents, [render])
+        self.assertRaises(LegionError, self.jobs.delete_job, new.id)
+
+    def test_unknown(self):
+        for depends in (['nothing'], [12345],
+                        [{ 'job': 'sim', 'window': [-1, 0] }]):
+            self.add(jobname='sim')
+            self.assertRaises(LegionError, self.add, depends=depends)
+
+    def test_tiles(self):
+        shade = self.add(jobname='shade', type='tile', tiles=[2, 1],
+            resolution=[4, 2], endframe=2)
+        comp = self.add(tasksize=1, endframe=2, depends=['shade'])
+
+        shade.set_task_status(0, 'complete')
+        shade.set_task_status(3, 'complete')
+        self.assertEqual(self.next_frame(comp), None)
+        shade.set_task_status(1, 'complete')
+        self.assertEqual(self.next_frame(comp), 1)
+        self.assertEqual(self.next_frame(comp), None)
+
+class MockProtocol(Mocked):
+    def __init__(self, *args, **kwargs):
+        self.lines = []
+        Mocked.__init__(self, *args, **kwargs)
+
+    def sendLine(self, line):
+        self.lines.append(line)
+
+class TestClient(unittest.TestCase):
+    def test_idle_gap(self):
+        c = Client(MockProtocol())
+        c.idle_since -= 2
+        c.add_task(1, 1)
+        self.assert_(c.idle_gap_last >= 2)
+        self.assertEqual(c.idle_gap_count, 1)
+        self.assertEqual(c.status, 'busy')
+
+        c.remove_task(1, 1)
+        self.assertEqual(c.status, 'idle')
+        c.add_task(1, 2)
+        self.assertEqual(c.idle_gap_count, 2)
+        self.assert_(c.idle_gap_last < 2)
+        self.assertEqual(c.to_hash()['idle_gap']['max'], c.idle_gap_max)
+
+    def test_task_lines(self):
+        c = Client(MockProtocol())
+        job = Job(job_file())
+        (first, second) = (job.get_task(1), job.get_task(3))
+
+        lines = c.task_lines(job, first)
+        self.assertEqual(len(lines), 1)
+        self.assertEqual(simplejson.loads(lines[0].split(None, 2)[2])['job'],
+            job.to_hash())
+
+        c.protocol_version = 2
+        lines = c.task_lines(job, first)
+        self.assertEqual(lines, [
+            'PUT /jobs/%d %s' % (job.id, job.to_json()),
+            'POST /jobs/%d/tasks/1/render 1 2' % (job.id,),
+        ])
+        self.assertEqual(c.task_lines(job, second),
+            [ 'POST /jobs/%d/tasks/3/render 3 4' % (job.id,) ])
+
+    def test_record_task(self):
+        c = Client(MockProtocol())
+        c.record_task(10, 5.0, 'complete', 1.0)
+        self.assertEqual((c.fps, c.speed, c.failure_rate), (2.0, 2.0, 0.0))
+
+        c.record_task(10, 20.0, 'complete', 1.0)
+        self.assertAlmostEqual(c.fps, 1.7)
+        self.assertAlmostEqual(c.speed, 1.7)
+
+        c.record_task(10, 20.0, 'error', 1.0)
+        self.assertAlmostEqual(c.failure_rate, 0.2, 5)
+        # and fades while no task finishes
+        c.failure_time -= 2 * Client.FAILURE_HALF_LIFE
+        self.assertAlmostEqual(c.failure_rate, 0.05, 5)
+        self.assertEqual(c.frames_rendered, 20)
+        self.assertEqual(c.tasks_failed, 1)
+
+    def test_prefetch(self):
+        c = Client(MockProtocol())
+        c.prefetch = 2
+        c.add_task(1, 1)
+        self.assertEqual(c.status, 'idle')
+        c.add_task(1, 2)
+        self.assertEqual(c.status, 'busy')
+        self.assertEqual(c.idle_gap_count, 1, 'only counted when empty')
+
+class TestScheduler(unittest.TestCase):
+    def assign(self, jobs, count):
+        assigned = []
+        for i in range(count):
+            (job, task) = jobs.assign_next_task(MockClient(id=i))
+            assigned.append(job and job.id)
+        return assigned
+
+    def test_priority(self):
+        jobs = Jobs()
+        low = Job(job_file(endframe=100, tasksize=1))
+        high = Job(job_file(endframe=2, tasksize=1, priority=10))
+        jobs.add_job(low)
+        jobs.add_job(high)
+
+        self.assertEqual(self.assign(jobs, 3), [high.id, high.id, low.id])
+
+    def test_weighted_share(self):
+        jobs = Jobs()
+        big = Job(job_file(endframe=100, tasksize=1))
+        small = Job(job_file(endframe=100, tasksize=1, weight=3))
+        jobs.add_job(big)
+        jobs.add_job(small)
+
+        assigned = self.assign(jobs, 8)
+        self.assertEqual(assigned.count(big.id), 2)
+        self.assertEqual(assigned.count(small.id), 6)
+
+        # a finished task frees up share for the job it came from
+        big.set_task_status(1, 'complete')
+        self.assertEqual(self.assign(jobs, 1), [big.id])
+
+    def test_drained_job_requeued(self):
+        jobs = Jobs()
+        job = Job(job_file(endframe=1, tasksize=1))
+        jobs.add_job(job)
+
+        self.assertEqual(self.assign(jobs, 2), [job.id, None])
+        job.set_task_status(1, 'error')
+        self.assertEqual(self.assign(jobs, 1), [job.id])
+
+    def test_paused_job(self):
+        jobs = Jobs()
+        job = Job(job_file())
+        jobs.add_job(job)
+
+        jobs.set_job_status(job.id, 'paused')
+        self.assertEqual(self.assign(jobs, 1), [None])
+        jobs.set_job_status(job.id, 'pending')
+        self.assertEqual(self.assign(jobs, 1), [job.id])
+
+    def test_slow_clients_avoid_tail(self):
+        for scheduler in (FifoScheduler(), FairShareScheduler()):
+            jobs = Jobs(scheduler=scheduler)
+            jobs.set_farm_size(4)
+            job = Job(job_file(endframe=5, tasksize=1))
+            jobs.add_job(job)
+
+            slow = MockClient(id=0, speed=0.3)
+            flaky = MockClient(id=1, failure_rate=0.8)
+            fast = MockClient(id=2, speed=1.5)
+
+            self.assertEqual(jobs.assign_next_task(slow)[1].startframe, 1)
+            self.assertEqual(jobs.assign_next_task(flaky), (None, None))
+            self.assertEqual(jobs.assign_next_task(slow), (None, None))
+            self.assertEqual(jobs.assign_next_task(fast)[1].startframe, 2)
+
+    def test_fifo(self):
+        jobs = Jobs(scheduler=FifoScheduler())
+        first = Job(job_file(endframe=2, tasksize=1))
+        second = Job(job_file(endframe=2, tasksize=1, priority=10))
+        jobs.add_job(first)
+        jobs.add_job(second)
+
+        self.assertEqual(self.assign(jobs, 4),
+            [first.id, first.id, second.id, second.id])
+
+class TestRangeSet(unittest.TestCase):
+    def test_add(self):
+        r = RangeSet([(5, 6), (1, 2)])
+        self.assertEqual(list(r), [(1, 2), (5, 6)])
+
+        # touching and overlapping ranges merge
+        r.add(3, 3)
+        self.assertEqual(list(r), [(1, 3), (5, 6)])
+        r.add(4, 10)
+        self.assertEqual(list(r), [(1, 10)])
+        r.add(20, 20)
+        self.assertEqual(r.size(), 11)
+
+    def test_remove(self):
+        r = RangeSet([(1, 10), (20, 30)])
+        r.remove(5, 22)
+        self.assertEqual(list(r), [(1, 4), (23, 30)])
+        r.remove(1, 4)
+        self.assertEqual(list(r), [(23, 30)])
+
+    def test_contains(self):
+        r = RangeSet([(1, 10), (20, 30)])
+        self.assert_(r.contains(1, 10))
+        self.assert_(r.contains(25, 25))
+        self.failIf(r.contains(5, 20))
+        self.failIf(r.contains(0, 1))
+
+    def test_intersection(self):
+        r = RangeSet([(1, 10), (20, 30), (40, 50)])
+        self.assertEqual(r.intersection(5, 25), [(5, 10), (20, 25)])
+        self.assertEqual(r.intersection(11, 19), [])
+        self.assertEqual(r.intersection(0, 100), list(r))
+
+class TestJournal(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def master(self):
+        m = Master(journal=Journal(self.path, snapshot_every=4))
+        m.add_client(MockClient(id=0))
+        return m
+
+    def submit(self, m, **kwargs):
+        filename = os.path.join(self.path, 'test.job')
+        fh = open(filename, 'w')
+        fh.write(job_file(**kwargs).getvalue())
+        fh.close()
+        m.handle_line(0, 'new_job %s' % (filename,))
+        return m.jobs.pending().next()
+
+    def sync(self, m):
+        (data, snapshot) = m.journal_batch()
+        m.journal.write(data, snapshot)
+
+    def test_recover(self):
+        m = self.master()
+        job = self.submit(m, endframe=10)
+        m.handle_line(0, 'set_task_status %d 1 complete' % (job.id,))
+        m.handle_line(0, 'set_task_status %d 3 error' % (job.id,))
+        self.sync(m)
+
+        # nothing reaches the disk until the journal is written
+        m.handle_line(0, 'set_task_status %d 5 complete' % (job.id,))
+        restarted = Master(journal=Journal(self.path))
+        restarted.recover()
+        restored = restarted.jobs.get_job(job.id)
+        self.assertEqual(list(restored.completed), [(1, 2)])
+        self.assertEqual(restored.to_hash()['jobname'], 'legionjob')
+
+        self.sync(m)
+        restarted = Master(journal=Journal(self.path))
+        restarted.recover()
+        restored = restarted.jobs.get_job(job.id)
+        self.assertEqual(list(restored.completed), [(1, 2), (5, 6)])
+        self.assertEqual(restored.count('pending'), 3)
+        self.assertEqual(restored.assign_next_task(MockClient()).startframe, 3)
+
+    def test_recover_depends(self):
+        m = self.master()
+        sim = self.submit(m, jobname='sim', tasksize=1)
+        self.submit(m, depends=['sim'])
+        render = m.jobs.get_job(sim.id + 1)
+        for frame in (1, 2):
+            m.handle_line(0, 'set_task_status %d %d complete' % (sim.id, frame))
+        self.sync(m)
+
+        restarted = Master(journal=Journal(self.path))
+        restarted.recover()
+        restored = restarted.jobs.get_job(render.id)
+        self.assertEqual(restored.depends,
+            [{ 'job': sim.id, 'window': [0, 0] }])
+        self.assertEqual(restored.stats()['blocked'], 2)
+        restarted.jobs.get_job(sim.id).set_task_status(3, 'complete')
+        restarted.jobs.get_job(sim.id).set_task_status(4, 'complete')
+        self.assertEqual(restored.stats()['blocked'], 1)
+
+    def test_snapshot(self):
+        m = self.master()
+        job = self.submit(m, endframe=10)
+        for frame in (1, 3, 5):
+            m.handle_line(0, 'set_task_status %d %d complete' % (job.id, frame))
+        self.sync(m)
+
+        # the snapshot covers everything journaled so far
+        self.assert_(m.journal.snapshot_seq == m.journal.seq == 4)
+        m.handle_line(0, 'pause_job %d' % (job.id,))
+        self.sync(m)
+
+        journal = Journal(self.path)
+        (state, records) = journal.recover()
+        self.assertEqual(state['jobs'][0]['complete'], [[1, 6]])
+        self.assertEqual([ r['op'] for r in records ], ['job_status'])
+
+        # a write cut short by a crash is ignored
+        fh = open(journal.log_path(), 'a')
+        fh.write('{"op": "comp')
+        fh.close()
+
+        restarted = Master(journal=Journal(self.path))
+        restarted.recover()
+        restored = restarted.jobs.get_job(job.id)
+        self.assertEqual(restored.status, 'paused')
+        self.assertEqual(list(restored.completed), [(1, 6)])
+        self.assertEqual(restored.stats()['frames_complete'], 6)
+
+        restored.set_task_status(7, 'complete')
+        restored.set_task_status(9, 'complete')
+        self.assertEqual(restored.status, 'complete')
+
+    def test_write_failed(self):
+        m = self.master()
+        job = self.submit(m, endframe=10)
+        m.handle_line(0, 'set_task_status %d 1 complete' % (job.id,))
+        # the batch never makes it to disk
+        (data, snapshot) = m.journal_batch()
+        self.assertEqual(snapshot, None)
+        m.journal.write_failed()
+
+        # the next write is a snapshot covering the lost records
+        (data, snapshot) = m.journal_batch()
+        self.assertEqual(snapshot['seq'], 2)
+        m.journal.write(data, snapshot)
+        restarted = Master(journal=Journal(self.path))
+        restarted.recover()
+        self.assertEqual(list(restarted.jobs.get_job(job.id).completed),
+            [(1, 2)])
+
+class TestMetrics(unittest.TestCase):
+    def test_render(self):
+        m = Metrics()
+        errors = m.counter('errors_total', 'Errors.', ('command',))
+        latency = m.histogram('latency_seconds', 'Latency.', buckets=(0.1, 1.0))
+        errors.inc('ping')
+        errors.inc('ping')
+        latency.observe(0.05)
+        latency.observe(0.5)
+        latency.observe(5)
+
+        self.assertEqual(m.render().splitlines(), [
+            '# HELP errors_total Errors.',
+            '# TYPE errors_total counter',
+            'errors_total{command="ping"} 2',
+            '# HELP latency_seconds Latency.',
+            '# TYPE latency_seconds histogram',
+            'latency_seconds_bucket{le="0.1"} 1',
+            'latency_seconds_bucket{le="1.0"} 2',
+            'latency_seconds_bucket{le="+Inf"} 3',
+            'latency_seconds_sum 5.55',
+            'latency_seconds_count 3',
+        ])
+
+    def test_master_metrics(self):
+        m = Master()
+        c = Client(MockProtocol())
+        m.add_client(c)
+        job = Job(job_file())
+        m.jobs.add_job(job)
+        m.dispatch_idle_clients()
+        m.handle_line(c.id, 'set_task_status %d 1 complete 2.0' % (job.id,))
+        m.handle_line(c.id, 'bogus')
+
+        lines = m.metrics.render().splitlines()
+        self.assert_('legion_command_seconds_count{command="set_task_status"} 1'
+            in lines)
+        self.assert_('legion_command_errors_total{command="unknown"} 1' in lines)
+        self.assert_('legion_job_tasks{job="%d",status="complete"} 1'
+            % (job.id,) in lines)
+        self.assert_('legion_tasks_in_flight 1' in lines)
+        self.assert_('legion_clients 1' in lines)
+        self.assert_('legion_client_frames_rendered_total{client="%d"} 2'
+            % (c.id,) in lines)
+
+class MockSink(Mocked):
+    def __init__(self, *args, **kwargs):
+        self.lines = []
+        Mocked.__init__(self, *args, **kwargs)
+
+    def write(self, line):
+        self.lines.append(line.split(' ', 1)[1])
+
+class TestLog(unittest.TestCase):
+    def test_levels(self):
+        sink = MockSink()
+        l = Logger(level=INFO, sink=sink)
+
+        class Expensive(object):
+            formatted = 0
+            def __str__(self):
+                Expensive.formatted += 1
+                return 'expensive'
+
+        l.debug("skipped %s", Expensive())
+        l.msg("client %d %s", 1, Expensive())
+        l.set_level('warn')
+        l.info("skipped")
+        l.warn("careful")
+
+        self.assertEqual(Expensive.formatted, 1)
+        self.assertEqual(sink.lines, ['[info] client 1 expensive',
+                                      '[warn] careful'])
+        self.failIf(l.enabled(DEBUG))
+
+    def test_every(self):
+        sink = MockSink()
+        l = Logger(sink=sink)
+        for frame in range(3):
+            l.every('timeout', 60, INFO, "frame %d timed out", frame)
+        l.limits['timeout'][0] -= 61
+        l.every('timeout', 60, INFO, "frame %d timed out", 3)
+        l.every('timeout', 60, DEBUG, "skipped")
+
+        self.assertEqual(sink.lines, ['[info] frame 0 timed out',
+            '[info] frame 3 timed out (2 similar messages suppressed)'])
+
+    def test_file_sink(self):
+        path = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(path, 'legion.log')
+            sink = FileSink(filename, interval=60)
+            Logger(sink=sink).warn("lease for client %d expired", 3)
+            sink.stop()
+            self.assert_(open(filename).read().endswith(
+                "[warn] lease for client 3 expired\n"))
+        finally:
+            shutil.rmtree(path)
+
+def fake_command(job, startframe, endframe, scene=None):
+    # the job name holds the fake renderer's options
+    return [ sys.executable, FAKE_RENDERER,
+             '-s', str(startframe), '-e', str(endframe) ] + job['jobname'].split()
+
+class WorkerTestCase(trial.TestCase):
+    timeout = 20
+
+    def setUp(self):
+        self.lines = []
+        self.worker = Worker(self.send_line, fake_command, slots=2)
+        self.worker.kill_grace = 0.2
+        self.addCleanup(self.stop)
+
+    def send_line(self, line):
+        self.lines.append(line)
+
+    def stop(self):
+        self.worker.stop()
+        return self.wait_for(lambda: not self.worker.running)
+
+    def wait_for(self, condition):
+        d = defer.Deferred()
+        def check():
+            if condition():
+                d.callback(None)
+            else:
+                reactor.callLater(0.01, check)
+        check()
+        return d
+
+    def reports(self):
+        reports = []
+        for line in self.lines:
+            (command, space, args) = line.partition(' ')
+            if command not in ('set_task_status', 'set_task_statuses'):
+                continue
+            fields = args.split()
+            for i in range(0, len(fields), 4):
+                reports.append((int(fields[i]), int(fields[i + 1]), fields[i + 2]))
+        return sorted(reports)
+
+class TestWorker(WorkerTestCase):
+    def submit(self, job_id, options='', timeout=60):
+        self.worker.handle_line('PUT /jobs/%d %s' % (job_id,
+            simplejson.dumps({ 'jobname': options, 'timeout': timeout })))
+
+    def render(self, job_id, start, end):
+        self.worker.handle_line('POST /jobs/%d/tasks/%d/render %d %d'
+            % (job_id, start, start, end))
+
+    def test_blender_command(self):
+        command = blender_command('/opt/blender', '/var/render')
+        self.assertEqual(command({ 'jobdir': 'j', 'filename': 'a.blend',
+                                   'jobname': 'a' }, 1, 10),
+            [ '/opt/blender', '-b', '/var/render/j/a.blend',
+              '-o', '/var/render/j/frames/a_####', '-s', '1', '-e', '10', '-a' ])
+
+    @defer.inlineCallbacks
+    def test_render(self):
+        self.submit(1, '--sleep 0.05')
+        self.render(1, 1, 2)
+        self.render(1, 3, 4)
+        self.render(1, 5, 6)
+        self.assertEqual(len(self.worker.running), 2)
+        self.assertEqual(len(self.worker.queue), 1)
+
+        yield self.wait_for(lambda: len(self.reports()) == 3)
+        self.assertEqual(self.reports(),
+            [ (1, 1, 'complete'), (1, 3, 'complete'), (1, 5, 'complete') ])
+        self.assert_('progress 1 1 1' in self.lines)
+        self.assert_('progress 1 1 2' in self.lines)
+
+    @defer.inlineCallbacks
+    def test_failure(self):
+        self.submit(1, '--exit 1')
+        self.render(1, 1, 1)
+        yield self.wait_for(self.reports)
+        self.assertEqual(self.reports(), [ (1, 1, 'error') ])
+
+    @defer.inlineCallbacks
+    def test_cancel(self):
+        self.submit(1, '--sleep 10')
+        self.render(1, 1, 1)
+        self.render(1, 2, 2)
+        self.render(1, 3, 3)
+        self.worker.handle_line('POST /jobs/1/tasks/3/cancel')
+        self.worker.handle_line('POST /jobs/1/tasks/1/cancel')
+        self.assertEqual(list(self.worker.queue), [])
+
+        yield self.wait_for(lambda: (1, 1) not in self.worker.running)
+        self.assertEqual(self.worker.running.keys(), [ (1, 2) ])
+        self.assertEqual(self.reports(), [])
+
+    @defer.inlineCallbacks
+    def test_timeout(self):
+        # renders that ignore being asked to stop are killed
+        self.submit(1, '--sleep 10 --ignore-term', timeout=0.2)
+        self.render(1, 1, 1)
+        yield self.wait_for(self.reports)
+        self.assertEqual(self.reports(), [ (1, 1, 'error') ])
+
+class AssetFiles(object):
+    """A job directory with a scene and a texture under a render root."""
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.root = os.path.join(self.path, 'root')
+        os.makedirs(os.path.join(self.root, 'jobdir', 'textures'))
+        self.scene = self.write('legion.blend', os.urandom(100 * 1024))
+        self.texture = self.write('textures/wood.png', 'wood')
+        self.store = AssetStore(self.root)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def write(self, name, data):
+        path = os.path.join(self.root, 'jobdir', name)
+        fh = open(path, 'wb')
+        fh.write(data)
+        fh.close()
+        return path
+
+    def read(self, path):
+        fh = open(path, 'rb')
+        try:
+            return fh.read()
+        finally:
+            fh.close()
+
+    def write_job(self, name='test.job', **kwargs):
+        filename = os.path.join(self.path, name)
+        fh = open(filename, 'w')
+        fh.write(job_file(**kwargs).getvalue())
+        fh.close()
+        return filename
+
+class TestAssets(AssetFiles, unittest.TestCase):
+    def test_store(self):
+        job = Job(job_file(assets=['textures/wood.png']))
+        manifest = self.store.add_job(job)
+        self.assertEqual(manifest, {
+            'legion.blend': list(hash_file(self.scene)),
+            'textures/wood.png': list(hash_file(self.texture)),
+        })
+
+        (hash, size) = manifest['legion.blend']
+        chunks = [ self.store.read_chunk(hash, i) for i in range(3) ]
+        self.assertEqual(''.join(chunks), self.read(self.scene))
+        self.assertEqual(self.store.read_chunk(hash, 3), '')
+        self.assertRaises(LegionError, self.store.read_chunk, '0' * 40, 0)
+
+        os.unlink(self.texture)
+        (hash, size) = manifest['textures/wood.png']
+        self.assertRaises(LegionError, self.store.read_chunk, hash, 0)
+        self.assertRaises(LegionError, self.store.add_job, job)
+
+    def test_master(self):
+        m = Master(assets=self.store)
+        c = Client(MockProtocol())
+        m.add_client(c)
+        m.handle_line(c.id, 'new_job %s' % (self.write_job(),))
+
+        job = m.jobs.pending().next()
+        (hash, size) = job.manifest['legion.blend']
+        self.assertEqual(job.to_hash()['manifest'], job.manifest)
+        m.handle_line(c.id, 'get_asset %s 1' % (hash,))
+        (put, path, data) = c._protocol.lines[-1].split()
+        self.assertEqual(path, '/assets/%s/1' % (hash,))
+        self.assertEqual(base64.b64decode(data),
+            self.store.read_chunk(hash, 1))
+
+        m.handle_line(c.id, 'get_asset %s 0' % ('0' * 40,))
+        self.assertEqual(c._protocol.lines[-1],
+            'Error: Unknown asset %s' % ('0' * 40,))
+
+    def submit(self, m, **kwargs):
+        m.handle_line(0, 'new_job %s' % (self.write_job(**kwargs),))
+        return m.jobs.get_job(max(m.jobs.jobs))
+
+    def test_reuse(self):
+        m = Master(assets=self.store,
+            journal=Journal(os.path.join(self.path, 'journal')))
+        m.add_client(MockClient(id=0))
+        job = self.submit(m)
+        m.handle_line(0, 'set_task_status %d 1 complete' % (job.id,))
+        m.jobs.get_job(job.id).get_task(3)
+        m.handle_line(0, 'set_task_status %d 3 complete' % (job.id,))
+
+        # resubmitted with more frames, only the new ones are rendered
+        job = self.submit(m, endframe=8)
+        self.assertEqual(list(job.completed), [ (1, 4) ])
+        self.assertEqual(job.stats()['frames_reused'], 4)
+        self.assertEqual(job.untouched_frames(), 4)
+        self.assertRaises(LegionError, job.get_task, 3)
+
+        # split up differently, partly rendered tasks are rendered again
+        job = self.submit(m, startframe=2, endframe=8, tasksize=3)
+        self.assertEqual(list(job.completed), [ (2, 4) ])
+        self.assertEqual(job.untouched_frames(), 4)
+        self.assertEqual(job.assign_next_task(MockClient()).startframe, 5)
+        self.assertEqual(job.assign_next_task(MockClient()).startframe, 8)
+        job = self.submit(m, endframe=10, tasksize=5)
+        self.assertEqual(job.untouched_frames(), 10)
+        self.assertEqual(job.assign_next_task(MockClient()).startframe, 1)
+        m.add_client(MockClient(id=1))
+
+        self.assertEqual(list(self.submit(m, reuse=False).completed), [])
+        self.assertEqual(list(self.submit(m, jobname='other').completed), [])
+        scene = self.read(self.scene)
+        self.write('legion.blend', 'changed')
+        self.assertEqual(list(self.submit(m).completed), [])
+        self.write('legion.blend', scene)
+
+        # a restarted master remembers what was rendered
+        (data, snapshot) = m.journal_batch()
+        m.journal.write(data, snapshot)
+        m = Master(assets=AssetStore(self.root),
+            journal=Journal(os.path.join(self.path, 'journal')))
+        m.recover()
+        self.assertEqual(list(m.jobs.get_job(job.id).completed), [ (1, 4) ])
+        m.add_client(MockClient(id=0))
+        self.assertEqual(list(self.submit(m, endframe=2).completed),
+            [ (1, 2) ])
+        self.assertEqual(m.jobs.get_job(max(m.jobs.jobs)).status, 'complete')
+
+    def test_reuse_tiles(self):
+        m = Master(assets=self.store)
+        m.add_client(MockClient(id=0))
+        job = self.submit(m, endframe=3, type='tile', tiles=[2, 1],
+            resolution=[4, 2])
+        for unit in (0, 1):
+            m.jobs.get_job(job.id).get_task(unit)
+            m.handle_line(0, 'set_task_status %d %d complete' % (job.id, unit))
+
+        # tiles are numbered from the first frame, a job starting at
+        # another frame can't tell which of its tiles were rendered
+        job = self.submit(m, startframe=2, endframe=3, type='tile',
+            tiles=[2, 1], resolution=[4, 2])
+        self.assertEqual(list(job.completed), [])
+        job = self.submit(m, endframe=2, type='tile', tiles=[2, 1],
+            resolution=[4, 2])
+        self.assertEqual(list(job.completed), [ (0, 1) ])
+
+    def download(self, cache, path):
+        (hash, size) = hash_file(path)
+        download = cache.download(hash, size)
+        download.write(self.read(path))
+        download.finish()
+        return hash
+
+    def test_cache(self):
+        cache = AssetCache(os.path.join(self.path, 'cache'), 100 * 1024 + 4)
+        scene = self.download(cache, self.scene)
+        texture = self.download(cache, self.texture)
+        self.assertEqual(self.read(cache.blob_path(scene)),
+            self.read(self.scene))
+
+        jobdir = cache.job_dir(1, { 'legion.blend': [ scene, 0 ],
+                                    'textures/wood.png': [ texture, 4 ] })
+        self.assertEqual(self.read(os.path.join(jobdir, 'textures/wood.png')),
+            'wood')
+
+        # least recently used assets are evicted unless pinned
+        cache.touch(scene)
+        cache.pin(scene)
+        cache.pin(texture)
+        other = self.write('other', 'other')
+        cache.pin(hash_file(other)[0])
+        self.download(cache, other)
+        self.assertEqual(cache.size, 100 * 1024 + 9)
+        cache.unpin(texture)
+        self.assert_(cache.has(scene))
+        self.assertFalse(cache.has(texture))
+        self.assertFalse(os.path.exists(cache.blob_path(texture)))
+
+        # a restarted worker keeps its cache, trimmed to the limit now
+        # nothing is pinned
+        cache = AssetCache(cache.path, cache.max_bytes)
+        self.assertEqual(cache.size, 5)
+        self.assert_(cache.has(hash_file(other)[0]))
+
+    def test_verification(self):
+        cache = AssetCache(os.path.join(self.path, 'cache'), 1024 * 1024)
+        (hash, size) = hash_file(self.texture)
+        download = cache.download(hash, size)
+        download.write('tree')
+        self.assertRaises(LegionError, download.finish)
+        self.assertFalse(cache.has(hash))
+        self.assertEqual(os.listdir(cache.objects), [])
+
+class TestWorkerAssets(AssetFiles, WorkerTestCase):
+    """A worker with an asset cache talking to a master with an asset store."""
+    def setUp(self):
+        AssetFiles.setUp(self)
+        self.addCleanup(AssetFiles.tearDown, self)
+        WorkerTestCase.setUp(self)
+        self.worker.cache = AssetCache(os.path.join(self.path, 'cache'),
+            1024 * 1024)
+        self.worker.command = self.command
+        self.scenes = []
+
+        self.master = Master(assets=self.store)
+        self.connected = True
+        # drop asset chunks, as if the master never answered
+        self.lost_assets = False
+        self.deliveries = []
+        self.client = Client(MockProtocol(sendLine=self.deliver))
+        self.master.add_client(self.client)
+        self.master.handle_line(self.client.id, 'protocol 2')
+        self.master.handle_line(self.client.id, 'slots 2')
+
+    def tearDown(self):
+        self.connected = False
+        for call in self.deliveries:
+            if call.active(): call.cancel()
+
+    def deliver(self, line):
+        # lines from the master reach the worker on the next iteration, as
+        # if they had been sent over a connection
+        if self.connected and not (self.lost_assets and
+                                   line.startswith('PUT /assets/')):
+            self.deliveries.append(
+                reactor.callLater(0, self.worker.handle_line, line))
+
+    def send_line(self, line):
+        self.lines.append(line)
+        self.master.handle_line(self.client.id, line)
+
+    def command(self, job, startframe, endframe, scene=None):
+        self.scenes.append(scene)
+        return fake_command(job, startframe, endframe)
+
+    def submit(self, **kwargs):
+        filename = self.write_job(endframe=2, tasksize=1, jobname='',
+            assets=['textures/wood.png'], **kwargs)
+        self.master.handle_line(self.client.id, 'new_job %s' % (filename,))
+        return max(self.master.jobs.jobs)
+
+    def fetched(self):
+        return [ line for line in self.lines if line.startswith('get_asset') ]
+
+    @defer.inlineCallbacks
+    def test_fetch(self):
+        job_id = self.submit()
+        yield self.wait_for(lambda: len(self.reports()) == 2)
+        self.assertEqual(self.reports(),
+            [ (job_id, 1, 'complete'), (job_id, 2, 'complete') ])
+        # both tasks waited for the same download
+        self.assertEqual(len(self.fetched()), 4)
+        scene = os.path.join(self.worker.cache.jobs, str(job_id),
+            'legion.blend')
+        self.assertEqual(self.scenes, [ scene, scene ])
+        self.assertEqual(self.read(scene), self.read(self.scene))
+        self.assertEqual(self.worker.cache.pinned, {})
+        self.assert_(self.master.jobs.get_job(job_id).locality_key()
+            in self.client.warm)
+
+        # the same scene in a new job is already cached
+        job_id = self.submit(reuse=False)
+        yield self.wait_for(lambda: len(self.reports()) == 4)
+        self.assertEqual(self.reports()[2:],
+            [ (job_id, 1, 'complete'), (job_id, 2, 'complete') ])
+        self.assertEqual(len(self.fetched()), 4)
+
+    @defer.inlineCallbacks
+    def test_corrupt(self):
+        job_id = self.submit()
+        # the texture changes between being hashed and being fetched
+        self.write('textures/wood.png', 'tree')
+        yield self.wait_for(lambda: len(self.reports()) >= 2)
+        # failed tasks are retried, stop the job failing over and over
+        self.master.set_job_status(job_id, 'paused')
+        self.assertEqual(set(self.reports()),
+            set([ (job_id, 1, 'error'), (job_id, 2, 'error') ]))
+        self.assertEqual(self.scenes, [])
+        # retries already sent fail the same way
+        yield self.wait_for(lambda: not self.worker.starting and
+            not [ call for call in self.deliveries if call.active() ])
+        self.assertEqual(self.worker.cache.pinned, {})
+
+    @defer.inlineCallbacks
+    def test_missing(self):
+        job_id = self.submit()
+        # the texture is gone by the time it's fetched
+        os.unlink(self.texture)
+        yield self.wait_for(lambda: len(self.reports()) >= 2)
+        self.master.set_job_status(job_id, 'paused')
+        self.assertEqual(set(self.reports()),
+            set([ (job_id, 1, 'error'), (job_id, 2, 'error') ]))
+        yield self.wait_for(lambda: not self.worker.starting and
+            not [ call for call in self.deliveries if call.active() ])
+        self.assertEqual(self.worker.downloads, {})
+
+    @defer.inlineCallbacks
+    def test_download_timeout(self):
+        self.worker.download_timeout = 0.1
+        self.lost_assets = True
+        job_id = self.submit()
+        yield self.wait_for(lambda: len(self.reports()) >= 2)
+        self.master.set_job_status(job_id, 'paused')
+        self.assertEqual(set(self.reports()),
+            set([ (job_id, 1, 'error'), (job_id, 2, 'error') ]))
+        yield self.wait_for(lambda: not self.worker.starting and
+            not self.worker.downloads)
+        self.assertEqual(self.worker.cache.pinned, {})
+
+class TestTiles(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.root, 'jobdir', 'tiles'))
+        self.job = Job(job_file(type='tile', tiles=[2, 2], resolution=[7, 5],
+            endframe=2))
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_job(self):
+        self.assertEqual(self.job.task_count(), 8)
+        self.assertEqual(self.job.get_task(7).startframe, 7)
+        self.assertEqual(tiles.split_unit(5, 1, [2, 2]), (2, 1))
+
+        for bad in ({ 'type': 'still' },
+                    { 'type': 'tile', 'tiles': [2, 2] },
+                    { 'type': 'tile', 'tiles': [0, 2], 'resolution': [7, 5] },
+                    { 'type': 'tile', 'tiles': [2, 2], 'resolution': [7, 5],
+                      'chunking': 'guided' }):
+            self.assertRaises(LegionError, Job, job_file(**bad))
+
+    def test_rects(self):
+        # the tiles cover every pixel exactly once
+        covered = []
+        for tile in range(6):
+            (x0, y0, x1, y1) = tiles.tile_rect(tile, [3, 2], [7, 5])
+            covered.extend((x, y) for x in range(x0, x1) for y in range(y0, y1))
+        self.assertEqual(sorted(covered),
+            [ (x, y) for x in range(7) for y in range(5) ])
+        self.assertEqual(tiles.tile_rect(4, [3, 2], [7, 5]), (2, 2, 4, 5))
+
+    def test_blender_command(self):
+        command = blender_command('/opt/blender', '/var/render')
+        argv = command(simplejson.loads(self.job.to_json()), 5, 5)
+        self.assertEqual(argv[:3], [ '/opt/blender', '-b',
+            '/var/render/jobdir/legion.blend' ])
+        self.assertEqual(argv[5:], [
+            '-o', '/var/render/jobdir/tiles/legionjob_####_001',
+            '-F', 'RAWTGA', '-x', '1', '-f', '2' ])
+        self.assert_('r.border_min_x = 0.42857142857142855' in argv[4])
+        self.assert_('r.border_min_y = 0.6' in argv[4])
+
+    def pixel(self, x, y, frame):
+        return chr(x) + chr(y) + chr(frame)
+
+    def render_tile(self, unit):
+        """Write a tile the way blender would, bottom up for odd tiles."""
+        (frame, tile) = tiles.split_unit(unit, 1, [2, 2])
+        (x0, y0, x1, y1) = tiles.tile_rect(tile, [2, 2], [7, 5])
+        rows = [
+            ''.join(self.pixel(x, y, frame) for x in range(x0, x1))
+            for y in range(y0, y1)
+        ]
+        bottom_up = tile % 2
+        if bottom_up: rows.reverse()
+
+        fh = open(os.path.join(self.root, 'jobdir', 'tiles',
+            tiles.tile_name('legionjob', frame, tile)), 'wb')
+        tiles.write_tga_header(fh, x1 - x0, y1 - y0, 3)
+        if bottom_up:
+            fh.seek(17)
+            fh.write(chr(0))
+        fh.write(''.join(rows))
+        fh.close()
+
+    def read_frame(self, frame):
+        fh = open(os.path.join(self.root, 'jobdir', 'frames',
+            tiles.frame_name('legionjob', frame)), 'rb')
+        try:
+            self.assertEqual(tiles.read_tga_header(fh), (7, 5, 3, True, 18))
+            return fh.read()
+        finally:
+            fh.close()
+
+    def test_assemble(self):
+        m = Master(assembler=tiles.TileAssembler(self.root, threaded=False))
+        m.add_client(MockClient(id=0))
+        m.jobs.add_job(self.job)
+        frames = os.path.join(self.root, 'jobdir', 'frames')
+
+        for unit in range(3):
+            self.render_tile(unit)
+            m.handle_line(0, 'set_task_status %d %d complete'
+                % (self.job.id, unit))
+        self.assertEqual(os.listdir(frames), [ 'legionjob_0001.tga.part' ])
+
+        self.render_tile(3)
+        m.handle_line(0, 'set_task_status %d 3 complete' % (self.job.id,))
+        self.assertEqual(os.listdir(frames), [ 'legionjob_0001.tga' ])
+        self.assertEqual(self.read_frame(1), ''.join(
+            self.pixel(x, y, 1) for y in range(5) for x in range(7)))
+        # tiles are removed once their frame is assembled
+        self.assertEqual(os.listdir(os.path.join(self.root, 'jobdir', 'tiles')),
+            [])
+
+    def test_threaded(self):
+        assembler = tiles.TileAssembler(self.root)
+        for unit in range(4, 8):
+            self.render_tile(unit)
+            assembler.add(self.job, unit)
+        assembler.stop()
+        self.assertEqual(self.read_frame(2), ''.join(
+            self.pixel(x, y, 2) for y in range(5) for x in range(7)))
+
+class TestUploads(AssetFiles, unittest.TestCase):
+    def setUp(self):
+        AssetFiles.setUp(self)
+        self.master = Master(uploads=UploadStore(self.root))
+        self.client = Client(MockProtocol())
+        self.master.add_client(self.client)
+        self.job = Job(job_file())
+        self.master.jobs.add_job(self.job)
+        self.data = os.urandom(100 * 1024)
+
+    def send(self, line):
+        self.master.handle_line(self.client.id, line)
+        return self.client._protocol.lines[-1]
+
+    def upload(self, id, name, data, hash=None):
+        self.send('upload %d %d %d %s' % (id, self.job.id, len(data),
+            urllib.quote(name)))
+        for (i, start) in enumerate(range(0, len(data), 48 * 1024)):
+            self.assertEqual(self.send('upload_chunk %d %d %s' % (id, i,
+                base64.b64encode(data[start:start + 48 * 1024]))),
+                'ACK /uploads/%d/%d' % (id, i))
+        return self.send('upload_end %d %s'
+            % (id, hash or hashlib.sha1(data).hexdigest()))
+
+    def test_upload(self):
+        self.assertEqual(self.upload(1, 'frames/legionjob_0001.png',
+            self.data), 'POST /uploads/1/done')
+        self.assertEqual(self.read(os.path.join(self.root, 'jobdir',
+            'frames', 'legionjob_0001.png')), self.data)
+        self.assertEqual(self.master.upload_bytes.values[()], len(self.data))
+        self.assert_(self.client.upload_rate > 0)
+
+    def test_space_in_name(self):
+        filename = self.write('my frame.png', self.data)
+        upload = Upload(1, self.job.id, 1, filename, 'frames/my frame.png')
+        self.send(upload.begin_line())
+        for line in upload.next_lines(10):
+            reply = self.send(line)
+        upload.close(remove=False)
+        self.assertEqual(reply, 'POST /uploads/1/done')
+        self.assertEqual(self.read(os.path.join(self.root, 'jobdir',
+            'frames', 'my frame.png')), self.data)
+
+    def test_same_file(self):
+        # both copies of a task upload the same file at once
+        other = Client(MockProtocol())
+        self.master.add_client(other)
+        loser = os.urandom(len(self.data))
+        uploads = []
+        for (client, data) in ((self.client, self.data), (other, loser)):
+            upload = Upload(1, self.job.id, 1, self.write('%d.png'
+                % (client.id,), data), 'frames/legionjob_0001.png')
+            uploads.append((client, upload, [ upload.begin_line() ]
+                + upload.next_lines(10)))
+        while uploads[0][2] or uploads[1][2]:
+            for (client, upload, lines) in uploads:
+                if lines:
+                    self.master.handle_line(client.id, lines.pop(0))
+        for (client, upload, lines) in uploads:
+            upload.close(remove=False)
+            self.assertEqual(client._protocol.lines[-1], 'POST /uploads/1/done')
+
+        # the first to finish is kept
+        self.assertEqual(self.read(os.path.join(self.root, 'jobdir',
+            'frames', 'legionjob_0001.png')), self.data)
+        self.assertEqual(os.listdir(os.path.join(self.root, 'jobdir',
+            'frames')), [ 'legionjob_0001.png' ])
+
+    def test_errors(self):
+        self.assertEqual(self.send('upload 1 %d 1 ../escape.png'
+            % (self.job.id,)), 'Error: Upload 1: invalid path "../escape.png"')
+        self.assertEqual(self.send('upload_chunk 1 0 eA=='),
+            'Error: Upload 1: unknown')
+        self.assertEqual(self.upload(2, 'frames/a.png', self.data, 'f00'),
+            'Error: Upload 2 failed verification')
+        self.assertEqual(self.send('upload 3 12345 1 frames/a.png'),
+            'Error: Upload 3: No job with id 12345')
+
+        # part of a file is dropped along with its client
+        self.send('upload 4 %d 10 frames/b.png' % (self.job.id,))
+        self.send('upload_chunk 4 0 %s' % (base64.b64encode('12345'),))
+        self.assertEqual(self.send('upload_chunk 4 2 %s'
+            % (base64.b64encode('67890'),)),
+            'Error: Upload 4: expected chunk 1, got 2')
+        self.send('upload 5 %d 10 frames/c.png' % (self.job.id,))
+        self.master.remove_client(self.client.id)
+        self.assertEqual(os.listdir(os.path.join(self.root, 'jobdir',
+            'frames')), [])
+
+class TestWorkerUploads(AssetFiles, WorkerTestCase):
+    """A worker uploading what it renders to a master with an upload store."""
+    def setUp(self):
+        AssetFiles.setUp(self)
+        self.addCleanup(AssetFiles.tearDown, self)
+        WorkerTestCase.setUp(self)
+        self.results = os.path.join(self.path, 'results')
+        os.makedirs(os.path.join(self.results, 'jobdir', 'frames'))
+        self.worker.results = self.results
+
+        self.master = Master(uploads=UploadStore(self.root))
+        self.connected = True
+        self.deliveries = []
+        self.unacked = []
+        self.client = Client(MockProtocol(sendLine=self.deliver))
+        self.master.add_client(self.client)
+        self.master.handle_line(self.client.id, 'protocol 2')
+        self.master.handle_line(self.client.id, 'slots 2')
+
+    def tearDown(self):
+        self.connected = False
+        for call in self.deliveries:
+            if call.active(): call.cancel()
+
+    def deliver(self, line):
+        if self.connected:
+            self.deliveries.append(
+                reactor.callLater(0, self.worker.handle_line, line))
+
+    def send_line(self, line):
+        self.lines.append(line)
+        if self.worker.uploads:
+            upload = self.worker.uploads[0]
+            self.unacked.append(upload.sent - upload.acked)
+        self.master.handle_line(self.client.id, line)
+
+    def submit(self, size, job_id=None):
+        output = os.path.join(self.results, 'jobdir', 'frames')
+        filename = self.write_job(endframe=2, tasksize=1,
+            jobname='--output %s --size %d' % (output, size))
+        self.master.handle_line(self.client.id, 'new_job %s' % (filename,))
+        return max(self.master.jobs.jobs)
+
+    def uploaded(self, frame):
+        return os.path.join(self.root, 'jobdir', 'frames',
+            'frame_%04d.png' % (frame,))
+
+    def test_saved_path(self):
+        for line in ("Saved: /r/a_0001.png Time: 00:01.20 (Saving: 00:00.10)",
+                     "Saved: '/r/a_0001.png'", 'Saved: "/r/a_0001.png"'):
+            self.assertEqual(saved_path(line), '/r/a_0001.png')
+
+    @defer.inlineCallbacks
+    def test_upload(self):
+        job_id = self.submit(400 * 1024)
+        yield self.wait_for(lambda: len(self.reports()) == 2)
+        self.assertEqual(self.reports(),
+            [ (job_id, 1, 'complete'), (job_id, 2, 'complete') ])
+        for frame in (1, 2):
+            self.assertEqual(self.read(self.uploaded(frame)),
+                ('%04d' % (frame,)) * (100 * 1024))
+        # the local copies are gone and no more than a window was in flight
+        self.assertEqual(os.listdir(os.path.join(self.results, 'jobdir',
+            'frames')), [])
+        self.assertEqual(max(self.unacked), self.worker.upload_window)
+        self.assertEqual(self.worker.uploading, {})
+
+    @defer.inlineCallbacks
+    def test_failure(self):
+        # the master can't write under its root
+        self.master.uploads.root = self.scene
+        job_id = self.submit(1000)
+        yield self.wait_for(lambda: len(self.reports()) >= 2)
+        self.master.set_job_status(job_id, 'paused')
+        self.assertEqual(set(self.reports()),
+            set([ (job_id, 1, 'error'), (job_id, 2, 'error') ]))
+        yield self.wait_for(lambda: not self.worker.running)
+        self.assertEqual(self.worker.uploading, {})
+
+class TestIngest(AssetFiles, trial.TestCase):
+    timeout = 20
+
+    def setUp(self):
+        AssetFiles.setUp(self)
+        self.master = Master(assets=self.store,
+            defer_to_thread=threads.deferToThread)
+        self.client = MockClient(id=0)
+        self.master.add_client(self.client)
+        self.jobs = []
+
+    def submit(self, command, *jobs):
+        paths = []
+        for job in jobs:
+            paths.append(self.write_job(name='%d.job' % (len(self.jobs),),
+                **job))
+            self.jobs.append(paths[-1])
+        self.master.handle_line(0, '%s %s' % (command, ' '.join(paths)))
+
+    def wait_for(self, condition):
+        return WorkerTestCase.wait_for.im_func(self, condition)
+
+    def added(self):
+        return [ line for line in self.client.received
+                 if str(line).startswith('# Added job') ]
+
+    @defer.inlineCallbacks
+    def test_threaded(self):
+        self.submit('new_jobs', { 'jobname': 'sim', 'endframe': 20000,
+            'tasksize': 1 }, { 'depends': ['sim'] })
+        self.submit('new_job', { 'jobname': 'late' })
+        # nothing is added until the whole submission has loaded
+        self.assertEqual(self.master.jobs.jobs, {})
+        yield self.wait_for(lambda: len(self.added()) == 3)
+        self.assertEqual([ self.master.jobs.jobs[id].jobname
+                           for id in self.master.jobs.job_ids ],
+            [ 'sim', 'legionjob', 'late' ])
+        self.assert_(self.master.jobs.jobs[self.master.jobs.job_ids[0]]
+            .manifest)
+        # one load per submission
+        self.assertEqual(sum(self.master.load_time.series[()][0]), 2)
+
+    @defer.inlineCallbacks
+    def test_failed(self):
+        self.submit('new_jobs', { 'jobname': 'sim' },
+            { 'depends': ['missing'] })
+        self.submit('new_jobs', { 'jobname': 'ok' }, { 'colour': 'red' })
+        self.submit('new_job', {})
+        yield self.wait_for(lambda: len(self.added()) == 1)
+        # neither batch was added in part
+        self.assertEqual([ line for line in self.client.received
+                           if str(line).startswith('Error') ],
+            [ 'Error: No job named "missing"',
+              'Error: Invalid key in job file, "colour"' ])
+        self.assertEqual(len(self.master.jobs.jobs), 1)
+        self.assertEqual(self.master.command_errors.values[('new_jobs',)], 2)
+
+    def test_stall(self):
+        calls = []
+        m = Metrics()
+        stalls = m.histogram('stall_seconds', 'Stalls.', buckets=(0.5,))
+        monitor = StallMonitor(stalls, lambda delay, f: calls.append(f), 1)
+        monitor.start()
+        monitor.due -= 3
+        calls.pop()()
+        self.assertEqual(len(calls), 1, 'checks again')
+        self.assert_(2 <= monitor.worst < 3)
+        self.assertEqual(stalls.series[()][0], [0, 1])
+
 # class TestClient(unittest.TestCase):
 #     def setUp(self):
 #         pass